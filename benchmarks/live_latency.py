@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# Measures how long after capture live HLS segments become available, using a synthetic realtime source.
+#
+#   python3 benchmarks/live_latency.py --hls-time 1 --gop 1 --segment-type fmp4
+#
+# The source is encoded by a separate FFmpeg and piped into a second one that runs the same live output
+# arguments as the server, so the muxer under test copies H.264 like it does for a camera.
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ffmpeg  # noqa: E402
+
+
+def relay(src, dst, started):
+    while True:
+        data = src.read1(65536)
+        if not data:
+            break
+        if not started:
+            started.append(time.monotonic())
+        try:
+            dst.write(data)
+            dst.flush()
+        except BrokenPipeError:
+            break
+    dst.close()
+
+
+def read_playlist(path):
+    try:
+        with open(path) as f:
+            lines = [line.strip() for line in f]
+    except FileNotFoundError:
+        return None, []
+    sequence = 0
+    segments = []
+    duration = None
+    for line in lines:
+        if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            sequence = int(line.split(':', 1)[1])
+        elif line.startswith('#EXTINF:'):
+            duration = float(line.split(':', 1)[1].rstrip(',').split(',')[0])
+        elif line and not line.startswith('#'):
+            segments.append((line, duration))
+    return sequence, segments
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Live HLS segment availability benchmark')
+    parser.add_argument('--ffmpeg', default=shutil.which('ffmpeg') or '/usr/bin/ffmpeg')
+    parser.add_argument('--hls-time', type=float, default=2)
+    parser.add_argument('--list-size', type=int, default=5)
+    parser.add_argument('--segment-type', choices=('mpegts', 'fmp4'), default='mpegts')
+    parser.add_argument('--gop', type=float, default=1, help='keyframe interval of the source, seconds')
+    parser.add_argument('--fps', type=int, default=25)
+    parser.add_argument('--duration', type=float, default=30, help='seconds to measure')
+    args = parser.parse_args()
+
+    live_dir = tempfile.mkdtemp(prefix='videoserver-latency-')
+    name = 'bench'
+    playlist = os.path.join(live_dir, '{}.m3u8'.format(name))
+    source = subprocess.Popen([
+        args.ffmpeg, '-hide_banner', '-loglevel', 'error', '-re',
+        '-f', 'lavfi', '-i', 'testsrc2=size=1280x720:rate={:d}'.format(args.fps),
+        '-c:v', 'libx264', '-preset', 'veryfast', '-tune', 'zerolatency',
+        '-g', '{:d}'.format(max(int(args.gop * args.fps), 1)), '-f', 'mpegts', 'pipe:1',
+    ], stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+    muxer = subprocess.Popen(
+        [args.ffmpeg, '-hide_banner', '-loglevel', 'error', '-y', '-f', 'mpegts', '-i', 'pipe:0']
+        + ffmpeg.live_output_args(name, live_dir, args.hls_time, args.list_size, args.segment_type),
+        stdin=subprocess.PIPE,
+    )
+    started = []
+    threading.Thread(target=relay, args=(source.stdout, muxer.stdin, started), daemon=True).start()
+
+    segment_end = {}
+    delays = []
+    end = time.monotonic() + args.duration
+    try:
+        while time.monotonic() < end:
+            sequence, segments = read_playlist(playlist)
+            now = time.monotonic()
+            for i, (segment, duration) in enumerate(segments):
+                index = sequence + i
+                if index in segment_end or not started:
+                    continue
+                start = segment_end.get(index - 1, 0 if index == 0 else None)
+                if start is None:
+                    continue
+                segment_end[index] = start + duration
+                # the first frame of the segment left the source this long ago
+                delay = now - (started[0] + start)
+                delays.append(delay)
+                print('segment {:d}: {:.2f} s long, available {:.2f} s after its first frame'.format(
+                    index, duration, delay))
+            time.sleep(0.01)
+    finally:
+        source.terminate()
+        muxer.terminate()
+        source.wait()
+        muxer.wait()
+        shutil.rmtree(live_dir, ignore_errors=True)
+
+    if not delays:
+        print('No segments were produced')
+        return 1
+    # players start this far behind the newest segment, 3 target durations unless told otherwise
+    hold_back = 3 * args.hls_time
+    print('segments: {:d}, availability delay: mean {:.2f} s, max {:.2f} s'.format(
+        len(delays), statistics.mean(delays), max(delays)))
+    print('estimated player latency with a {:.1f} s hold back: {:.2f} s'.format(
+        hold_back, statistics.mean(delays) + hold_back - args.hls_time))
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,319 @@
+import heapq
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import recindex
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS segments (
+    filename TEXT PRIMARY KEY,
+    stream TEXT NOT NULL,
+    start REAL NOT NULL,
+    end REAL,
+    size INTEGER NOT NULL,
+    closed INTEGER NOT NULL,
+    volume TEXT NOT NULL,
+    scan INTEGER NOT NULL DEFAULT 0,
+    path TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS segments_stream_start ON segments (stream, start, filename);
+CREATE INDEX IF NOT EXISTS segments_start ON segments (start);
+CREATE TABLE IF NOT EXISTS streams (stream TEXT PRIMARY KEY, count INTEGER NOT NULL, size INTEGER NOT NULL);
+CREATE TRIGGER IF NOT EXISTS segments_insert AFTER INSERT ON segments BEGIN
+    INSERT OR IGNORE INTO streams (stream, count, size) VALUES (NEW.stream, 0, 0);
+    UPDATE streams SET count = count + 1, size = size + NEW.size WHERE stream = NEW.stream;
+END;
+CREATE TRIGGER IF NOT EXISTS segments_delete AFTER DELETE ON segments BEGIN
+    UPDATE streams SET count = count - 1, size = size - OLD.size WHERE stream = OLD.stream;
+    DELETE FROM streams WHERE stream = OLD.stream AND count <= 0;
+END;
+CREATE TRIGGER IF NOT EXISTS segments_resize AFTER UPDATE OF size ON segments BEGIN
+    UPDATE streams SET size = size + NEW.size - OLD.size WHERE stream = NEW.stream;
+END;
+'''
+COLUMNS = 'stream, start, filename, size, closed, end'
+
+
+def _segment(row):
+    return recindex.Segment(row[0], row[1], row[2], row[3], bool(row[4]))
+
+
+# same interface as RecordingIndex, but the index survives restarts in SQLite and is reconciled with
+# rec_dir in the background, so startup does not depend on the number of recordings
+class RecordingCatalog(recindex.RecordingIndex):
+    def __init__(self, rec_dir, date_fmt, path, rescan_interval=60, batch_size=500):
+        super().__init__(rec_dir, date_fmt, rescan_interval)
+        self.path = path
+        self.batch_size = batch_size
+        self.local = threading.local()
+        self.generation = int(time.time() * 1000)
+        self.reconciler = None
+        self.stopping = False
+        self.reconciled = False
+        conn = self._connection()
+        with conn:
+            conn.executescript(SCHEMA)
+            if 'path' not in [row[1] for row in conn.execute('PRAGMA table_info(segments)')]:
+                # catalogs created before rows stored their full path
+                conn.execute("ALTER TABLE segments ADD COLUMN path TEXT NOT NULL DEFAULT ''")
+                conn.execute("UPDATE segments SET path = volume || '/' || filename")
+            volume = conn.execute("SELECT value FROM meta WHERE key = 'volume'").fetchone()
+            if volume and volume[0] != self.rec_dir:
+                logging.warning('rec_dir changed from %s, discarding the recording catalog', volume[0])
+                conn.execute('DELETE FROM segments')
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('volume', ?)", (self.rec_dir,))
+
+    def _connection(self):
+        # one connection per thread, WAL lets API requests read while the main loop writes
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def stop(self):
+        self.stopping = True
+        if self.reconciler:
+            self.reconciler.join()
+        super().stop()
+
+    def scan(self):
+        if self.reconciler and self.reconciler.is_alive():
+            return
+        self.generation = int(time.time() * 1000)
+        self.reconciler = threading.Thread(target=self._reconcile, args=(self.generation,), name='catalog')
+        self.reconciler.daemon = True
+        self.reconciler.start()
+        self.next_rescan = time.monotonic() + self.rescan_interval
+
+    def _reconcile(self, generation):
+        started = time.monotonic()
+        conn = self._connection()
+        seen = 0
+        added = 0
+        batch = []
+        latest_streams = []
+        with os.scandir(self.rec_dir) as it:
+            for entry in it:
+                if self.stopping:
+                    return
+                if entry.name.endswith(recindex.LATEST_SUFFIX):
+                    latest_streams.append(entry.name[:-len(recindex.LATEST_SUFFIX)])
+                    continue
+                parsed = self._parse(entry.name)
+                if not parsed:
+                    continue
+                batch.append((entry, parsed))
+                if len(batch) >= self.batch_size:
+                    added += self._reconcile_batch(conn, batch, generation)
+                    seen += len(batch)
+                    batch = []
+        added += self._reconcile_batch(conn, batch, generation)
+        seen += len(batch)
+        removed = 0
+        stale = conn.execute('SELECT filename FROM segments WHERE scan != ?', (generation,)).fetchall()
+        for filename, in stale:
+            # files created after the directory listing was taken are still there
+            if not os.path.exists(os.path.join(self.rec_dir, filename)) and self.remove(filename):
+                removed += 1
+        self.reconciled = True
+        logging.info(
+            'Reconciled recording catalog with %d files in %.3f s: %d added, %d removed',
+            seen, time.monotonic() - started, added, removed,
+        )
+        self.remove_stale_latest_files(latest_streams)
+
+    def _reconcile_batch(self, conn, batch, generation):
+        if not batch:
+            return 0
+        known = dict(conn.execute(
+            'SELECT filename, closed FROM segments WHERE filename IN ({})'.format(','.join('?' * len(batch))),
+            [entry.name for entry, _ in batch],
+        ).fetchall())
+        added = 0
+        with conn:
+            for entry, (stream, start) in batch:
+                if known.get(entry.name):
+                    # closed files do not change, no need to stat them again
+                    conn.execute(
+                        'UPDATE segments SET scan = ? WHERE filename = ? AND scan != ?',
+                        (generation, entry.name, generation),
+                    )
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name in known:
+                    # left open by a previous run
+                    conn.execute(
+                        'UPDATE segments SET size = ?, end = ?, closed = 1, scan = ? WHERE filename = ? AND scan != ?',
+                        (stat.st_size, stat.st_mtime, generation, entry.name, generation),
+                    )
+                    continue
+                cursor = conn.execute(
+                    'INSERT OR IGNORE INTO segments (filename, stream, start, end, size, closed, volume, scan, path) '
+                    'VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?)',
+                    (entry.name, stream, start, stat.st_mtime, stat.st_size, self.rec_dir, generation, entry.path),
+                )
+                added += cursor.rowcount
+        return added
+
+    def add(self, filename, closed=True):
+        parsed = self._parse(filename)
+        if not parsed:
+            return None
+        try:
+            stat = os.stat(os.path.join(self.rec_dir, filename))
+        except FileNotFoundError:
+            return None
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                'INSERT INTO segments (filename, stream, start, end, size, closed, volume, scan, path) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (filename) DO UPDATE '
+                'SET end = excluded.end, size = excluded.size, closed = excluded.closed, scan = excluded.scan',
+                (
+                    filename, parsed[0], parsed[1], stat.st_mtime if closed else None, stat.st_size, int(closed),
+                    self.rec_dir, self.generation, os.path.join(self.rec_dir, filename),
+                ),
+            )
+        return recindex.Segment(parsed[0], parsed[1], filename, stat.st_size, closed)
+
+    def remove(self, filename):
+        conn = self._connection()
+        with conn:
+            row = conn.execute('SELECT {} FROM segments WHERE filename = ?'.format(COLUMNS), (filename,)).fetchone()
+            if not row:
+                return None
+            conn.execute('DELETE FROM segments WHERE filename = ?', (filename,))
+        return _segment(row)
+
+    def contains(self, filename):
+        if not self.reconciled and os.path.exists(os.path.join(self.rec_dir, filename)):
+            return True
+        return self._connection().execute('SELECT 1 FROM segments WHERE filename = ?', (filename,)).fetchone() \
+            is not None
+
+    def get(self, filename):
+        row = self._connection().execute(
+            'SELECT {} FROM segments WHERE filename = ?'.format(COLUMNS), (filename,),
+        ).fetchone()
+        return _segment(row) if row else None
+
+    def _stream_segments(self, stream, start=None, after=None, descending=False):
+        query = 'SELECT {} FROM segments WHERE stream = ?'.format(COLUMNS)
+        params = [stream]
+        if start is not None:
+            query += ' AND start >= ?'
+            params.append(start)
+        if after is not None:
+            query += ' AND (start > ? OR (start = ? AND filename > ?))'
+            params += [after.start, after.start, after.filename]
+        query += ' ORDER BY start DESC, filename DESC' if descending else ' ORDER BY start, filename'
+        return self._connection().execute(query, params)
+
+    def oldest(self):
+        row = self._connection().execute(
+            'SELECT {} FROM segments ORDER BY start, filename LIMIT 1'.format(COLUMNS),
+        ).fetchone()
+        return _segment(row) if row else None
+
+    def expired(self, cutoff):
+        return [_segment(row) for row in self._connection().execute(
+            'SELECT {} FROM segments WHERE start < ? ORDER BY stream, start, filename'.format(COLUMNS), (cutoff,),
+        )]
+
+    def _stream_iterators(self):
+        return [(name, map(_segment, self._stream_segments(name))) for name in self.get_stream_names()]
+
+    def over_quota(self, quotas):
+        result = []
+        for name, quota in quotas.items():
+            excess = self.get_size(name) - quota
+            if not quota or excess <= 0:
+                continue
+            newest = self.newest(name)
+            for row in self._stream_segments(name):
+                segment = _segment(row)
+                # always keep the newest segment
+                if excess <= 0 or segment.filename == newest.filename:
+                    break
+                result.append(segment)
+                excess -= segment.size
+        return result
+
+    def query(self, stream=None, start=None, end=None, after=None, limit=100):
+        conn = self._connection()
+
+        def with_end(name):
+            lo = start
+            if start is not None:
+                # include the segment that covers the start of the range
+                row = conn.execute(
+                    'SELECT MAX(start) FROM segments WHERE stream = ? AND start <= ?', (name, start),
+                ).fetchone()
+                lo = row[0] if row[0] is not None else start
+            previous = None
+            for row in self._stream_segments(name, lo, after):
+                if previous is not None:
+                    yield previous, recindex.effective_end(previous[1], row[1], previous[4], previous[5])
+                if end is not None and row[1] >= end:
+                    return
+                previous = row
+            if previous is not None:
+                yield previous, recindex.effective_end(previous[1], None, previous[4], previous[5])
+
+        names = [stream] if stream is not None else sorted(self.get_stream_names())
+        items = []
+        has_more = False
+        for row, segment_end in heapq.merge(*[with_end(name) for name in names], key=lambda item: item[0][1]):
+            if start is not None and segment_end is not None and segment_end <= start:
+                continue
+            if len(items) >= limit:
+                has_more = True
+                break
+            closed = bool(row[4])
+            items.append({
+                'stream': row[0],
+                'filename': row[2],
+                'start': int(row[1]),
+                'end': int(segment_end) if segment_end is not None else None,
+                'duration': int(segment_end - row[1]) if segment_end is not None else None,
+                'size': row[3],
+                'closed': closed,
+            })
+        return items, items[-1]['filename'] if has_more else None
+
+    def summary(self):
+        return [
+            {'stream': row[0], 'count': row[1], 'size': row[2], 'first': int(row[3]), 'last': int(row[4])}
+            for row in self._connection().execute(
+                'SELECT stream, count, size, '
+                '(SELECT MIN(start) FROM segments WHERE segments.stream = streams.stream), '
+                '(SELECT MAX(start) FROM segments WHERE segments.stream = streams.stream) '
+                'FROM streams ORDER BY stream'
+            )
+        ]
+
+    def newest(self, stream):
+        row = next(self._stream_segments(stream, descending=True), None)
+        return _segment(row) if row else None
+
+    def get_stream_names(self):
+        return [row[0] for row in self._connection().execute('SELECT stream FROM streams')]
+
+    def get_segments(self, stream):
+        return [_segment(row) for row in self._stream_segments(stream)]
+
+    def get_size(self, stream=None):
+        if stream is not None:
+            row = self._connection().execute('SELECT size FROM streams WHERE stream = ?', (stream,)).fetchone()
+            return row[0] if row else 0
+        return self._connection().execute('SELECT COALESCE(SUM(size), 0) FROM streams').fetchone()[0]
@@ -0,0 +1,239 @@
+import configparser
+import fcntl
+import hashlib
+import json
+import logging
+import math
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import util
+
+FORWARDED_HEADER = 'X-Videoserver-Forwarded'
+
+
+def rendezvous_score(node_id, weight, name):
+    digest = hashlib.sha1('{}/{}'.format(node_id, name).encode('utf-8')).digest()
+    # uniform in (0, 1), the logarithm keeps the share of each node proportional to its weight
+    u = (int.from_bytes(digest[:8], 'big') + 0.5) / 2 ** 64
+    return -weight / math.log(u)
+
+
+def pick_owner(name, nodes):
+    owner = None
+    best = None
+    for node_id, node in nodes.items():
+        if node['weight'] <= 0:
+            continue
+        score = rendezvous_score(node_id, node['weight'], name)
+        if best is None or score > best:
+            owner = node_id
+            best = score
+    return owner
+
+
+class Registry:
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = '{}.lock'.format(path)
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        data.setdefault('nodes', {})
+        data.setdefault('streams', {})
+        return data
+
+    def update(self, callback):
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                data = self.read()
+                result = callback(data)
+                util.write_file_atomic(self.path, json.dumps(data, indent=1, sort_keys=True))
+                return result
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class Cluster:
+    def __init__(self, config):
+        if not config.get_cluster_registry():
+            raise ValueError('Cluster registry not set. Set registry in the cluster config section')
+        self.config = config
+        self.registry = Registry(config.get_cluster_registry())
+        self.node_id = config.get_cluster_node_id()
+        self.url = config.get_cluster_node_url()
+        self.weight = config.get_cluster_weight()
+        self.heartbeat_interval = config.get_cluster_heartbeat_interval()
+        self.node_timeout = config.get_cluster_node_timeout()
+        self.next_heartbeat = time.monotonic()
+        self.nodes = {}
+        self.streams = {}
+        self.applied = {}
+        # the main loop and API requests both apply registry changes
+        self.lock = threading.Lock()
+
+    def _heartbeat(self, data):
+        first_join = self.node_id not in data['nodes']
+        data['nodes'][self.node_id] = {'url': self.url, 'weight': self.weight, 'heartbeat': time.time()}
+        if first_join:
+            # streams this node was configured with by hand become part of the shared registry
+            imported = 0
+            for stream in self.config.get_streams():
+                if stream is not None and stream['name'] not in data['streams']:
+                    data['streams'][stream['name']] = stream
+                    imported += 1
+            logging.info('Joined cluster as %s, imported %d streams', self.node_id, imported)
+        return data
+
+    def _alive_nodes(self, data):
+        now = time.time()
+        return {
+            node_id: node for node_id, node in data['nodes'].items()
+            if node_id == self.node_id or now - node['heartbeat'] < self.node_timeout
+        }
+
+    def _apply(self, data):
+        with self.lock:
+            self._apply_locked(data)
+
+    def _apply_locked(self, data):
+        nodes = self._alive_nodes(data)
+        if set(nodes) != set(self.nodes):
+            logging.info('Cluster nodes: %s', ', '.join(sorted(nodes)))
+        self.nodes = nodes
+        self.streams = data['streams']
+        assigned = {name: stream for name, stream in self.streams.items() if self.owner(name) == self.node_id}
+        with self.config.batch():
+            for stream in self.config.get_streams():
+                if stream is not None and stream['name'] not in assigned:
+                    logging.info('Stream %s is no longer assigned to this node', stream['name'])
+                    self.config.remove_stream(stream['name'])
+                    self.applied.pop(stream['name'], None)
+            for name, stream in assigned.items():
+                if self.applied.get(name) != stream:
+                    if name not in self.applied:
+                        logging.info('Stream %s is assigned to this node', name)
+                    try:
+                        self.config.add_stream(stream)
+                    except ValueError as e:
+                        logging.error('Failed to apply stream from the cluster registry: %s', e)
+                    self.applied[name] = stream
+
+    def owner(self, name):
+        return pick_owner(name, self.nodes)
+
+    def owner_url(self, name):
+        owner = self.owner(name)
+        return self.nodes[owner]['url'] if owner is not None else None
+
+    def start(self):
+        self._apply(self.registry.update(self._heartbeat))
+        self.next_heartbeat = time.monotonic() + self.heartbeat_interval
+
+    def check(self, now):
+        if now < self.next_heartbeat:
+            return
+        try:
+            self._apply(self.registry.update(self._heartbeat))
+        except (OSError, ValueError) as e:
+            logging.error('Failed to update cluster registry: %s', e)
+        self.next_heartbeat = now + self.heartbeat_interval
+
+    def next_deadline(self):
+        return self.next_heartbeat
+
+    def sync(self):
+        self._apply(self.registry.read())
+
+    def put_streams(self, streams):
+        def put(data):
+            for stream in streams:
+                data['streams'][stream['name']] = stream
+        self.registry.update(put)
+        self.sync()
+
+    def _parse(self, stream, parser):
+        try:
+            return self.config.validate_stream(stream, parser)
+        except (KeyError, ValueError):
+            return None
+
+    def apply_streams(self, streams):
+        # compared as parsed, the registry holds both request parameters and streams imported from streams.ini
+        parser = configparser.ConfigParser()
+        desired = {stream['name']: (stream, self._parse(stream, parser)) for stream in streams}
+
+        def apply(data):
+            result = {'added': [], 'changed': [], 'removed': [], 'unchanged': 0}
+            applied = {}
+            for name, (stream, parsed) in desired.items():
+                if name not in data['streams']:
+                    result['added'].append(name)
+                elif self._parse(data['streams'][name], parser) != parsed:
+                    result['changed'].append(name)
+                else:
+                    # the entry stays as it is, its owner does not rewrite or restart the stream
+                    result['unchanged'] += 1
+                    applied[name] = data['streams'][name]
+                    continue
+                applied[name] = stream
+            result['removed'] = [name for name in data['streams'] if name not in desired]
+            data['streams'] = applied
+            return result
+        result = self.registry.update(apply)
+        self.sync()
+        return result
+
+    def remove_stream(self, name):
+        def remove(data):
+            return data['streams'].pop(name, None) is not None
+        found = self.registry.update(remove)
+        self.sync()
+        return found
+
+    def forward(self, name, method, body=None, headers=None):
+        url = self.owner_url(name)
+        if url is None:
+            return None
+        request = urllib.request.Request(
+            '{}/{}'.format(url.rstrip('/'), name), data=body, method=method, headers=dict(headers or {}),
+        )
+        request.add_header(FORWARDED_HEADER, self.node_id)
+        opener = urllib.request.build_opener(util.TolerantHTTPErrorProcessor)
+        try:
+            with opener.open(request, timeout=5) as response:
+                return response.status, response.read()
+        except (urllib.error.URLError, OSError) as e:
+            logging.warning('Failed to forward %s of stream %s to %s: %s', method, name, url, e)
+            return None
+
+    def status(self):
+        return {
+            'node': self.node_id,
+            'nodes': [
+                {
+                    'id': node_id,
+                    'url': node['url'],
+                    'weight': node['weight'],
+                    'streams': sorted(name for name in self.streams if self.owner(name) == node_id),
+                }
+                for node_id, node in sorted(self.nodes.items())
+            ],
+        }
+
+    def stop(self):
+        def leave(data):
+            # keep the entry so a restart does not import streams again, other nodes take over immediately
+            if self.node_id in data['nodes']:
+                data['nodes'][self.node_id]['heartbeat'] = 0
+        try:
+            self.registry.update(leave)
+        except (OSError, ValueError) as e:
+            logging.error('Failed to leave cluster: %s', e)
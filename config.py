@@ -1,8 +1,11 @@
 import configparser
+import contextlib
+import io
 import logging
 import os
 import shutil
 import socket
+import threading
 
 import util
 
@@ -11,15 +14,57 @@ DEFAULTS = {
         'ffmpeg_start_timeout': '20',
         'ffmpeg_stop_timeout': '10',
         'ffmpeg_debug_output': 'false',
+        'ffmpeg_pipeline': 'false',
+        'workers': '0',
+        'ffmpeg_restart_min_delay': '0.5',
+        'ffmpeg_restart_max_delay': '30',
+        'ffmpeg_spawn_rate': '10',
+        'ffmpeg_spawn_burst': '20',
         'stream_down_timeout': '60',
+        'stream_stall_timeout': '60',
         'keep_free_mb': '100',
+        'snapshot_ttl': '2',
+        'snapshot_cache_mb': '16',
+        'notification_window': '2',
+        'notification_queue_size': '1000',
+        'notification_retry_min_delay': '1',
+        'notification_retry_max_delay': '300',
+        'notification_circuit_threshold': '5',
         'date_fmt': '%%Y%%m%%d%%H%%M%%S'
     },
     'recording': {
         'rec_keep_hours': '12',
-        'segment_duration': '3600'
+        'segment_duration': '3600',
+        'segment_offset': 'auto',
+        'rec_format': 'mp4',
+        'index': 'memory',
+        'catalog': ''
+    },
+    'live': {
+        'hls_time': '2',
+        'hls_list_size': '5',
+        'hls_segment_type': 'mpegts',
+        'store': 'disk',
+        'store_mb': '256',
+        'store_segments': '10',
+        'upload_workers': '4'
+    },
+    'api': {
+        'http_workers': '8',
+        'http_keepalive_timeout': '5',
+        'http_transfer_workers': '32',
+        'http_write_timeout': '300',
+        'export_timeout': '30'
+    },
+    'cluster': {
+        'enabled': 'false',
+        'registry': '',
+        'node_id': '',
+        'node_url': '',
+        'weight': '1',
+        'heartbeat_interval': '5',
+        'node_timeout': '15'
     },
-    'api': {},
     'http_get': {
         'enabled': 'false',
         'url': 'http://example.com/notify',
@@ -50,73 +95,167 @@ DEFAULTS = {
 }
 
 
+HLS_SEGMENT_TYPES = ('mpegts', 'fmp4')
+LIVE_STORES = ('disk', 'memory')
+REC_INDEXES = ('memory', 'sqlite')
+REC_FORMATS = ('mp4', 'fmp4', 'cmaf')
+
+
 class FFmpegNotFoundError(Exception):
     def __str__(self):
         return 'FFmpeg binary not found'
 
 
 class Config:
-    def __init__(self):
+    def __init__(self, read_only=False):
+        self.read_only = read_only
         self.stream_prefix = 'stream:'
         self.parser = configparser.ConfigParser()
         self.stream_parser = configparser.ConfigParser()
-        self.config_dir = os.path.join(os.path.dirname(__file__), 'conf')
+        self.config_dir = os.environ.get('VIDEOSERVER_CONFIG_DIR', os.path.join(os.path.dirname(__file__), 'conf'))
         os.makedirs(self.config_dir, exist_ok=True)
         self.config_file = os.path.join(self.config_dir, 'videoserver.ini')
         self.stream_config_file = os.path.join(self.config_dir, 'streams.ini')
+        self.streams_version = 0
+        self.listeners = []
+        self.lock = threading.RLock()
+        # parsed stream table, replaced as a whole on every change so readers need no lock
+        self.streams = ()
+        self.streams_by_name = {}
+        self.batch_depth = 0
+        self.batch_changed = False
         self.parser.read(self.config_file)
         self.stream_parser.read(self.stream_config_file)
-        self._init_config()
+        if self._init_config(self.parser) and not self.read_only:
+            self.save()
+        self._rebuild_streams()
 
-    def _init_config(self):
+    def _init_config(self, parser):
+        # fills in defaults, answers whether anything was added
+        changed = False
         for section, items in DEFAULTS.items():
-            if not self.parser.has_section(section):
-                self.parser.add_section(section)
+            if not parser.has_section(section):
+                parser.add_section(section)
+                changed = True
             for key, value in items.items():
-                if not self.parser.has_option(section, key):
-                    self.parser.set(section, key, value)
+                if not parser.has_option(section, key):
+                    parser.set(section, key, value)
+                    changed = True
 
-        if not self.parser.has_option('general', 'ffmpeg_bin'):
+        if not parser.has_option('general', 'ffmpeg_bin'):
             bin_ = shutil.which('ffmpeg')
             if not bin_:
                 raise FileNotFoundError('FFmpeg binary not found. Set ffmpeg_bin in the general config section')
             logging.warning('ffmpeg_bin not set, guessed: %s', bin_)
-            self.parser.set('general', 'ffmpeg_bin', bin_)
-        if not self.parser.has_option('general', 'live_dir'):
+            parser.set('general', 'ffmpeg_bin', bin_)
+            changed = True
+        if not parser.has_option('general', 'live_dir'):
             dir_ = os.path.join(os.path.dirname(__file__), 'static', 'live')
             logging.warning('live_dir not set, falling back to %s', dir_)
-            self.parser.set('general', 'live_dir', dir_)
-        if not self.parser.has_option('general', 'rec_dir'):
+            parser.set('general', 'live_dir', dir_)
+            changed = True
+        if not parser.has_option('general', 'rec_dir'):
             dir_ = os.path.join(os.path.dirname(__file__), 'static', 'rec')
             logging.warning('rec_dir not set, falling back to %s', dir_)
-            self.parser.set('general', 'rec_dir', dir_)
+            parser.set('general', 'rec_dir', dir_)
+            changed = True
 
-        if not self.parser.has_option('api', 'http_addr'):
+        if not parser.has_option('api', 'http_addr'):
             logging.warning('http_addr not set, falling back to 127.0.0.1')
-            self.parser.set('api', 'http_addr', '127.0.0.1')
-        if not self.parser.has_option('api', 'http_port'):
+            parser.set('api', 'http_addr', '127.0.0.1')
+            changed = True
+        if not parser.has_option('api', 'http_port'):
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.bind(('', 0))
             port_ = s.getsockname()[1]
             s.close()
             logging.warning('http_port not set, picked %s', port_)
-            self.parser.set('api', 'http_port', str(port_))
-
-        self.save()
-
-    def _parse_stream(self, section):
+            parser.set('api', 'http_port', str(port_))
+            changed = True
+        if not parser.has_option('live', 'upload_port'):
+            # saved, worker processes read it to build the upload URL
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.bind(('127.0.0.1', 0))
+            port_ = s.getsockname()[1]
+            s.close()
+            logging.warning('upload_port not set, picked %s', port_)
+            parser.set('live', 'upload_port', str(port_))
+            changed = True
+        return changed
+
+    @staticmethod
+    def _invalid_option(strict, name, option, value, fallback):
+        # values from the API are rejected, hand-edited files fall back to a working value
+        if strict:
+            raise ValueError('invalid {} {!r}'.format(option, value))
+        logging.warning('Stream %s has invalid %s %s, using %s', name, option, value, fallback)
+        return fallback
+
+    def _parse_stream(self, section, parser=None, strict=False):
+        if parser is None:
+            parser = self.stream_parser
         name = section[len(self.stream_prefix):]
-        if self.stream_parser.has_option(section, 'source'):
-            source = self.stream_parser.get(section, 'source')
+        if parser.has_option(section, 'source'):
+            source = parser.get(section, 'source')
         else:
             logging.warning('Stream %s has no source, ignoring', name)
             return None
-        live = self.stream_parser.getboolean(section, 'live')
-        rec = self.stream_parser.getboolean(section, 'rec')
-        snap = self.stream_parser.getboolean(section, 'snap')
+        live = parser.getboolean(section, 'live')
+        rec = parser.getboolean(section, 'rec')
+        # continuous snapshots cost a decoder per stream, posters are captured on demand without them
+        snap = parser.getboolean(section, 'snap', fallback=False)
         segment_duration = self.get_segment_duration()
-        if self.stream_parser.has_option(section, 'segment_duration'):
-            segment_duration = self.stream_parser.getint(section, 'segment_duration')
+        if parser.has_option(section, 'segment_duration'):
+            segment_duration = parser.getint(section, 'segment_duration')
+            if segment_duration <= 0:
+                segment_duration = self._invalid_option(
+                    strict, name, 'segment_duration', segment_duration, self.get_segment_duration(),
+                )
+        segment_offset = self.get_segment_offset()
+        if parser.has_option(section, 'segment_offset'):
+            segment_offset = parser.get(section, 'segment_offset')
+        if segment_offset != 'auto':
+            try:
+                segment_offset = float(segment_offset)
+            except ValueError:
+                segment_offset = self._invalid_option(strict, name, 'segment_offset', segment_offset, 'auto')
+
+        rec_format = self.get_rec_format()
+        if parser.has_option(section, 'rec_format'):
+            rec_format = parser.get(section, 'rec_format')
+        if rec_format not in REC_FORMATS:
+            rec_format = self._invalid_option(strict, name, 'rec_format', rec_format, 'mp4')
+
+        pipeline = self.get_ffmpeg_pipeline()
+        if parser.has_option(section, 'pipeline'):
+            pipeline = parser.getboolean(section, 'pipeline')
+        rec_quota_mb = 0
+        if parser.has_option(section, 'rec_quota_mb'):
+            rec_quota_mb = parser.getint(section, 'rec_quota_mb')
+            if rec_quota_mb < 0:
+                rec_quota_mb = self._invalid_option(strict, name, 'rec_quota_mb', rec_quota_mb, 0)
+        rec_weight = 1.0
+        if parser.has_option(section, 'rec_weight'):
+            rec_weight = parser.getfloat(section, 'rec_weight')
+            if rec_weight <= 0:
+                rec_weight = self._invalid_option(strict, name, 'rec_weight', rec_weight, 1.0)
+        hls_time = self.get_hls_time()
+        if parser.has_option(section, 'hls_time'):
+            hls_time = parser.getfloat(section, 'hls_time')
+            if hls_time <= 0:
+                hls_time = self._invalid_option(strict, name, 'hls_time', hls_time, self.get_hls_time())
+        hls_list_size = self.get_hls_list_size()
+        if parser.has_option(section, 'hls_list_size'):
+            hls_list_size = parser.getint(section, 'hls_list_size')
+            if hls_list_size < 0:
+                hls_list_size = self._invalid_option(
+                    strict, name, 'hls_list_size', hls_list_size, self.get_hls_list_size(),
+                )
+        hls_segment_type = self.get_hls_segment_type()
+        if parser.has_option(section, 'hls_segment_type'):
+            hls_segment_type = parser.get(section, 'hls_segment_type')
+        if hls_segment_type not in HLS_SEGMENT_TYPES:
+            hls_segment_type = self._invalid_option(strict, name, 'hls_segment_type', hls_segment_type, 'mpegts')
 
         return {
             'name': name,
@@ -124,7 +263,15 @@ class Config:
             'live': live,
             'rec': rec,
             'snap': snap,
-            'segment_duration': segment_duration
+            'segment_duration': segment_duration,
+            'segment_offset': segment_offset,
+            'rec_format': rec_format,
+            'pipeline': pipeline,
+            'rec_quota_mb': rec_quota_mb,
+            'rec_weight': rec_weight,
+            'hls_time': hls_time,
+            'hls_list_size': hls_list_size,
+            'hls_segment_type': hls_segment_type
         }
 
     def get_ffmpeg_bin(self):
@@ -139,15 +286,118 @@ class Config:
     def get_ffmpeg_debug_output(self):
         return self.parser.getboolean('general', 'ffmpeg_debug_output')
 
+    def get_workers(self):
+        return self.parser.getint('general', 'workers')
+
+    def get_ffmpeg_pipeline(self):
+        return self.parser.getboolean('general', 'ffmpeg_pipeline')
+
+    def get_ffmpeg_restart_min_delay(self):
+        return self.parser.getfloat('general', 'ffmpeg_restart_min_delay')
+
+    def get_ffmpeg_restart_max_delay(self):
+        return self.parser.getfloat('general', 'ffmpeg_restart_max_delay')
+
+    def get_ffmpeg_spawn_rate(self):
+        rate = self.parser.getfloat('general', 'ffmpeg_spawn_rate')
+        if rate <= 0:
+            fallback = float(DEFAULTS['general']['ffmpeg_spawn_rate'])
+            logging.warning('Invalid ffmpeg_spawn_rate %s, using %s', rate, fallback)
+            return fallback
+        return rate
+
+    def get_ffmpeg_spawn_burst(self):
+        burst = self.parser.getint('general', 'ffmpeg_spawn_burst')
+        if burst < 1:
+            fallback = int(DEFAULTS['general']['ffmpeg_spawn_burst'])
+            logging.warning('Invalid ffmpeg_spawn_burst %s, using %s', burst, fallback)
+            return fallback
+        return burst
+
     def get_stream_down_timeout(self):
         return self.parser.getint('general', 'stream_down_timeout')
 
+    def get_stream_stall_timeout(self):
+        return self.parser.getint('general', 'stream_stall_timeout')
+
     def get_date_fmt(self):
         return self.parser.get('general', 'date_fmt')
 
+    def get_snapshot_ttl(self):
+        return self.parser.getint('general', 'snapshot_ttl')
+
+    def get_snapshot_cache_mb(self):
+        return self.parser.getint('general', 'snapshot_cache_mb')
+
+    def get_notification_window(self):
+        return self.parser.getfloat('general', 'notification_window')
+
+    def get_notification_queue_size(self):
+        return self.parser.getint('general', 'notification_queue_size')
+
+    def get_notification_retry_min_delay(self):
+        return self.parser.getfloat('general', 'notification_retry_min_delay')
+
+    def get_notification_retry_max_delay(self):
+        return self.parser.getfloat('general', 'notification_retry_max_delay')
+
+    def get_notification_circuit_threshold(self):
+        return self.parser.getint('general', 'notification_circuit_threshold')
+
+    def get_notification_outbox(self):
+        return os.path.join(self.config_dir, 'notifications.outbox')
+
     def get_segment_duration(self):
         return self.parser.getint('recording', 'segment_duration')
 
+    def get_segment_offset(self):
+        return self.parser.get('recording', 'segment_offset')
+
+    def get_rec_format(self):
+        return self.parser.get('recording', 'rec_format')
+
+    def get_rec_index(self):
+        index = self.parser.get('recording', 'index')
+        if index not in REC_INDEXES:
+            logging.warning('Unknown recording index %s, using memory', index)
+            return 'memory'
+        return index
+
+    def get_rec_catalog(self):
+        return self.parser.get('recording', 'catalog') or os.path.join(self.config_dir, 'recordings.sqlite')
+
+    def get_hls_time(self):
+        return self.parser.getfloat('live', 'hls_time')
+
+    def get_hls_list_size(self):
+        return self.parser.getint('live', 'hls_list_size')
+
+    def get_hls_segment_type(self):
+        return self.parser.get('live', 'hls_segment_type')
+
+    def get_live_store(self):
+        store = self.parser.get('live', 'store')
+        if store not in LIVE_STORES:
+            logging.warning('Unknown live store %s, using disk', store)
+            return 'disk'
+        return store
+
+    def get_live_store_mb(self):
+        return self.parser.getint('live', 'store_mb')
+
+    def get_live_store_segments(self):
+        return self.parser.getint('live', 'store_segments')
+
+    def get_live_upload_port(self):
+        return self.parser.getint('live', 'upload_port')
+
+    def get_live_upload_workers(self):
+        return self.parser.getint('live', 'upload_workers')
+
+    def get_live_store_url(self):
+        # FFmpeg runs on this host and uploads to a listener of its own on loopback
+        return 'http://127.0.0.1:{:d}/:live'.format(self.get_live_upload_port())
+
     def get_live_dir(self):
         return self.parser.get('general', 'live_dir')
 
@@ -160,12 +410,53 @@ class Config:
     def get_http_port(self):
         return self.parser.getint('api', 'http_port')
 
+    def get_http_workers(self):
+        return self.parser.getint('api', 'http_workers')
+
+    def get_http_keepalive_timeout(self):
+        return self.parser.getint('api', 'http_keepalive_timeout')
+
+    def get_http_transfer_workers(self):
+        return self.parser.getint('api', 'http_transfer_workers')
+
+    def get_http_write_timeout(self):
+        return self.parser.getint('api', 'http_write_timeout')
+
+    def get_export_timeout(self):
+        return self.parser.getint('api', 'export_timeout')
+
     def get_rec_keep_hours(self):
         return self.parser.getint('recording', 'rec_keep_hours')
 
     def get_keep_free_mb(self):
         return self.parser.getint('general', 'keep_free_mb')
 
+    def get_cluster_enabled(self):
+        return self.parser.getboolean('cluster', 'enabled')
+
+    def get_cluster_registry(self):
+        return self.parser.get('cluster', 'registry')
+
+    def get_cluster_node_id(self):
+        return self.parser.get('cluster', 'node_id') or '{}:{:d}'.format(socket.gethostname(), self.get_http_port())
+
+    def get_cluster_node_url(self):
+        if self.parser.get('cluster', 'node_url'):
+            return self.parser.get('cluster', 'node_url')
+        addr = self.get_http_addr()
+        if addr in ('', '0.0.0.0', '::'):
+            addr = socket.gethostname()
+        return 'http://{}:{:d}'.format(addr, self.get_http_port())
+
+    def get_cluster_weight(self):
+        return self.parser.getfloat('cluster', 'weight')
+
+    def get_cluster_heartbeat_interval(self):
+        return self.parser.getfloat('cluster', 'heartbeat_interval')
+
+    def get_cluster_node_timeout(self):
+        return self.parser.getfloat('cluster', 'node_timeout')
+
     def get_http_get_enabled(self):
         return self.parser.getboolean('http_get', 'enabled')
 
@@ -228,21 +519,101 @@ class Config:
         return self.parser.getboolean('telegram', 'convert_chat_id')
 
     def save(self):
-        with open(self.config_file, 'w') as fp:
-            self.parser.write(fp)
+        fp = io.StringIO()
+        self.parser.write(fp)
+        util.write_file_atomic(self.config_file, fp.getvalue())
 
     def reload(self):
-        self.parser.read(self.config_file)
-
-    def get_streams(self):
+        # a fresh parser drops options removed from the file, _init_config() restores their defaults before it
+        # replaces the one readers use
+        parser = configparser.ConfigParser()
+        parser.read(self.config_file)
+        changed = self._init_config(parser)
+        with self.lock:
+            self.parser = parser
+            if changed and not self.read_only:
+                self.save()
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def _rebuild_streams(self):
         streams = []
         for section in self.stream_parser.sections():
             if section[:len(self.stream_prefix)] == self.stream_prefix:
-                streams.append(self._parse_stream(section))
-        return streams
+                try:
+                    streams.append(self._parse_stream(section))
+                except ValueError as e:
+                    logging.error('Stream %s is invalid, ignoring: %s', section[len(self.stream_prefix):], e)
+        self.streams = tuple(streams)
+        self.streams_by_name = {stream['name']: stream for stream in streams if stream is not None}
+
+    def _streams_changed(self, save=True):
+        if self.batch_depth:
+            self.batch_changed = True
+            return
+        if save:
+            self.save_streams()
+        self._rebuild_streams()
+        self.streams_version += 1
+        for callback in self.listeners:
+            callback()
+
+    @contextlib.contextmanager
+    def batch(self):
+        # several stream changes are written and announced once, when the outermost batch ends
+        with self.lock:
+            self.batch_depth += 1
+            try:
+                yield self
+            finally:
+                self.batch_depth -= 1
+                if not self.batch_depth and self.batch_changed:
+                    self.batch_changed = False
+                    self._streams_changed()
+
+    def get_streams(self):
+        return self.streams
 
     def get_stream(self, name):
-        return self._parse_stream('{}{}'.format(self.stream_prefix, util.escape_name(name)))
+        return self.streams_by_name.get(util.escape_name(name))
+
+    def _set_stream(self, parser, section, params):
+        parser.remove_section(section)
+        parser.add_section(section)
+        parser.set(section, 'source', params['source'])
+        parser.set(section, 'live', 'true' if params.get('live', True) else 'false')
+        parser.set(section, 'rec', 'true' if params.get('rec', True) else 'false')
+        parser.set(section, 'snap', 'true' if params.get('snap', False) else 'false')
+        if params.get('segment_duration', None) is not None:
+            parser.set(section, 'segment_duration', str(params['segment_duration']))
+        if params.get('segment_offset', None) is not None:
+            parser.set(section, 'segment_offset', str(params['segment_offset']))
+        if params.get('rec_format', None) is not None:
+            parser.set(section, 'rec_format', str(params['rec_format']))
+        if params.get('pipeline', None) is not None:
+            parser.set(section, 'pipeline', 'true' if params['pipeline'] else 'false')
+        if params.get('rec_quota_mb', None) is not None:
+            parser.set(section, 'rec_quota_mb', str(params['rec_quota_mb']))
+        if params.get('rec_weight', None) is not None:
+            parser.set(section, 'rec_weight', str(params['rec_weight']))
+        for key in ('hls_time', 'hls_list_size', 'hls_segment_type'):
+            if params.get(key, None) is not None:
+                parser.set(section, key, str(params[key]))
+
+    def validate_stream(self, params, parser=None):
+        # parsed from a scratch parser first, a value that does not parse never reaches streams.ini
+        if parser is None:
+            parser = configparser.ConfigParser()
+        name = util.escape_name(params['name'])
+        if not isinstance(params.get('source'), str):
+            raise ValueError('Stream {}: source must be a string'.format(name))
+        section = '{}{}'.format(self.stream_prefix, name)
+        try:
+            self._set_stream(parser, section, params)
+            return self._parse_stream(section, parser, strict=True)
+        except ValueError as e:
+            raise ValueError('Stream {}: {}'.format(name, e)) from None
 
     def add_stream(self, params):
         if 'name' not in params:
@@ -251,31 +622,61 @@ class Config:
         if 'source' not in params:
             logging.error('Stream has no source')
             return
+        self.validate_stream(params)
         name = util.escape_name(params['name'])
         section = '{}{}'.format(self.stream_prefix, util.escape_name(name))
-        self.stream_parser.add_section(section)
-        self.stream_parser.set(section, 'source', params['source'])
-        self.stream_parser.set(section, 'live', 'true' if params.get('live', True) else 'false')
-        self.stream_parser.set(section, 'rec', 'true' if params.get('rec', True) else 'false')
-        self.stream_parser.set(section, 'snap', 'true' if params.get('snap', True) else 'false')
-        if params.get('segment_duration', None) is not None:
-            self.stream_parser.set(section, 'segment_duration', params['segment_duration'])
-        self.save_streams()
+        with self.lock:
+            self._set_stream(self.stream_parser, section, params)
+            self._streams_changed()
+
+    def apply_streams(self, streams):
+        # parse the desired streams the same way as stored ones, so defaults do not count as changes
+        parser = configparser.ConfigParser()
+        desired = {}
+        for params in streams:
+            section = '{}{}'.format(self.stream_prefix, util.escape_name(params['name']))
+            desired[section] = params, self.validate_stream(params, parser)
+        result = {'added': [], 'changed': [], 'removed': [], 'unchanged': 0}
+        with self.batch():
+            current = self.streams_by_name
+            for section, (params, stream) in desired.items():
+                if stream['name'] not in current:
+                    result['added'].append(stream['name'])
+                elif stream != current[stream['name']]:
+                    result['changed'].append(stream['name'])
+                else:
+                    result['unchanged'] += 1
+                    continue
+                self._set_stream(self.stream_parser, section, params)
+                self._streams_changed()
+            for name in current:
+                if '{}{}'.format(self.stream_prefix, name) not in desired:
+                    result['removed'].append(name)
+                    self.remove_stream(name)
+        return result
 
     def remove_stream(self, name):
         name = util.escape_name(name)
         section = '{}{}'.format(self.stream_prefix, name)
         success = True
-        if not self.stream_parser.has_section(section):
-            success = False
-            logging.error('No such stream: %s', name)
-        self.stream_parser.remove_section(section)
-        self.save_streams()
+        with self.lock:
+            if not self.stream_parser.has_section(section):
+                success = False
+                logging.error('No such stream: %s', name)
+            else:
+                self.stream_parser.remove_section(section)
+                self._streams_changed()
         return success
 
     def save_streams(self):
-        with open(self.stream_config_file, 'w') as fp:
-            self.stream_parser.write(fp)
+        fp = io.StringIO()
+        self.stream_parser.write(fp)
+        util.write_file_atomic(self.stream_config_file, fp.getvalue())
 
     def reload_streams(self):
-        self.stream_parser.read(self.stream_config_file)
+        # read into a new parser, otherwise streams removed from the file would be kept
+        stream_parser = configparser.ConfigParser()
+        stream_parser.read(self.stream_config_file)
+        with self.lock:
+            self.stream_parser = stream_parser
+            self._streams_changed(save=False)
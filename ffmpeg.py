@@ -1,22 +1,154 @@
 import os
+import re
+import select
+import socket
 import subprocess
 import signal
 import logging
 import sys
+import time
 
+import progress
 import util
 
+UDP_PORT_RE = re.compile(r'udp://127\.0\.0\.1:\d+')
 
-class FFmpeg:
+
+def live_output_args(name, live, hls_time=2, hls_list_size=5, hls_segment_type='mpegts'):
+    hls_file = os.path.join(live, '{}.m3u8'.format(name))
+    upload = live.startswith('http://')
+    # segments are cut at keyframes only, so the source GOP bounds how short they can get
+    args = [
+        '-an', '-c:v', 'copy', '-f', 'hls', '-hls_time', '{:g}'.format(hls_time),
+        '-hls_list_size', '{:d}'.format(hls_list_size),
+        '-hls_flags', 'independent_segments' if upload else 'delete_segments+independent_segments',
+    ]
+    if hls_segment_type == 'fmp4':
+        args += ['-hls_segment_type', 'fmp4', '-hls_fmp4_init_filename', '{}_init.mp4'.format(name)]
+    if upload:
+        # the in-memory store drops old segments itself, the separator keeps names ending in digits unambiguous
+        args += [
+            '-method', 'PUT', '-hls_segment_filename',
+            os.path.join(live, '{}_%d.{}'.format(name, 'm4s' if hls_segment_type == 'fmp4' else 'ts')),
+        ]
+    return args + [hls_file]
+
+
+# fragmented files need no rewrite when closed and can be played up to the last fragment while recorded
+REC_MOVFLAGS = {
+    'mp4': 'movflags=faststart',
+    'fmp4': 'movflags=frag_keyframe+empty_moov+default_base_moof',
+    'cmaf': 'movflags=cmaf+frag_keyframe+empty_moov+default_base_moof',
+}
+
+
+def rec_output_args(name, rec, segment_duration, date_fmt, segment_offset=0, rec_format='mp4'):
+    rec_file_format = os.path.join(rec, '{}_{}.mp4'.format(name, date_fmt))
+    latest_file = os.path.join(rec, '{}_latest'.format(name))
+    args = [
+        '-an', '-c:v', 'copy', '-f', 'segment', '-segment_format_options', REC_MOVFLAGS[rec_format],
+        '-segment_time', '{:d}'.format(segment_duration), '-segment_atclocktime', '1',
+    ]
+    if segment_offset:
+        # streams rotate at different times of the period, so faststart rewrites do not all hit the disk at once
+        args += ['-segment_clocktime_offset', '{:g}'.format(segment_offset)]
+    return args + [
+        '-segment_list_size', '1', '-segment_list_type', 'flat', '-segment_list', latest_file,
+        '-strftime', '1', '-reset_timestamps', '1', rec_file_format
+    ]
+
+
+def snap_output_args(name, live):
+    snap_file = os.path.join(live, '{}.jpg'.format(name))
+    return [
+        '-an', '-vf', "select='eq(pict_type,PICT_TYPE_I)'", '-vsync', 'vfr', '-q:v', '28', '-update', '1',
+        snap_file
+    ]
+
+
+def pick_udp_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class Process:
+    def __init__(self, name, cmd, stop_timeout=10, debug_output=False, progress_reader=None):
+        self.name = name
+        self.cmd = cmd
+        self.subprocess = None
+        self.stop_timeout = stop_timeout
+        self.debug_output = debug_output
+        self.progress_reader = progress_reader
+        self.progress = progress.Progress() if progress_reader else None
+
+    def start(self):
+        if not self.cmd:
+            return None
+        cmd = self.cmd
+        stdout = sys.stderr if self.debug_output else subprocess.DEVNULL
+        if self.progress_reader:
+            cmd = cmd[:1] + ['-progress', 'pipe:1', '-nostats'] + cmd[1:]
+            stdout = subprocess.PIPE
+        logging.debug('FFmpeg command: %s', subprocess.list2cmdline(cmd))
+        self.subprocess = subprocess.Popen(
+            cmd,
+            stdout=stdout,
+            stderr=sys.stderr if self.debug_output else subprocess.DEVNULL,
+            stdin=subprocess.DEVNULL,
+        )
+        if self.progress_reader:
+            self.progress_reader.register(self.subprocess.stdout, self.progress)
+        self.subprocess.poll()
+
+    def pids(self):
+        if not self.subprocess or self.subprocess.poll() is not None:
+            return []
+        return [self.subprocess.pid]
+
+    def terminate(self):
+        if not self.cmd or not self.subprocess or self.subprocess.poll() is not None:
+            return
+        logging.info('Stopping FFmpeg for %s', self.name)
+        try:
+            self.subprocess.send_signal(signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def wait(self, deadline):
+        if not self.cmd or not self.subprocess:
+            return None
+        try:
+            ret = self.subprocess.wait(max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            logging.warning('Failed to stop FFmpeg for %s, killing', self.name)
+            self.subprocess.kill()
+            ret = self.subprocess.wait()
+        logging.info('Stopped FFmpeg for %s', self.name)
+        return ret
+
+    def stop(self):
+        self.terminate()
+        return self.wait(time.monotonic() + self.stop_timeout)
+
+    def status(self):
+        if not self.cmd or not self.subprocess:
+            return False, None
+        return True, self.subprocess.poll()
+
+
+class FFmpeg(Process):
     def __init__(
             self, name, source, ffmpeg_bin='/usr/bin/ffmpeg',
             live=None, rec=None, snap=True,
-            segment_duration=10, stop_timeout=10,
-            date_fmt='%Y%m%d%H%M%S', debug_output=False,
+            segment_duration=10, segment_offset=0, rec_format='mp4', stop_timeout=10,
+            date_fmt='%Y%m%d%H%M%S', debug_output=False, progress_reader=None,
+            hls_time=2, hls_list_size=5, hls_segment_type='mpegts', live_url=None,
     ):
         self.bin = ffmpeg_bin
 
-        self.name = util.escape_name(name)
         self.source = source
         if live:
             self.live = os.path.realpath(live)
@@ -27,67 +159,249 @@ class FFmpeg:
         else:
             self.rec = None
         self.segment_duration = segment_duration
+        self.segment_offset = segment_offset
+        self.rec_format = rec_format
         self.snap = snap
-        self.stop_timeout = stop_timeout
         self.date_fmt = date_fmt
+        self.hls_time = hls_time
+        self.hls_list_size = hls_list_size
+        self.hls_segment_type = hls_segment_type
+        # HLS is uploaded there instead of written to live_dir, snapshots still go to live_dir
+        self.live_url = live_url if self.live else None
 
+        super().__init__(
+            util.escape_name(name), None,
+            stop_timeout=stop_timeout, debug_output=debug_output, progress_reader=progress_reader,
+        )
         self.cmd = self._construct_cmd()
-        self.subprocess = None
-
-        self.debug_output = debug_output
 
     def _construct_cmd(self):
         self.cmd = [self.bin, '-y', '-timeout', '1000000', '-re', '-rtsp_transport', 'tcp', '-i', self.source]
         if self.live:
-            hls_file = os.path.join(self.live, '{}.m3u8'.format(self.name))
-            self.cmd += ['-an', '-c:v', 'copy', '-hls_flags', 'delete_segments', hls_file]
+            self.cmd += live_output_args(
+                self.name, self.live_url or self.live, self.hls_time, self.hls_list_size, self.hls_segment_type,
+            )
         if self.rec:
-            rec_file_format = os.path.join(self.rec, '{}_{}.mp4'.format(self.name, self.date_fmt))
-            latest_file = os.path.join(self.rec, '{}_latest'.format(self.name))
-            self.cmd += [
-                '-an', '-c:v', 'copy', '-f', 'segment', '-segment_format_options', 'movflags=faststart',
-                '-segment_time', '{:d}'.format(self.segment_duration), '-segment_atclocktime', '1',
-                '-segment_list_size', '1', '-segment_list_type', 'flat', '-segment_list', latest_file,
-                '-strftime', '1', '-reset_timestamps', '1', rec_file_format
-            ]
+            self.cmd += rec_output_args(
+                self.name, self.rec, self.segment_duration, self.date_fmt, self.segment_offset, self.rec_format,
+            )
         if self.snap:
-            snap_file = os.path.join(self.live, '{}.jpg'.format(self.name))
-            self.cmd += [
-                '-an', '-vf', "select='eq(pict_type,PICT_TYPE_I)'", '-vsync', 'vfr', '-q:v', '28', '-update', '1',
-                snap_file
-            ]
+            self.cmd += snap_output_args(self.name, self.live)
         return self.cmd
 
+    def signature(self):
+        return 'ffmpeg', tuple(self.cmd)
+
+
+# one ingest process pulls the source once and fans it out over loopback UDP to independent consumers
+class Pipeline:
+    def __init__(
+            self, name, source, ffmpeg_bin='/usr/bin/ffmpeg',
+            live=None, rec=None, snap=True,
+            segment_duration=10, segment_offset=0, rec_format='mp4', stop_timeout=10,
+            date_fmt='%Y%m%d%H%M%S', debug_output=False, progress_reader=None,
+            hls_time=2, hls_list_size=5, hls_segment_type='mpegts', live_url=None,
+    ):
+        self.bin = ffmpeg_bin
+        self.name = util.escape_name(name)
+        self.source = source
+        self.live = os.path.realpath(live) if live else None
+        self.rec = os.path.realpath(rec) if rec else None
+        self.segment_duration = segment_duration
+        self.segment_offset = segment_offset
+        self.rec_format = rec_format
+        self.date_fmt = date_fmt
+        self.hls_time = hls_time
+        self.hls_list_size = hls_list_size
+        self.hls_segment_type = hls_segment_type
+        self.live_url = live_url if self.live else None
+        self.stop_timeout = stop_timeout
+        self.debug_output = debug_output
+        self.progress_reader = progress_reader
+        self.ports = {}
+        self.consumers = {}
+        self.ingest = None
+
+        if self.live:
+            self._add_consumer('live', live_output_args(
+                self.name, self.live_url or self.live, self.hls_time, self.hls_list_size, self.hls_segment_type,
+            ))
+        if self.rec:
+            self._add_consumer('rec', rec_output_args(
+                self.name, self.rec, self.segment_duration, self.date_fmt, self.segment_offset, self.rec_format,
+            ))
+        if self.live:
+            # reserved even when disabled so that snapshots can be toggled without restarting the ingest
+            self.ports['snap'] = pick_udp_port()
+            if snap:
+                self._add_consumer('snap', snap_output_args(self.name, self.live), keyframes_only=True)
+        self._construct_ingest()
+
+    @property
+    def cmd(self):
+        return self.ingest.cmd + [arg for role in sorted(self.consumers) for arg in self.consumers[role].cmd]
+
+    def signature(self):
+        # loopback ports are picked anew for every instance and the snapshot consumer can be toggled on the fly
+        cmd = self.ingest.cmd + [
+            arg for role in sorted(self.consumers) if role != 'snap' for arg in self.consumers[role].cmd
+        ]
+        return 'pipeline', tuple(UDP_PORT_RE.sub('udp://127.0.0.1:', arg) for arg in cmd)
+
+    def _consumer_input_args(self, role):
+        return [
+            '-f', 'mpegts',
+            '-i', 'udp://127.0.0.1:{:d}?fifo_size=1000000&overrun_nonfatal=1&timeout=5000000'.format(self.ports[role]),
+        ]
+
+    def _add_consumer(self, role, output_args, keyframes_only=False):
+        if role not in self.ports:
+            self.ports[role] = pick_udp_port()
+        cmd = [self.bin, '-y']
+        if keyframes_only:
+            # only keyframes reach the decoder, the rest is dropped before decoding
+            cmd += ['-skip_frame', 'nokey']
+        cmd += self._consumer_input_args(role) + output_args
+        self.consumers[role] = Process(
+            '{} ({})'.format(self.name, role), cmd,
+            stop_timeout=self.stop_timeout, debug_output=self.debug_output,
+        )
+
+    def _construct_ingest(self):
+        outputs = '|'.join(
+            '[f=mpegts:onfail=ignore]udp://127.0.0.1:{:d}?pkt_size=1316'.format(self.ports[role])
+            for role in sorted(self.ports)
+        )
+        cmd = [
+            self.bin, '-y', '-timeout', '1000000', '-re', '-rtsp_transport', 'tcp', '-i', self.source,
+            '-map', '0:v', '-c', 'copy', '-f', 'tee', outputs,
+        ]
+        self.ingest = Process(
+            '{} (ingest)'.format(self.name), cmd,
+            stop_timeout=self.stop_timeout, debug_output=self.debug_output, progress_reader=self.progress_reader,
+        )
+
+    def _processes(self):
+        return [self.ingest] + [self.consumers[role] for role in sorted(self.consumers)]
+
+    @property
+    def progress(self):
+        return self.ingest.progress
+
+    def pids(self):
+        return [pid for process in self._processes() for pid in process.pids()]
+
+    def detach_live(self):
+        # returns the live consumer for the caller to stop, the ingest and the other consumers keep running
+        return self.consumers.pop('live', None)
+
+    def set_snap(self, enabled):
+        # returns a removed snapshot consumer, the caller stops it without waiting for it to exit
+        if enabled and 'snap' not in self.consumers and self.live:
+            self._add_consumer('snap', snap_output_args(self.name, self.live), keyframes_only=True)
+            if self.ingest.status()[0]:
+                self.consumers['snap'].start()
+        elif not enabled and 'snap' in self.consumers:
+            return self.consumers.pop('snap')
+        return None
+
+    def start(self):
+        for process in self._processes():
+            started, status = process.status()
+            if not started or status is not None:
+                process.start()
+
+    def terminate(self):
+        for process in self._processes():
+            process.terminate()
+
+    def wait(self, deadline):
+        ret = self.ingest.wait(deadline)
+        for role in sorted(self.consumers):
+            self.consumers[role].wait(deadline)
+        return ret
+
+    def stop(self):
+        self.terminate()
+        return self.wait(time.monotonic() + self.stop_timeout)
+
+    def status(self):
+        started, status = self.ingest.status()
+        if not started:
+            return False, None
+        for process in self._processes():
+            _, process_status = process.status()
+            if process_status is not None:
+                return True, process_status
+        return True, None
+
+
+def stop_all(threads, timeout):
+    # every process gets the signal first, so the timeout is shared instead of adding up
+    for thread in threads:
+        thread.terminate()
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.wait(deadline)
+
+
+class ClipExport:
+    def __init__(self, segments, start, end, ffmpeg_bin='/usr/bin/ffmpeg'):
+        self.bin = ffmpeg_bin
+        # (path, segment start, segment end) tuples covering [start, end), timestamps in seconds
+        self.segments = segments
+        self.start_time = start
+        self.end_time = end
+        self.cmd = self._construct_cmd()
+        self.subprocess = None
+
+    def read(self, timeout, size=65536):
+        # answers b'' at the end of the clip; read from the pipe itself, buffered data would be invisible to select
+        fd = self.subprocess.stdout.fileno()
+        if not select.select([fd], [], [], timeout)[0]:
+            raise TimeoutError('no output from FFmpeg for {:d} seconds'.format(timeout))
+        return os.read(fd, size)
+
+    def _construct_script(self):
+        lines = ['ffconcat version 1.0']
+        for path, segment_start, segment_end in self.segments:
+            lines.append("file '{}'".format(path.replace("'", "'\\''")))
+            if self.start_time > segment_start:
+                lines.append('inpoint {:.3f}'.format(self.start_time - segment_start))
+            if segment_end is None or self.end_time < segment_end:
+                lines.append('outpoint {:.3f}'.format(self.end_time - segment_start))
+        return '\n'.join(lines) + '\n'
+
+    def _construct_cmd(self):
+        return [
+            self.bin, '-hide_banner', '-loglevel', 'error',
+            '-f', 'concat', '-safe', '0', '-protocol_whitelist', 'file,pipe', '-i', 'pipe:0',
+            '-map', '0:v', '-c', 'copy',
+            '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4', 'pipe:1',
+        ]
+
     def start(self):
-        if not self.cmd:
-            return None
         logging.debug('FFmpeg command: %s', subprocess.list2cmdline(self.cmd))
         self.subprocess = subprocess.Popen(
             self.cmd,
-            stdout=sys.stderr if self.debug_output else subprocess.DEVNULL,
-            stderr=sys.stderr if self.debug_output else subprocess.DEVNULL,
-            stdin=subprocess.DEVNULL,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
         )
-        self.subprocess.poll()
+        self.subprocess.stdin.write(self._construct_script().encode('utf-8'))
+        self.subprocess.stdin.close()
 
     def stop(self):
-        if not self.cmd or not self.subprocess:
+        if not self.subprocess:
             return None
-        logging.info('Stopping FFmpeg for %s', self.name)
-        try:
-            self.subprocess.send_signal(signal.SIGTERM)
-            try:
-                ret = self.subprocess.wait(self.stop_timeout)
-            except subprocess.TimeoutExpired:
-                logging.warning('Failed to stop FFmpeg for %s, killing', self.name)
-                self.subprocess.kill()
-                ret = -9
-        except ProcessLookupError:
-            ret = self.subprocess.poll()
-        logging.info('Stopped FFmpeg for %s', self.name)
-        return ret
+        if self.subprocess.poll() is None:
+            self.subprocess.kill()
+        self.subprocess.stdout.close()
+        return self.subprocess.wait()
 
-    def status(self):
-        if not self.cmd or not self.subprocess:
-            return False, None
-        return True, self.subprocess.poll()
+
+def snapshot_cmd(ffmpeg_bin, path, from_end=None):
+    cmd = [ffmpeg_bin, '-hide_banner', '-loglevel', 'error', '-skip_frame', 'nokey']
+    if from_end:
+        cmd += ['-sseof', '-{:d}'.format(from_end)]
+    return cmd + ['-i', path, '-an', '-frames:v', '1', '-q:v', '28', '-f', 'image2pipe', '-c:v', 'mjpeg', 'pipe:1']
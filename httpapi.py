@@ -1,105 +1,711 @@
+import concurrent.futures
+import datetime
+import email.utils
 import http.server
 import json
 import logging
 import os
 import re
+import selectors
 import shutil
-import socketserver
+import socket
 import threading
+import time
+import urllib.parse
 
+import cluster as cluster_
+import ffmpeg
+import metrics
+import mp4
+import recindex
 import util
 
+STATIC_TYPES = {
+    '.mp4': 'video/mp4',
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t',
+    '.m4s': 'video/iso.segment',
+    '.jpg': 'image/jpeg',
+    '.html': 'text/html; charset=utf-8',
+}
+# the player pages, served so that they work without NGINX
+PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+# files that are rewritten in place and must be revalidated on every request
+STATIC_NO_CACHE = ('.m3u8', '.jpg')
+# larger bodies are handed to the transfer threads, smaller ones normally fit into the socket buffer
+INLINE_BODY_SIZE = 65536
+
+
+def parse_range(header, size):
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, _, end = header[len('bytes='):].strip().partition('-')
+    try:
+        if not start:
+            length = int(end)
+            if length <= 0:
+                return False
+            return max(size - length, 0), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+def is_not_modified(headers, etag, mtime):
+    if headers['If-None-Match']:
+        return etag in [tag.strip() for tag in headers['If-None-Match'].split(',')] \
+            or headers['If-None-Match'].strip() == '*'
+    if headers['If-Modified-Since']:
+        try:
+            since = email.utils.parsedate_to_datetime(headers['If-Modified-Since']).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+    return False
+
+
+def parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def stream_params(name, request):
+    if not name or 'source' not in request:
+        return None
+    return {
+        'name': name,
+        'source': request['source'],
+        'live': request.get('live', True),
+        'rec': request.get('rec', True),
+        'snap': request.get('snap', False),
+        'segment_duration': request.get('segment_duration'),
+        'segment_offset': request.get('segment_offset'),
+        'rec_format': request.get('rec_format'),
+        'pipeline': request.get('pipeline'),
+        'rec_quota_mb': request.get('rec_quota_mb'),
+        'rec_weight': request.get('rec_weight'),
+        'hls_time': request.get('hls_time'),
+        'hls_list_size': request.get('hls_list_size'),
+        'hls_segment_type': request.get('hls_segment_type')
+    }
+
+
+def remove_stream_files(config, recordings, name, job, live_store=None, wait_stopped=None):
+    # FFmpeg rewrites the playlist, the segment list and the last segment when it exits
+    if wait_stopped and not wait_stopped():
+        logging.warning('FFmpeg of stream %s did not stop in time, removing its files anyway', name)
+    segments = recordings.get_segments(name)
+    latest_file = os.path.join(config.get_rec_dir(), '{}{}'.format(name, recindex.LATEST_SUFFIX))
+    try:
+        with open(latest_file) as f:
+            last_filename = f.readline().strip()
+    except FileNotFoundError:
+        last_filename = None
+    # the segment written last may not have been indexed yet
+    if (
+            last_filename and os.path.basename(last_filename) == last_filename
+            and last_filename.startswith('{}_'.format(name))
+            and last_filename not in [segment.filename for segment in segments]
+    ):
+        segments.append(recindex.Segment(name, 0, last_filename))
+    live_dir = config.get_live_dir()
+    live_files = [
+        filename for filename in os.listdir(live_dir)
+        if re.match(r'^{}\d+\.(ts|m4s)$'.format(name), filename)
+        or filename in ('{}.jpg'.format(name), '{}.m3u8'.format(name), '{}_init.mp4'.format(name))
+    ]
+    job.progress(0, len(segments) + len(live_files) + 1)
+    for i, segment in enumerate(segments, 1):
+        logging.debug('Removing record "%s" due to stream removal', segment.filename)
+        recordings.delete(segment)
+        job.progress(i)
+    try:
+        os.remove(latest_file)
+    except FileNotFoundError:
+        pass
+    job.progress(len(segments) + 1)
+    for i, filename in enumerate(live_files, len(segments) + 2):
+        try:
+            os.remove(os.path.join(live_dir, filename))
+        except FileNotFoundError:
+            pass
+        job.progress(i)
+    live_count = len(live_files) + (live_store.remove_stream(name) if live_store else 0)
+    logging.info('Removed %d records and %d live files of stream %s', len(segments), live_count, name)
+
+
+class PooledRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    idle = False
+    body_pending = False
+    transfer = None
+
+    def handle(self):
+        # serves the requests that have arrived, an idle keep-alive connection goes back to the server, which
+        # waits for its next request without holding a worker
+        self.idle = False
+        while True:
+            self.close_connection = True
+            self.handle_one_request()
+            if self.transfer or self.close_connection:
+                return
+            if not self.input_pending():
+                self.idle = True
+                return
+
+    def input_pending(self):
+        # pipelined requests may already be buffered, the server's selector would not see them
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return True
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def resume(self):
+        try:
+            self.handle()
+        finally:
+            self.finish()
+
+    def finish(self):
+        if not self.idle and not self.transfer:
+            super().finish()
+
+    def close(self):
+        self.idle = False
+        self.finish()
+
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        self.body_pending = bool(
+            self.headers['Transfer-Encoding'] or self.headers['Content-Length'] not in (None, '0')
+        )
+        return True
+
+    def end_headers(self):
+        # a body the handler did not read would be parsed as the next request on this connection
+        if self.body_pending:
+            self.send_header('Connection', 'close')
+        super().end_headers()
+
+    def _send_empty(self, code):
+        self.send_response(code)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Content-Length', 0)
+        self.end_headers()
+
+    def _send_body(self, size, write, close=None):
+        # bodies that may not fit into the socket buffer are written by the server's transfer threads, so a
+        # slow client holds no worker; close is called once the body is written or failed
+        if self.server.transfers and (size is None or size > INLINE_BODY_SIZE):
+            self.transfer = (write, close)
+            return
+        try:
+            write()
+        finally:
+            if close:
+                close()
+
+    def _read_body(self, limit):
+        if (self.headers['Transfer-Encoding'] or '').lower() != 'chunked':
+            length = int(self.headers['Content-Length'] or 0)
+            if length > limit:
+                return None
+            self.body_pending = False
+            return self.rfile.read(length)
+        # FFmpeg uploads with chunked transfer encoding
+        body = bytearray()
+        while True:
+            size = int(self.rfile.readline(1024).split(b';', 1)[0], 16)
+            if not size:
+                break
+            if len(body) + size > limit:
+                return None
+            body += self.rfile.read(size)
+            self.rfile.readline(1024)
+        while self.rfile.readline(1024).strip():
+            pass
+        self.body_pending = False
+        return bytes(body)
+
+    def version_string(self):
+        return 'videoserver'
+
+    def log_message(self, fmt, *args):
+        logging.debug('HTTPServer: %s', (fmt % args))
+
+
+# FFmpeg uploads of the in-memory live store have a listener and workers of their own on loopback, so
+# viewers and pollers of the API cannot hold them up
+def create_upload_handler(config, live_store):
+    class LiveUploadHandler(PooledRequestHandler):
+        timeout = config.get_http_keepalive_timeout()
+
+        def do_PUT(self):
+            if not self.path.startswith('/:live/') or config.get_live_store() != 'memory':
+                self._send_empty(404)
+                return
+            try:
+                body = self._read_body(live_store.max_size())
+            except ValueError:
+                self.close_connection = True
+                self._send_empty(400)
+                return
+            if body is None:
+                self.close_connection = True
+                self._send_empty(413)
+                return
+            self._send_empty(204 if live_store.put(self.path[len('/:live/'):], body) else 404)
+
+    return LiveUploadHandler
+
+
+def create_handler(
+        config, threads, recordings, snapshots, cluster=None, jobs=None, live_store=None, notifications=None,
+        wait_stopped=None,
+):
+    fragments = mp4.FragmentScanner()
+
+    class VideoServerRequestHandler(PooledRequestHandler):
+        timeout = config.get_http_keepalive_timeout()
 
-def create_handler(config, threads):
-    class VideoServerRequestHandler(http.server.BaseHTTPRequestHandler):
         def __init__(self, *args, **kwargs):
             self.config = config
             self.threads = threads
+            self.recordings = recordings
+            self.snapshots = snapshots
+            self.cluster = cluster
+            self.jobs = jobs
+            self.live_store = live_store
+            self.notifications = notifications
             super().__init__(*args, **kwargs)
 
+        def _send_json(self, code, result):
+            response = bytes(json.JSONEncoder().encode(result), 'utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', len(response))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def _forward(self, name, method, body=None):
+            # requests for streams owned by another node are relayed to it once
+            if not self.cluster or self.headers[cluster_.FORWARDED_HEADER]:
+                return False
+            owner = self.cluster.owner(name)
+            if owner == self.cluster.node_id:
+                return False
+            if owner is None:
+                # every live node has weight 0
+                self._send_json(503, {'success': False, 'error': 'No cluster node can take stream {}'.format(name)})
+                return True
+            headers = {'Content-Type': 'application/json'} if body is not None else None
+            response = self.cluster.forward(name, method, body, headers)
+            if response is None:
+                return False
+            code, body = response
+            self.cluster.sync()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', len(body))
+            self.end_headers()
+            self.wfile.write(body)
+            return True
+
         def do_OPTIONS(self):
             self.send_response(200)
-            self.send_header('Access-Control-Allow-Methods', 'GET,PUT,DELETE')
+            self.send_header('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE')
             self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-            self.send_header('Allow', 'GET,PUT,DELETE')
+            self.send_header('Allow', 'GET,PUT,POST,DELETE')
+            self.send_header('Content-Length', 0)
             self.end_headers()
 
-        def do_PUT(self):
-            name = util.escape_name(self.path[1:])
+        def _read_json(self):
             if (
                     not self.headers['Content-Length']
                     or not self.headers['Content-Type']
                     or not self.headers['Content-Type'].split(';')[0] == 'application/json'
-                    or not len(name)
             ):
-                self.send_response(400)
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
+                return None, None
+            try:
+                body = self.rfile.read(int(self.headers['Content-Length']))
+            except ValueError:
+                return None, None
+            self.body_pending = False
+            try:
+                return body, json.JSONDecoder().decode(body.decode("utf-8"))
+            except ValueError:
+                return body, None
+
+        def _read_stream_list(self):
+            _, request = self._read_json()
+            if not isinstance(request, list):
+                return None
+            streams = [
+                stream_params(util.escape_name(item.get('name', '')), item) if isinstance(item, dict) else None
+                for item in request
+            ]
+            return streams if None not in streams else None
+
+        def _reject_invalid(self, streams):
+            try:
+                for stream in streams:
+                    config.validate_stream(stream)
+            except ValueError as e:
+                self._send_json(400, {'success': False, 'error': str(e)})
+                return True
+            return False
+
+        def do_POST(self):
+            # the posted list becomes the complete stream table, untouched streams keep running
+            if self.path != '/:apply':
+                self._send_empty(404)
+                return
+            streams = self._read_stream_list()
+            if streams is None:
+                self._send_empty(400)
+                return
+            if self._reject_invalid(streams):
+                return
+            if self.cluster:
+                result = self.cluster.apply_streams(streams)
+            else:
+                result = config.apply_streams(streams)
+            logging.info(
+                'Applied stream table: %d added, %d changed, %d removed, %d unchanged',
+                len(result['added']), len(result['changed']), len(result['removed']), result['unchanged'],
+            )
+            result['success'] = True
+            self._send_json(200, result)
+
+        def do_PUT(self):
+            name = util.escape_name(self.path[1:])
+            if not len(name) and self.path != '/':
+                self._send_empty(400)
                 return
-            length = self.headers['Content-Length']
-            request = json.JSONDecoder().decode(self.rfile.read(int(length)).decode("utf-8"))
+            # PUT / with a list of streams adds or replaces all of them with a single write
+            if not len(name):
+                streams = self._read_stream_list()
+                if streams is None:
+                    self._send_empty(400)
+                    return
+                if self._reject_invalid(streams):
+                    return
+                self._put_streams(streams)
+                self._send_json(200, {'success': True, 'count': len(streams)})
+                return
+            body, request = self._read_json()
             logging.debug('HTTP API PUT: {}'.format(request))
-            if 'source' not in request:
-                self.send_response(400)
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
+            stream = stream_params(name, request) if isinstance(request, dict) else None
+            if stream is None:
+                self._send_empty(400)
                 return
-            if 'live' not in request:
-                request['live'] = True
-            if 'rec' not in request:
-                request['rec'] = True
-            if 'snap' not in request:
-                request['snap'] = True
-            if 'segment_duration' not in request:
-                request['segment_duration'] = None
-            config.add_stream({
-                'name': name,
-                'source': request['source'],
-                'live': request['live'],
-                'rec': request['rec'],
-                'snap': request['snap'],
-                'segment_duration': request['segment_duration']
-            })
-            response = json.JSONEncoder().encode({'success': True})
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Content-Length', len(response))
-            self.end_headers()
-            self.wfile.write(bytes(response, 'utf-8'))
+            if self._reject_invalid([stream]):
+                return
+            if self._forward(name, 'PUT', body):
+                return
+            self._put_streams([stream])
+            self._send_json(200, {'success': True})
+
+        def _put_streams(self, streams):
+            if self.cluster:
+                self.cluster.put_streams(streams)
+                return
+            with config.batch():
+                for stream in streams:
+                    config.add_stream(stream)
 
         def do_DELETE(self):
             name = util.escape_name(self.path[1:])
-            success = self.config.remove_stream(name)
-
-            if name in self.threads:
-                self.threads[name].stop()
-            files_to_delete = []
-            for filename in os.listdir(self.config.get_rec_dir()):
-                if re.match(r'^{}_\d+\.mp4$'.format(name), filename) or filename == '{}_latest'.format(name):
-                    files_to_delete.append(os.path.join(self.config.get_rec_dir(), filename))
-            for filename in os.listdir(self.config.get_live_dir()):
-                if (
-                        re.match(r'^{}\d+\.ts$'.format(name), filename)
-                        or filename == '{}.jpg'.format(name)
-                        or filename == '{}.m3u8'.format(name)
-                ):
-                    files_to_delete.append(os.path.join(self.config.get_live_dir(), filename))
-            for filename in files_to_delete:
-                logging.info('Removing file "{}" due to stream removal'.format(filename))
+            if self._forward(name, 'DELETE'):
+                return
+            if self.cluster:
+                success = self.cluster.remove_stream(name)
+            else:
+                success = self.config.remove_stream(name)
+
+            # the supervisor stops the process once it sees the change, its files are removed once it has exited
+            version = self.config.streams_version
+            timeout = self.config.get_ffmpeg_stop_timeout() + 5
+            job = self.jobs.submit(
+                'remove files of stream {}'.format(name),
+                lambda job_: remove_stream_files(
+                    self.config, self.recordings, name, job_, self.live_store,
+                    (lambda: wait_stopped(name, version, timeout)) if wait_stopped else None,
+                ),
+            )
+            self._send_json(200 if success else 404, {'success': success, 'job': job.id})
+
+        def _static_ext(self, filename):
+            ext = os.path.splitext(filename)[1]
+            if ext not in STATIC_TYPES or util.escape_name(filename[:-len(ext)]) != filename[:-len(ext)]:
+                return None
+            return ext
+
+        def _send_content(self, ext, size, mtime_ns, head, no_cache=False):
+            # sends the headers, returns the offset and length of the body to send, if any
+            mtime = mtime_ns / 1e9
+            etag = '"{:x}-{:x}"'.format(mtime_ns, size)
+            if is_not_modified(self.headers, etag, mtime):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            byte_range = None
+            if not self.headers['If-Range'] or self.headers['If-Range'].strip() == etag:
+                byte_range = parse_range(self.headers['Range'], size)
+            if byte_range is False:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{:d}'.format(size))
+                self.send_header('Content-Length', 0)
+                self.end_headers()
+                return
+            if byte_range:
+                offset, count = byte_range[0], byte_range[1] - byte_range[0] + 1
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {:d}-{:d}/{:d}'.format(*byte_range, size))
+            else:
+                offset, count = 0, size
+                self.send_response(200)
+            self.send_header('Content-Type', STATIC_TYPES[ext])
+            self.send_header('Content-Length', count)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', email.utils.formatdate(mtime, usegmt=True))
+            self.send_header('Access-Control-Allow-Origin', '*')
+            if no_cache or ext in STATIC_NO_CACHE:
+                self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            if not head and count:
+                return offset, count
+            return None
+
+        def _send_file(self, directory, filename, head=False, size_limit=None):
+            ext = self._static_ext(filename)
+            if not ext:
+                self._send_empty(404)
+                return
+            try:
+                f = open(os.path.join(directory, filename), 'rb')
+            except (FileNotFoundError, IsADirectoryError):
+                self._send_empty(404)
+                return
+            try:
+                stat = os.fstat(f.fileno())
+                size = min(stat.st_size, size_limit) if size_limit is not None else stat.st_size
+                body = self._send_content(ext, size, stat.st_mtime_ns, head, no_cache=size_limit is not None)
+            except BaseException:
+                f.close()
+                raise
+            if not body:
+                f.close()
+                return
+            # zero-copy transfer from the page cache to the socket
+            self._send_body(body[1], lambda: self.connection.sendfile(f, *body), f.close)
+
+        def _playable_size(self, filename):
+            return fragments.playable_size(os.path.join(self.recordings.rec_dir, filename))
+
+        def _send_recording(self, filename, head=False):
+            segment = self.recordings.get(filename)
+            playable = None
+            if segment and not segment.closed:
+                # a fragmented recording in progress is served up to its last complete fragment
+                playable = self._playable_size(filename)
+            self._send_file(self.config.get_rec_dir(), filename, head, playable)
+
+        def _send_live(self, filename, head=False):
+            live_file = self.live_store.get(filename) if self.live_store else None
+            if live_file is None:
+                # snapshots of the snap option are still written to live_dir, the posters of the other streams
+                # are captured on demand
+                name, ext = os.path.splitext(filename)
+                if ext == '.jpg' and not os.path.isfile(os.path.join(self.config.get_live_dir(), filename)):
+                    self._send_snapshot(util.escape_name(name), head)
+                else:
+                    self._send_file(self.config.get_live_dir(), filename, head)
+                return
+            data = memoryview(live_file.data)
+            body = self._send_content(os.path.splitext(filename)[1], len(data), live_file.mtime_ns, head)
+            if body:
+                offset, count = body
+                self._send_body(count, lambda: self.wfile.write(data[offset:offset + count]))
+
+        def _route_static(self, head=False):
+            path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+            directory, separator, filename = path[1:].partition('/')
+            if directory == 'live':
+                self._send_live(filename, head)
+            elif directory == 'rec':
+                self._send_recording(filename, head)
+            elif not separator and directory.endswith('.html'):
+                self._send_file(PAGES_DIR, directory, head)
+            else:
+                return False
+            return True
+
+        def do_HEAD(self):
+            if not self._route_static(head=True):
+                self._send_empty(404)
+
+        def _get_recordings(self, query):
+            try:
+                start = parse_time(query['from'][0]) if 'from' in query else None
+                end = parse_time(query['to'][0]) if 'to' in query else None
+                limit = min(int(query.get('limit', ['100'])[0]), 1000)
+            except ValueError:
+                return None
+            after = None
+            if 'cursor' in query:
+                after = self.recordings.parse_cursor(query['cursor'][0])
+                if not after:
+                    return None
+            stream = util.escape_name(query['stream'][0]) if 'stream' in query else None
+            items, cursor = self.recordings.query(stream, start, end, after, max(limit, 1))
+            for item in items:
+                item['playable'] = item['closed'] or self._playable_size(item['filename']) is not None
+            return {'recordings': items, 'next': cursor}
+
+        def _send_chunk(self, data):
+            self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+
+        def _export(self, query):
+            try:
+                stream = util.escape_name(query['stream'][0])
+                start = parse_time(query['from'][0])
+                end = parse_time(query['to'][0])
+            except (KeyError, ValueError):
+                self._send_empty(400)
+                return
+            if end <= start:
+                self._send_empty(400)
+                return
+            items, _ = self.recordings.query(stream, start, end, limit=10000)
+            # segments that are still being written have no index yet, unless they are fragmented
+            segments = [
+                (os.path.join(self.recordings.rec_dir, item['filename']), item['start'], item['end'])
+                for item in items if item['closed'] or self._playable_size(item['filename']) is not None
+            ]
+            if not segments:
+                self._send_empty(404)
+                return
+            export = ffmpeg.ClipExport(segments, start, end, ffmpeg_bin=self.config.get_ffmpeg_bin())
+            export.start()
+            timeout = self.config.get_export_timeout()
+            handed_off = False
+            try:
                 try:
-                    os.remove(os.path.join(self.config.get_rec_dir(), filename))
-                except FileNotFoundError:
-                    pass
+                    data = export.read(timeout)
+                except TimeoutError as e:
+                    logging.error('Failed to export %s from %s to %s: %s', stream, start, end, e)
+                    self._send_empty(504)
+                    return
+                if not data:
+                    logging.error('Failed to export %s from %s to %s', stream, start, end)
+                    self._send_empty(500)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'video/mp4')
+                self.send_header('Content-Disposition', 'attachment; filename="{}_{:d}-{:d}.mp4"'.format(
+                    stream, int(start), int(end),
+                ))
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                handed_off = True
+                self._send_body(None, lambda: self._stream_export(stream, export, timeout, data), export.stop)
+            except (BrokenPipeError, ConnectionResetError):
+                logging.info('Client aborted export of %s', stream)
+                self.close_connection = True
+            finally:
+                if not handed_off:
+                    export.stop()
 
-            response = json.JSONEncoder().encode({'success': success})
+        def _stream_export(self, stream, export, timeout, data):
+            try:
+                while data:
+                    self._send_chunk(data)
+                    try:
+                        data = export.read(timeout)
+                    except TimeoutError as e:
+                        # the status is already sent, the missing last chunk tells the client the file is incomplete
+                        logging.error('Export of %s aborted: %s', stream, e)
+                        self.close_connection = True
+                        return
+                self._send_chunk(b'')
+            except OSError:
+                logging.info('Client aborted export of %s', stream)
+                raise
 
-            self.send_response(200 if success else 404)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Content-Length', len(response))
+        def _send_snapshot(self, name, head=False):
+            if not len(name) or self.config.get_stream(name) is None:
+                self._send_empty(404)
+                return
+            snapshot = self.snapshots.get(name)
+            if not snapshot:
+                self._send_empty(404)
+                return
+            created, data = snapshot
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', len(data))
+            self.send_header('Cache-Control', 'max-age={:d}'.format(
+                max(round(self.config.get_snapshot_ttl() - (time.monotonic() - created)), 0),
+            ))
+            self.send_header('Access-Control-Allow-Origin', '*')
             self.end_headers()
-            self.wfile.write(bytes(response, 'utf-8'))
+            if not head:
+                self.wfile.write(data)
 
         def do_GET(self):
+            if self.path.startswith('/api/'):
+                # the pages address the API as api/, the same path they use behind NGINX
+                self.path = self.path[len('/api'):]
+            if self._route_static():
+                return
+            url = urllib.parse.urlsplit(self.path)
+            if url.path.endswith('.jpg') and url.path.count('/') == 1:
+                self._send_snapshot(util.escape_name(url.path[1:-len('.jpg')]))
+                return
+            if url.path == '/:metrics':
+                response = bytes(
+                    metrics.render(
+                        self.config, self.threads, self.recordings, self.live_store, self.notifications,
+                    ), 'utf-8',
+                )
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', len(response))
+                self.end_headers()
+                self.wfile.write(response)
+                return
+            if url.path == '/:export':
+                self._export(urllib.parse.parse_qs(url.query))
+                return
+            if url.path == '/:recordings':
+                result = self._get_recordings(urllib.parse.parse_qs(url.query))
+                self._send_json(200 if result is not None else 400, result)
+                return
+            if url.path == '/:notifications' and self.notifications:
+                self._send_json(200, self.notifications.stats())
+                return
+            if url.path == '/:jobs':
+                self._send_json(200, self.jobs.list())
+                return
+            if url.path == '/:cluster' and self.cluster:
+                self._send_json(200, self.cluster.status())
+                return
+            if url.path == '/:recording_streams':
+                self._send_json(200, self.recordings.summary())
+                return
             if self.path[1:] == ':free':
                 result = shutil.disk_usage(self.config.get_rec_dir()).free
             elif self.path[1:] == ':free_str':
@@ -110,41 +716,188 @@ def create_handler(config, threads):
                     result = config.get_stream(name)
                 else:
                     result = config.get_streams()
-            response = json.JSONEncoder().encode(result)
-            self.send_response(200 if result is not None else 404)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Content-Length', len(response))
-            self.end_headers()
-            self.wfile.write(bytes(response, 'utf-8'))
+            self._send_json(200 if result is not None else 404, result)
+
+    return VideoServerRequestHandler
 
-        def version_string(self):
-            return 'videoserver'
 
-        def log_message(self, fmt, *args):
-            logging.debug('HTTPServer: %s', (fmt % args))
-            pass
+# workers only serve connections that have a request to read, idle connections wait in a selector
+class PooledHTTPServer(http.server.HTTPServer):
+    allow_reuse_address = True
 
-    return VideoServerRequestHandler
+    def __init__(self, server_address, handler_class, max_workers, idle_timeout=5, transfer_workers=0,
+                 write_timeout=300):
+        # server_close() needs the executors and the idle thread if binding fails
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='httpapi')
+        self.transfers = None
+        if transfer_workers:
+            self.transfers = concurrent.futures.ThreadPoolExecutor(
+                transfer_workers, thread_name_prefix='httpapi-transfer',
+            )
+        self.idle_timeout = idle_timeout
+        self.write_timeout = write_timeout
+        self.parked = []
+        self.parked_lock = threading.Lock()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.closing = False
+        self.idle_thread = threading.Thread(target=self._watch_idle, name='httpapi-idle')
+        self.idle_thread.daemon = True
+        self.idle_thread.start()
+        super().__init__(server_address, handler_class)
+
+    def process_request(self, request, client_address):
+        # a new connection takes a worker once its first request arrives
+        self.park(request, client_address, None)
+
+    def park(self, request, client_address, handler):
+        with self.parked_lock:
+            if not self.closing:
+                self.parked.append((request, client_address, handler))
+                self.wake_w.send(b'\0')
+                return
+        self._close_idle(request, handler)
+
+    def serve_connection(self, request, client_address, handler):
+        try:
+            if handler is None:
+                handler = self.RequestHandlerClass(request, client_address, self)
+            else:
+                handler.resume()
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+        if handler.transfer:
+            self.transfers.submit(self.finish_transfer, request, client_address, handler)
+        elif handler.idle:
+            self.park(request, client_address, handler)
+        else:
+            self.shutdown_request(request)
+
+    def finish_transfer(self, request, client_address, handler):
+        write, close = handler.transfer
+        handler.transfer = None
+        try:
+            # a player that has buffered enough stops reading, only a long stall aborts the transfer
+            request.settimeout(self.write_timeout)
+            write()
+            request.settimeout(handler.timeout)
+        except OSError as e:
+            logging.debug('HTTPServer: transfer to %s aborted: %s', client_address[0], e)
+            handler.close_connection = True
+        except Exception:
+            self.handle_error(request, client_address)
+            handler.close_connection = True
+        finally:
+            if close:
+                close()
+        if handler.close_connection:
+            handler.close()
+            self.shutdown_request(request)
+        elif handler.input_pending():
+            self.executor.submit(self.serve_connection, request, client_address, handler)
+        else:
+            handler.idle = True
+            self.park(request, client_address, handler)
+
+    def _close_idle(self, request, handler):
+        if handler:
+            handler.close()
+        self.shutdown_request(request)
+
+    def _watch_idle(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.wake_r, selectors.EVENT_READ)
+        connections = {}
+        while not self.closing:
+            with self.parked_lock:
+                parked, self.parked = self.parked, []
+            now = time.monotonic()
+            for request, client_address, handler in parked:
+                connections[request] = (client_address, handler, now + self.idle_timeout)
+                selector.register(request, selectors.EVENT_READ)
+            timeout = None
+            if connections:
+                timeout = max(min(deadline for _, _, deadline in connections.values()) - now, 0)
+            for key, _ in selector.select(timeout):
+                if key.fileobj is self.wake_r:
+                    self.wake_r.recv(4096)
+                    continue
+                selector.unregister(key.fileobj)
+                client_address, handler, _ = connections.pop(key.fileobj)
+                self.executor.submit(self.serve_connection, key.fileobj, client_address, handler)
+            now = time.monotonic()
+            for request, (_, handler, deadline) in list(connections.items()):
+                if deadline <= now:
+                    selector.unregister(request)
+                    del connections[request]
+                    self._close_idle(request, handler)
+        for request, (_, handler, _) in connections.items():
+            self._close_idle(request, handler)
+        selector.close()
+        self.wake_r.close()
+        self.wake_w.close()
+
+    def server_close(self):
+        super().server_close()
+        with self.parked_lock:
+            self.closing = True
+            self.wake_w.send(b'\0')
+        self.executor.shutdown(wait=False)
+        if self.transfers:
+            self.transfers.shutdown(wait=False)
 
 
 class HttpApi:
-    def __init__(self, config, threads):
+    def __init__(
+            self, config, threads, recordings, snapshots, cluster=None, jobs=None, live_store=None, notifications=None,
+            wait_stopped=None,
+    ):
         self.config = config
         self.threads = threads
+        self.recordings = recordings
+        self.snapshots = snapshots
+        self.cluster = cluster
+        self.jobs = jobs
+        self.live_store = live_store
+        self.notifications = notifications
+        self.wait_stopped = wait_stopped
         self.port = self.config.get_http_port()
         self.addr = self.config.get_http_addr()
-        socketserver.TCPServer.allow_reuse_address = True
-        self.httpd = socketserver.TCPServer(('', self.port), create_handler(self.config, self.threads))
+        self.httpd = PooledHTTPServer(
+            (self.addr, self.port),
+            create_handler(
+                self.config, self.threads, self.recordings, self.snapshots, self.cluster, self.jobs, self.live_store,
+                self.notifications, self.wait_stopped,
+            ),
+            self.config.get_http_workers(),
+            self.config.get_http_keepalive_timeout(),
+            self.config.get_http_transfer_workers(),
+            self.config.get_http_write_timeout(),
+        )
+        self.upload_httpd = None
+        if self.live_store:
+            self.upload_httpd = PooledHTTPServer(
+                ('127.0.0.1', self.config.get_live_upload_port()),
+                create_upload_handler(self.config, self.live_store),
+                self.config.get_live_upload_workers(),
+                self.config.get_http_keepalive_timeout(),
+            )
         self.running = False
 
     def start(self):
-        logging.debug('HTTP API server stating on port {:d}'.format(self.port))
-        thread = threading.Thread(target=self.httpd.serve_forever)
-        thread.daemon = True
-        thread.start()
+        logging.debug('HTTP API server stating on {}:{:d}'.format(self.addr, self.port))
+        for httpd in (self.httpd, self.upload_httpd):
+            if httpd:
+                thread = threading.Thread(target=httpd.serve_forever)
+                thread.daemon = True
+                thread.start()
         self.running = True
 
     def stop(self):
         logging.debug('HTTP API server shutting down')
-        self.httpd.shutdown()
+        for httpd in (self.httpd, self.upload_httpd):
+            if httpd:
+                httpd.shutdown()
+                httpd.server_close()
         self.running = False
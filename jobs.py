@@ -0,0 +1,88 @@
+import collections
+import itertools
+import logging
+import queue
+import threading
+import time
+
+
+class Job:
+    def __init__(self, job_id, description, func):
+        self.id = job_id
+        self.description = description
+        self.func = func
+        self.state = 'queued'
+        self.total = None
+        self.done = 0
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def progress(self, done, total=None):
+        self.done = done
+        if total is not None:
+            self.total = total
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'description': self.description,
+            'state': self.state,
+            'done': self.done,
+            'total': self.total,
+            'error': self.error,
+            'created': int(self.created),
+            'finished': int(self.finished) if self.finished is not None else None,
+        }
+
+
+# slow housekeeping runs here so that API requests and the main loop do not wait for it
+class JobQueue:
+    def __init__(self, history=100):
+        self.queue = queue.Queue()
+        self.jobs = collections.OrderedDict()
+        self.history = history
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, description, func):
+        with self.lock:
+            job = Job(next(self.ids), description, func)
+            self.jobs[job.id] = job
+            finished = [job_id for job_id, job_ in self.jobs.items() if job_.finished is not None]
+            for job_id in finished[:max(len(self.jobs) - self.history, 0)]:
+                del self.jobs[job_id]
+        self.queue.put(job)
+        return job
+
+    def list(self):
+        with self.lock:
+            return [job.as_dict() for job in self.jobs.values()]
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='jobs')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        self.queue.put(None)
+        if self.thread:
+            self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            job.state = 'running'
+            started = time.monotonic()
+            try:
+                job.func(job)
+                job.state = 'done'
+            except Exception as e:
+                logging.error('Job "%s" failed: %s', job.description, e)
+                job.state = 'failed'
+                job.error = str(e)
+            job.finished = time.time()
+            logging.info('Job "%s" %s in %.3f s', job.description, job.state, time.monotonic() - started)
@@ -0,0 +1,162 @@
+import collections
+import re
+import threading
+import time
+
+import util
+
+SEGMENT_RE = re.compile(r'^(.+)_(\d+)\.(ts|m4s)$')
+EVICTION_REASONS = ('ring', 'memory')
+
+
+def parse_filename(filename):
+    if filename.endswith('.m3u8'):
+        name, kind = filename[:-len('.m3u8')], 'playlist'
+    elif filename.endswith('_init.mp4'):
+        name, kind = filename[:-len('_init.mp4')], 'init'
+    else:
+        match = SEGMENT_RE.match(filename)
+        if not match:
+            return None
+        name, kind = match.group(1), 'segment'
+    if not name or util.escape_name(name) != name:
+        return None
+    return name, kind
+
+
+class LiveFile:
+    def __init__(self, data):
+        self.data = data
+        self.mtime = time.time()
+        self.mtime_ns = time.time_ns()
+
+
+class LiveStream:
+    def __init__(self):
+        self.playlist = None
+        self.init = None
+        self.segments = collections.OrderedDict()
+        self.playlist_entries = 0
+        self.size = 0
+
+
+# live HLS uploaded by FFmpeg is kept here instead of live_dir, a ring of the newest segments per stream
+class LiveStore:
+    def __init__(self, config):
+        self.config = config
+        self.streams = {}
+        # every segment of every stream in upload order, the oldest go first when memory runs out
+        self.order = collections.OrderedDict()
+        self.size = 0
+        self.evictions = dict.fromkeys(EVICTION_REASONS, 0)
+        self.evicted_bytes = dict.fromkeys(EVICTION_REASONS, 0)
+        self.lock = threading.Lock()
+
+    def max_size(self):
+        return self.config.get_live_store_mb() * 1000000
+
+    def _replace(self, stream, attr, data):
+        old = getattr(stream, attr)
+        if old is not None:
+            stream.size -= len(old.data)
+            self.size -= len(old.data)
+        setattr(stream, attr, LiveFile(data) if data is not None else None)
+        if data is not None:
+            stream.size += len(data)
+            self.size += len(data)
+
+    def _evict(self, name, filename, reason):
+        stream = self.streams[name]
+        segment = stream.segments.pop(filename)
+        del self.order[(name, filename)]
+        stream.size -= len(segment.data)
+        self.size -= len(segment.data)
+        self.evictions[reason] += 1
+        self.evicted_bytes[reason] += len(segment.data)
+
+    def put(self, filename, data):
+        parsed = parse_filename(filename)
+        if not parsed:
+            return False
+        name, kind = parsed
+        with self.lock:
+            stream = self.streams.setdefault(name, LiveStream())
+            if kind == 'playlist':
+                self._replace(stream, 'playlist', data)
+                stream.playlist_entries = data.count(b'#EXTINF:')
+            elif kind == 'init':
+                self._replace(stream, 'init', data)
+            else:
+                old = stream.segments.pop(filename, None)
+                if old:
+                    del self.order[(name, filename)]
+                    stream.size -= len(old.data)
+                    self.size -= len(old.data)
+                stream.segments[filename] = LiveFile(data)
+                self.order[(name, filename)] = True
+                stream.size += len(data)
+                self.size += len(data)
+            # one segment more than the playlist lists, players may still be loading the one that just left it
+            ring = max(self.config.get_live_store_segments(), stream.playlist_entries + 1)
+            while len(stream.segments) > ring:
+                self._evict(name, next(iter(stream.segments)), 'ring')
+            max_size = self.max_size()
+            while self.size > max_size and self.order:
+                self._evict(*next(iter(self.order)), 'memory')
+        return True
+
+    def get(self, filename):
+        parsed = parse_filename(filename)
+        if not parsed:
+            return None
+        name, kind = parsed
+        with self.lock:
+            stream = self.streams.get(name)
+            if not stream:
+                return None
+            if kind == 'playlist':
+                return stream.playlist
+            if kind == 'init':
+                return stream.init
+            return stream.segments.get(filename)
+
+    def playlist_marker(self, name):
+        with self.lock:
+            stream = self.streams.get(name)
+            if not stream or not stream.playlist:
+                return None
+            return stream.playlist.mtime_ns
+
+    def latest_segment(self, name):
+        with self.lock:
+            stream = self.streams.get(name)
+            if not stream or not stream.segments:
+                return None
+            segment = stream.segments[next(reversed(stream.segments))]
+            # fMP4 segments can only be decoded together with the initialization segment
+            if stream.init:
+                return stream.init.data + segment.data
+            return segment.data
+
+    def remove_stream(self, name):
+        with self.lock:
+            stream = self.streams.pop(name, None)
+            if not stream:
+                return 0
+            for filename in stream.segments:
+                del self.order[(name, filename)]
+            self.size -= stream.size
+            return len(stream.segments)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'max_size': self.max_size(),
+                'streams': {
+                    name: {'size': stream.size, 'segments': len(stream.segments)}
+                    for name, stream in self.streams.items()
+                },
+                'evictions': dict(self.evictions),
+                'evicted_bytes': dict(self.evicted_bytes),
+            }
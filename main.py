@@ -1,72 +1,128 @@
 #!/usr/bin/env python3
-import datetime
 import logging
 import os
-import re
 import shutil
 import signal
-import threading
 import time
 
+import catalog
+import cluster
 import config
-import ffmpeg
 import httpapi
+import jobs
+import livestore
+import notifications
 import notifiers
+import progress
+import recindex
+import shard
+import snapshot
+import supervisor
 import util
 
 
-def configure_logging():
-    logging.root.setLevel(logging.NOTSET)
-    handler = logging.StreamHandler()
-    handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s', '%Y-%m-%d %H:%M:%S'))
-    logging.root.addHandler(handler)
-
-
 class Application:
     def __init__(self):
         self.running = False
         self.config = None
         self.threads = {}
         self.notifiers = []
+        self.dispatcher = None
         self.server = None
+        self.supervisor = None
+        self.cluster = None
+        self.recordings = None
+        self.jobs = jobs.JobQueue()
+        self.live_store = None
+        self.progress_reader = progress.ProgressReader()
+        self.stream_limits_version = None
+        self.rec_quotas = {}
+        self.rec_weights = {}
+        self.waker = util.Waker()
+        self.reload_requested = False
+        self.fs_check_interval = 1
+
+    def wait_stopped(self, name, version, timeout=None):
+        # called from the job thread, the supervisor is created after the API server
+        if self.supervisor is None:
+            return True
+        return self.supervisor.process_tracker.wait_stopped(name, version, timeout)
 
     def _send_notification(self, message, stream=None, status=None):
-        for notifier in self.notifiers:
-            threading.Thread(target=notifier.send, args=[message, stream, status]).start()
-
-    def _find_recordings(self):
-        recordings = []
-        for filename in os.listdir(self.config.get_rec_dir()):
-            if re.match(r'^[A-z-_\d]+_\d+\.mp4$', filename):
-                recordings.append(filename)
-        return sorted(recordings)
-
-    def _remove_stale_latest_files(self):
-        recordings = self._find_recordings()
-        for filename in os.listdir(self.config.get_rec_dir()):
-            if re.match(r'^[A-z-_\d]+_latest$', filename):
-                remove = False
-                with open(os.path.join(self.config.get_rec_dir(), filename)) as f:
-                    rec_filename = f.readline().strip()
-                    if rec_filename not in recordings:
-                        remove = True
-                if remove:
-                    logging.info('Removing stale %s', filename)
-                    try:
-                        os.remove(os.path.join(self.config.get_rec_dir(), filename))
-                    except FileNotFoundError:
-                        pass
+        self.dispatcher.submit(message, stream, status)
+
+    def _update_stream_limits(self):
+        if self.stream_limits_version == self.config.streams_version:
+            return
+        self.stream_limits_version = self.config.streams_version
+        self.rec_quotas = {}
+        self.rec_weights = {}
+        for stream in self.config.get_streams():
+            if stream is None:
+                continue
+            if stream['rec_quota_mb'] > 0:
+                self.rec_quotas[stream['name']] = stream['rec_quota_mb'] * 1000000
+            if stream['rec_weight'] != 1:
+                self.rec_weights[stream['name']] = stream['rec_weight']
+
+    def _remove_recordings(self, segments, reason):
+        started = time.monotonic()
+        size = 0
+        for segment in segments:
+            logging.debug('Removing record "%s" due to %s', segment.filename, reason)
+            self.recordings.delete(segment)
+            size += segment.size
+        if segments:
+            logging.info(
+                'Removed %d records (%s) due to %s in %.3f s',
+                len(segments), util.filesizeformat(size), reason, time.monotonic() - started,
+            )
+        return {segment.stream for segment in segments}
+
+    def _check_recordings(self):
+        self.recordings.refresh()
+        self._update_stream_limits()
+        touched_streams = set()
+        rec_keep_hours = self.config.get_rec_keep_hours()
+        # do not remove if rec_keep_hours is 0
+        if rec_keep_hours > 0:
+            touched_streams |= self._remove_recordings(
+                self.recordings.expired(time.time() - rec_keep_hours * 3600),
+                'expiry of {:d} hours'.format(rec_keep_hours),
+            )
+        if self.rec_quotas:
+            touched_streams |= self._remove_recordings(self.recordings.over_quota(self.rec_quotas), 'stream quota')
+        keep_free = self.config.get_keep_free_mb() * 1000000
+        needed = keep_free - shutil.disk_usage(self.config.get_rec_dir()).free
+        while needed > 0:
+            logging.warning('Free space is less than %d MB', self.config.get_keep_free_mb())
+            segments = self.recordings.select_oldest(needed, self.rec_weights)
+            if not segments:
+                logging.critical('Unable to free up the required space')
+                self._send_notification('Unable to free up the required space')
+                return False
+            touched_streams |= self._remove_recordings(segments, 'lack of free space')
+            needed = keep_free - shutil.disk_usage(self.config.get_rec_dir()).free
+        if touched_streams:
+            self.recordings.remove_stale_latest_files(touched_streams)
+        return True
 
     def run(self):
         logging.info('Starting')
         self.config = config.Config()
-        self.server = httpapi.HttpApi(self.config, self.threads)
         logging.info('Using FFmpeg binary: %s', self.config.get_ffmpeg_bin())
         os.makedirs(os.path.realpath(self.config.get_live_dir()), exist_ok=True)
         os.makedirs(os.path.realpath(self.config.get_rec_dir()), exist_ok=True)
-        logging.info('Free space: %s', util.filesizeformat(shutil.disk_usage(self.config.get_rec_dir()).free))
-        self.running = True
-        self.server.start()
+        if self.config.get_rec_index() == 'sqlite':
+            self.recordings = catalog.RecordingCatalog(
+                self.config.get_rec_dir(), self.config.get_date_fmt(), self.config.get_rec_catalog(),
+            )
+        else:
+            self.recordings = recindex.RecordingIndex(self.config.get_rec_dir(), self.config.get_date_fmt())
+        self.recordings.start()
+        if self.config.get_cluster_enabled():
+            self.cluster = cluster.Cluster(self.config)
+            self.cluster.start()
         if self.config.get_http_get_enabled():
             self.notifiers.append(notifiers.HttpGet(self.config))
         if self.config.get_slack_enabled():
@@ -75,156 +131,110 @@ class Application:
             self.notifiers.append(notifiers.SMTP(self.config))
         if self.config.get_telegram_enabled():
             self.notifiers.append(notifiers.Telegram(self.config))
+        self.dispatcher = notifications.NotificationDispatcher(
+            self.notifiers, self.config.get_notification_outbox(),
+            window=self.config.get_notification_window(),
+            queue_size=self.config.get_notification_queue_size(),
+            retry_min_delay=self.config.get_notification_retry_min_delay(),
+            retry_max_delay=self.config.get_notification_retry_max_delay(),
+            circuit_threshold=self.config.get_notification_circuit_threshold(),
+        )
+        # always present so that switching [live] store on reload needs no restart of the API
+        self.live_store = livestore.LiveStore(self.config)
+        self.server = httpapi.HttpApi(
+            self.config, self.threads, self.recordings,
+            snapshot.SnapshotCache(self.config, self.recordings, self.live_store),
+            self.cluster, self.jobs, self.live_store, self.dispatcher, self.wait_stopped,
+        )
+        logging.info('Free space: %s', util.filesizeformat(shutil.disk_usage(self.config.get_rec_dir()).free))
+        self.running = True
+        self.jobs.start()
+        self.dispatcher.start()
+        self.server.start()
         self._send_notification('Started')
-        fs_check_tick_limit = 99
-        fs_limit_check_ticks = 0
-        # wait before assuming that ffmpeg is running ok
-        ff_success_cnt = self.config.get_ffmpeg_start_timeout() * 100
-        ff_running_cnt = {}
-        rec_keep_timedelta = datetime.timedelta(hours=self.config.get_rec_keep_hours())
-        failed_streams = {}
+        workers = self.config.get_workers()
+        if workers > 1:
+            # streams are supervised by worker processes, this process keeps the API and the disk housekeeping
+            logging.info('Distributing streams across %d workers', workers)
+            self.supervisor = shard.ShardManager(
+                self.config, workers, self.threads, self._send_notification, self.waker,
+            )
+            self.supervisor.start()
+        else:
+            self.progress_reader.start()
+            self.supervisor = supervisor.Supervisor(
+                self.config, self.threads, self._send_notification,
+                progress_reader=self.progress_reader, recordings=self.recordings, live_store=self.live_store,
+            )
+        # stream changes made through the API wake the supervisor up immediately
+        self.config.add_listener(self.wake)
+        next_fs_check = time.monotonic()
         while self.running:
-            time.sleep(0.01)
-
-            ok = True
-            if fs_limit_check_ticks == 0:
-                recordings = self._find_recordings()
-                # do not remove if rec_keep_hours is 0
-                if rec_keep_timedelta > datetime.timedelta():
-                    for filename in recordings:
-                        stream_name, datetime_str = str(filename.rsplit('.', 1)[0]).rsplit('_', 1)
-                        datetime_ = datetime.datetime.strptime(datetime_str, self.config.get_date_fmt())
-                        if datetime.datetime.now() - datetime_ > rec_keep_timedelta:
-                            logging.info(
-                                'Removing record "%s" due to expiry of %d hours',
-                                filename, self.config.get_rec_keep_hours(),
-                            )
-                            try:
-                                os.remove(os.path.join(self.config.get_rec_dir(), filename))
-                            except FileNotFoundError:
-                                pass
-                            recordings.remove(filename)
-                while shutil.disk_usage(self.config.get_rec_dir()).free < (self.config.get_keep_free_mb() * 1000000):
-                    if not recordings or len(recordings) < 1:
-                        logging.critical('Unable to free up the required space')
-                        self._send_notification('Unable to free up the required space')
-                        ok = False
-                        break
-                    filename = recordings[0]
-                    logging.warning('Free space is less than %d MB', self.config.get_keep_free_mb())
-                    logging.warning('Removing record %s due to lack of free space', filename)
-                    try:
-                        os.remove(os.path.join(self.config.get_rec_dir(), filename))
-                    except FileNotFoundError:
-                        pass
-                    recordings = self._find_recordings()
-                self._remove_stale_latest_files()
-            elif fs_limit_check_ticks > fs_check_tick_limit:
-                fs_limit_check_ticks = 0
-            else:
-                fs_limit_check_ticks += 1
-
-            if not ok:
-                break
-
-            active_stream_names = []
-            for stream in self.config.get_streams():
-                active_stream_names.append(stream['name'])
-                if stream['name'] not in self.threads:
-                    name = stream['name']
-                    source = stream['source']
-                    live = None
-                    rec = None
-                    snap = None
-                    if stream['live']:
-                        live = self.config.get_live_dir()
-                    if stream['rec']:
-                        rec = self.config.get_rec_dir()
-                    if 'snap' in stream and stream['snap'] is not None:
-                        snap = stream['snap']
-                    self.threads[stream['name']] = ffmpeg.FFmpeg(
-                        name, source,
-                        ffmpeg_bin=self.config.get_ffmpeg_bin(),
-                        live=live, rec=rec, snap=snap,
-                        segment_duration=stream['segment_duration'],
-                        stop_timeout=self.config.get_ffmpeg_stop_timeout(),
-                        date_fmt=self.config.get_date_fmt(),
-                        debug_output=self.config.get_ffmpeg_debug_output(),
-                    )
-
-            threads_to_stop = []
-            for name, thread in self.threads.items():
-                if name not in active_stream_names:
-                    threads_to_stop.append(name)
-            for name in threads_to_stop:
-                self.threads[name].stop()
-                if name in failed_streams:
-                    del failed_streams[name]
-                del self.threads[name]
-
-            for stream, thread in self.threads.items():
-                started, status = thread.status()
-                if not started:
-                    logging.info('Starting FFmpeg for %s', stream)
-                    thread.start()
-                # failed
-                elif status is not None:
-                    if stream in ff_running_cnt:
-                        del ff_running_cnt[stream]
-                    if stream in failed_streams:
-                        if failed_streams[stream] >= self.config.get_stream_down_timeout():
-                            self._send_notification('Stream {} failed'.format(stream), stream, False)
-                            failed_streams[stream] = -1
-                        elif failed_streams[stream] != -1:
-                            failed_streams[stream] += 1
-                    else:
-                        logging.warning(
-                            'FFmpeg for stream %s exited with status %d, restarting',
-                            stream, status,
-                        )
-                        failed_streams[stream] = 0
-                    thread.start()
-                # running
-                else:
-                    if stream not in ff_running_cnt:
-                        ff_running_cnt[stream] = 0
-                    else:
-                        if -1 < ff_running_cnt[stream] < ff_success_cnt:
-                            ff_running_cnt[stream] += 1
-                        else:
-                            if stream in failed_streams:
-                                logging.info('FFmpeg for stream %s restored', stream)
-                                if failed_streams[stream] == -1:
-                                    self._send_notification('Stream {} restored'.format(stream), stream, True)
-                                del failed_streams[stream]
-                            elif ff_running_cnt[stream] != -1:
-                                logging.info('FFmpeg for stream %s started successfully', stream)
-                                self._send_notification(None, stream, True)
-                                ff_running_cnt[stream] = -1
+            if self.reload_requested:
+                self.reload_requested = False
+                self._reload()
+            now = time.monotonic()
+            if now >= next_fs_check:
+                if not self._check_recordings():
+                    break
+                next_fs_check = now + self.fs_check_interval
+            if self.cluster:
+                self.cluster.check(now)
+            self.supervisor.check(now)
+
+            # sleep until a child exits, the configuration changes or the nearest timeout expires
+            deadline = next_fs_check
+            if self.cluster:
+                deadline = min(deadline, self.cluster.next_deadline())
+            supervisor_deadline = self.supervisor.next_deadline()
+            if supervisor_deadline is not None:
+                deadline = min(deadline, supervisor_deadline)
+            if self.running:
+                ready = self.waker.wait(deadline - time.monotonic())
+                if ready:
+                    self.supervisor.handle(ready)
 
         logging.info('Shutting down')
         self._send_notification('Shutting down')
         self.server.stop()
-        for _, thread in self.threads.items():
-            thread.stop()
+        if self.cluster:
+            self.cluster.stop()
+        self.supervisor.stop()
+        self.jobs.stop(self.config.get_ffmpeg_stop_timeout())
+        self.dispatcher.stop(self.config.get_ffmpeg_stop_timeout())
+        self.progress_reader.stop()
+        self.recordings.stop()
         return 0
 
-    def reload(self):
+    def _reload(self):
         logging.info('Reloading configuration files')
-        self.config.reload()
-        self.config.reload_streams()
+        try:
+            self.config.reload()
+            self.config.reload_streams()
+        except Exception as e:
+            logging.error('Failed to reload configuration: %s', e)
+
+    def reload(self):
+        # called from the signal handler, the main loop does the actual work
+        self.reload_requested = True
+        self.wake()
+
+    def wake(self):
+        self.waker.wake()
 
     def stop(self):
         self.running = False
+        self.wake()
 
 
 if __name__ == '__main__':
-    configure_logging()
+    util.configure_logging()
     try:
         app = Application()
         signal.signal(signal.SIGINT, lambda signum, frame: app.stop())
         signal.signal(signal.SIGTERM, lambda signum, frame: app.stop())
         signal.signal(signal.SIGHUP, lambda signum, frame: app.reload())
+        signal.signal(signal.SIGCHLD, lambda signum, frame: app.wake())
         exit(app.run())
     except Exception as e:
         logging.critical(e or e.__class__.__name__)
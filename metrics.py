@@ -0,0 +1,155 @@
+import shutil
+
+import progress
+
+
+def _format_value(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Registry:
+    def __init__(self):
+        self.lines = []
+
+    def add(self, name, type_, help_, samples):
+        self.lines.append('# HELP {} {}'.format(name, help_))
+        self.lines.append('# TYPE {} {}'.format(name, type_))
+        for labels, value in samples:
+            if labels:
+                label_str = ','.join('{}="{}"'.format(k, _escape_label(v)) for k, v in sorted(labels.items()))
+                self.lines.append('{}{{{}}} {}'.format(name, label_str, _format_value(value)))
+            else:
+                self.lines.append('{} {}'.format(name, _format_value(value)))
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def collect_streams(registry, threads):
+    up = []
+    stats = {key: [] for key in ('fps', 'bitrate_kbps', 'drop_frames', 'dup_frames', 'speed', 'age')}
+    cpu = []
+    rss = []
+    for name, thread in list(threads.items()):
+        labels = {'stream': name}
+        started, status = thread.status()
+        up.append((labels, started and status is None))
+        latest = thread.progress.latest() if getattr(thread, 'progress', None) else None
+        if latest:
+            for key in stats:
+                stats[key].append((labels, latest[key]))
+        usage = [progress.process_usage(pid) for pid in thread.pids()]
+        usage = [item for item in usage if item]
+        if usage:
+            cpu.append((labels, sum(item[0] for item in usage)))
+            rss.append((labels, sum(item[1] for item in usage)))
+
+    registry.add('videoserver_stream_up', 'gauge', 'Whether the FFmpeg processes of the stream are running', up)
+    registry.add('videoserver_stream_fps', 'gauge', 'Frames per second reported by FFmpeg', stats['fps'])
+    registry.add(
+        'videoserver_stream_bitrate_kbps', 'gauge', 'Output bitrate reported by FFmpeg', stats['bitrate_kbps'],
+    )
+    registry.add(
+        'videoserver_stream_dropped_frames_total', 'counter', 'Frames dropped by FFmpeg', stats['drop_frames'],
+    )
+    registry.add(
+        'videoserver_stream_duplicated_frames_total', 'counter', 'Frames duplicated by FFmpeg', stats['dup_frames'],
+    )
+    registry.add('videoserver_stream_speed', 'gauge', 'Processing speed relative to real time', stats['speed'])
+    registry.add(
+        'videoserver_stream_last_packet_age_seconds', 'gauge',
+        'Seconds since the output timestamp of the stream last advanced', stats['age'],
+    )
+    registry.add('videoserver_stream_cpu_seconds_total', 'counter', 'CPU time used by the FFmpeg processes', cpu)
+    registry.add('videoserver_stream_memory_rss_bytes', 'gauge', 'Resident memory of the FFmpeg processes', rss)
+
+
+def collect_live_store(registry, live_store):
+    stats = live_store.stats()
+    registry.add(
+        'videoserver_live_store_bytes', 'gauge', 'Memory used by uploaded live HLS files',
+        [({'stream': name}, stream['size']) for name, stream in sorted(stats['streams'].items())],
+    )
+    registry.add(
+        'videoserver_live_store_segments', 'gauge', 'Live HLS segments kept in memory',
+        [({'stream': name}, stream['segments']) for name, stream in sorted(stats['streams'].items())],
+    )
+    registry.add(
+        'videoserver_live_store_limit_bytes', 'gauge', 'Memory limit of the live store', [({}, stats['max_size'])],
+    )
+    registry.add(
+        'videoserver_live_store_evictions_total', 'counter', 'Live HLS segments dropped from memory',
+        [({'reason': reason}, count) for reason, count in sorted(stats['evictions'].items())],
+    )
+    registry.add(
+        'videoserver_live_store_evicted_bytes_total', 'counter', 'Bytes of live HLS segments dropped from memory',
+        [({'reason': reason}, count) for reason, count in sorted(stats['evicted_bytes'].items())],
+    )
+
+
+def collect_notifications(registry, notifications):
+    stats = notifications.stats()
+    notifiers = sorted(stats['notifiers'].items())
+    registry.add(
+        'videoserver_notification_queue_depth', 'gauge', 'Notifications waiting to be grouped into digests',
+        [({}, stats['queued'])],
+    )
+    registry.add(
+        'videoserver_notifications_queued', 'gauge', 'Notifications waiting for delivery',
+        [({'notifier': name}, notifier['queued']) for name, notifier in notifiers],
+    )
+    registry.add(
+        'videoserver_notifications_sent_total', 'counter', 'Notifications delivered',
+        [({'notifier': name}, notifier['sent']) for name, notifier in notifiers],
+    )
+    registry.add(
+        'videoserver_notification_retries_total', 'counter', 'Failed delivery attempts',
+        [({'notifier': name}, notifier['retries']) for name, notifier in notifiers],
+    )
+    registry.add(
+        'videoserver_notifications_dropped_total', 'counter', 'Notifications dropped because the queue was full',
+        [({}, stats['dropped'])],
+    )
+    registry.add(
+        'videoserver_notifier_probes_total', 'counter', 'Single notifications sent to test a held notifier',
+        [({'notifier': name}, notifier['probes']) for name, notifier in notifiers],
+    )
+    registry.add(
+        'videoserver_notification_delivery_seconds_total', 'counter',
+        'Time from event to delivery summed over delivered notifications',
+        [({'notifier': name}, notifier['latency_sum']) for name, notifier in notifiers],
+    )
+    registry.add(
+        'videoserver_notification_last_delivery_seconds', 'gauge', 'Time from event to delivery of the last one',
+        [({'notifier': name}, notifier['last_latency']) for name, notifier in notifiers],
+    )
+    registry.add(
+        'videoserver_notifier_circuit_open', 'gauge', 'Whether notifications are held after repeated failures',
+        [({'notifier': name}, notifier['circuit_open']) for name, notifier in notifiers],
+    )
+
+
+def render(config, threads, recordings, live_store=None, notifications=None):
+    registry = Registry()
+    collect_streams(registry, threads)
+    if live_store and config.get_live_store() == 'memory':
+        collect_live_store(registry, live_store)
+    if notifications:
+        collect_notifications(registry, notifications)
+    registry.add(
+        'videoserver_free_bytes', 'gauge', 'Free space on the recordings volume',
+        [({}, shutil.disk_usage(config.get_rec_dir()).free)],
+    )
+    registry.add(
+        'videoserver_recordings_bytes', 'gauge', 'Total size of the indexed recordings',
+        [({'stream': name}, recordings.get_size(name)) for name in recordings.get_stream_names()],
+    )
+    return registry.render()
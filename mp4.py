@@ -0,0 +1,76 @@
+import collections
+import os
+import struct
+import threading
+
+BOX_HEADER = struct.Struct('>I4s')
+LARGE_SIZE = struct.Struct('>Q')
+
+
+def iter_boxes(f, size, offset=0):
+    while offset + BOX_HEADER.size <= size:
+        f.seek(offset)
+        header = f.read(16)
+        if len(header) < BOX_HEADER.size:
+            return
+        box_size, box_type = BOX_HEADER.unpack_from(header)
+        header_size = BOX_HEADER.size
+        if box_size == 1:
+            if len(header) < 16:
+                return
+            box_size = LARGE_SIZE.unpack_from(header, 8)[0]
+            header_size = 16
+        elif box_size == 0:
+            # extends to the end of a file that is still being written, its size is not known yet
+            return
+        if box_size < header_size:
+            return
+        yield box_type, offset, box_size
+        offset += box_size
+
+
+class ScanState:
+    __slots__ = ('offset', 'playable', 'moov', 'fragment')
+
+    def __init__(self):
+        # where scanning resumes, the end of the last complete fragment and what has been seen so far
+        self.offset = 0
+        self.playable = None
+        self.moov = False
+        self.fragment = False
+
+
+# finds how much of a fragmented MP4 that is still being written can be played, scans resume where they stopped
+class FragmentScanner:
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.states = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def playable_size(self, path):
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        with f:
+            stat = os.fstat(f.fileno())
+            key = (path, stat.st_ino)
+            with self.lock:
+                state = self.states.pop(key, None) or ScanState()
+                self.states[key] = state
+                while len(self.states) > self.max_entries:
+                    self.states.popitem(last=False)
+            # concurrent requests may scan the same file, the results are identical
+            offset = state.offset
+            for box_type, box_offset, box_size in iter_boxes(f, stat.st_size, offset):
+                if box_offset + box_size > stat.st_size:
+                    break
+                offset = box_offset + box_size
+                if box_type == b'moov':
+                    state.moov = True
+                elif box_type == b'moof':
+                    state.fragment = True
+                elif box_type == b'mdat' and state.moov and state.fragment:
+                    state.playable = offset
+            state.offset = offset
+            return state.playable
@@ -0,0 +1,353 @@
+import collections
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import util
+
+
+def format_streams(names, limit=20):
+    if len(names) > limit:
+        return '{} and {:d} more'.format(', '.join(names[:limit]), len(names) - limit)
+    return ', '.join(names)
+
+
+def summarize(names, what):
+    if len(names) == 1:
+        return 'Stream {} {}'.format(names[0], what)
+    return '{:d} streams {}: {}'.format(len(names), what, format_streams(names))
+
+
+def digest(events):
+    messages = [event for event in events if event[0] is not None]
+    if len(messages) <= 1:
+        return messages
+    lines = []
+    failed = []
+    restored = []
+    for message, stream, status in messages:
+        if stream is None or status is None:
+            lines.append(message)
+        elif status:
+            restored.append(stream)
+        else:
+            failed.append(stream)
+    if failed:
+        lines.append(summarize(failed, 'failed'))
+    if restored:
+        lines.append(summarize(restored, 'restored'))
+    return [('\n'.join(lines), None, None)]
+
+
+# append-only JSON lines: one record per event naming its notifiers, and ack records as they deliver it
+class Outbox:
+    def __init__(self, path, compact_lines=1000):
+        self.path = path
+        self.compact_lines = compact_lines
+        self.pending = collections.OrderedDict()
+        self.next_id = 1
+        self.lines = 0
+        self.file = None
+        self.lock = threading.Lock()
+
+    def load(self, names):
+        records = collections.OrderedDict()
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line may be cut short by a crash
+                        continue
+                    if 'ack' in record:
+                        for event_id in record['ack']:
+                            if event_id in records:
+                                records[event_id]['to'].discard(record['to'])
+                    else:
+                        record['to'] = set(record['to'])
+                        records[record['id']] = record
+                        self.next_id = max(self.next_id, record['id'] + 1)
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            # notifiers that are no longer enabled will not deliver anything
+            for event_id, record in records.items():
+                record['to'] &= set(names)
+                if record['to']:
+                    self.pending[event_id] = record
+            self._compact_locked()
+        return [dict(record, to=sorted(record['to'])) for record in self.pending.values()]
+
+    def _open_locked(self):
+        try:
+            self.file = open(self.path, 'a')
+        except OSError as e:
+            logging.error('Failed to open notification outbox: %s', e)
+            self.file = None
+
+    def _write_locked(self, lines, sync=False):
+        self.lines += len(lines)
+        if not self.file:
+            self._open_locked()
+            if not self.file:
+                return
+        try:
+            self.file.write(''.join(line + '\n' for line in lines))
+            self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+        except (OSError, ValueError) as e:
+            logging.error('Failed to write notification outbox: %s', e)
+
+    def _compact_locked(self):
+        if self.file:
+            self.file.close()
+        try:
+            util.write_file_atomic(self.path, ''.join(
+                json.dumps(dict(record, to=sorted(record['to'])), separators=(',', ':')) + '\n'
+                for record in self.pending.values()
+            ))
+            self.lines = len(self.pending)
+        except OSError as e:
+            logging.error('Failed to rewrite notification outbox: %s', e)
+        self._open_locked()
+
+    def append(self, records):
+        if not records:
+            return
+        with self.lock:
+            for record in records:
+                record['id'] = self.next_id
+                self.next_id += 1
+                self.pending[record['id']] = dict(record, to=set(record['to']))
+            # one sync per batch, a burst of failing streams costs a single disk flush
+            self._write_locked([json.dumps(record, separators=(',', ':')) for record in records], sync=True)
+
+    def ack(self, ids, name):
+        with self.lock:
+            for event_id in ids:
+                record = self.pending.get(event_id)
+                if record:
+                    record['to'].discard(name)
+                    if not record['to']:
+                        del self.pending[event_id]
+            self._write_locked([json.dumps({'ack': ids, 'to': name}, separators=(',', ':'))])
+            if self.lines > max(self.compact_lines, 4 * len(self.pending)):
+                self._compact_locked()
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+
+# closed: everything waiting is sent, failures are retried with backoff. open: after circuit_threshold
+# failures in a row nothing is sent until the retry delay has passed. half-open: then a single record is sent
+# as a probe, its delivery closes the circuit and the backlog follows, its failure opens it again
+class NotifierWorker:
+    def __init__(self, notifier, outbox, backoff, circuit_threshold):
+        self.notifier = notifier
+        self.name = notifier.__class__.__name__
+        self.outbox = outbox
+        self.backoff = backoff
+        self.circuit_threshold = circuit_threshold
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        self.retry_at = 0
+        self.failures = 0
+        self.circuit_open = False
+        self.stopping = False
+        self.sent = 0
+        self.retries = 0
+        self.probes = 0
+        self.latency_sum = 0
+        self.last_latency = None
+        self.thread = None
+
+    def put(self, records):
+        # nothing is dropped here: the outbox keeps every undelivered record anyway, and a digest notifier
+        # sends its backlog as one message
+        with self.condition:
+            self.pending.extend(records)
+            self.condition.notify()
+
+    def _take(self):
+        if self.circuit_open:
+            self.probes += 1
+            return [self.pending.popleft()]
+        # a digest covers everything waiting, including the backlog of an outage
+        count = len(self.pending) if self.notifier.digest else 1
+        return [self.pending.popleft() for _ in range(count)]
+
+    def _deliver(self, batch):
+        events = [(record['m'], record['s'], record['st']) for record in batch]
+        if self.notifier.digest and len(batch) > 1:
+            events = digest(events)
+        try:
+            return all([self.notifier.send(*event) for event in events])
+        except Exception as e:
+            logging.error('%s failed to send notification: %s', self.name, e)
+            return False
+
+    def _finish(self, batch, delivered):
+        now = time.time()
+        with self.condition:
+            if delivered:
+                self.sent += len(batch)
+                for record in batch:
+                    self.last_latency = now - record['t']
+                    self.latency_sum += self.last_latency
+                self.failures = 0
+                self.backoff.reset()
+                self.retry_at = 0
+                if self.circuit_open:
+                    logging.info('%s is reachable again, sending %d held notifications', self.name, len(self.pending))
+                    self.circuit_open = False
+            else:
+                self.pending.extendleft(reversed(batch))
+                self.retries += 1
+                self.failures += 1
+                delay = self.backoff.next_delay()
+                self.retry_at = time.monotonic() + delay
+                if self.circuit_open:
+                    logging.info('Probe via %s failed, holding %d notifications for %.1f s', self.name,
+                                 len(self.pending), delay)
+                elif self.failures >= self.circuit_threshold:
+                    # further events wait for the next probe instead of hammering the endpoint
+                    logging.warning('%s failed %d times in a row, holding notifications', self.name, self.failures)
+                    self.circuit_open = True
+                else:
+                    logging.info('Retrying %d notifications via %s in %.1f s', len(self.pending), self.name, delay)
+        if delivered:
+            self.outbox.ack([record['id'] for record in batch], self.name)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='notify-{}'.format(self.name))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    if self.pending and now >= self.retry_at:
+                        break
+                    # undelivered notifications stay in the outbox for the next start
+                    if self.stopping:
+                        self.notifier.close()
+                        return
+                    self.condition.wait(self.retry_at - now if self.pending else None)
+                batch = self._take()
+            self._finish(batch, self._deliver(batch))
+
+    def stats(self):
+        with self.condition:
+            return {
+                'queued': len(self.pending),
+                'sent': self.sent,
+                'retries': self.retries,
+                'probes': self.probes,
+                'latency_sum': self.latency_sum,
+                'last_latency': self.last_latency,
+                'circuit_open': self.circuit_open,
+            }
+
+
+# events go through one bounded queue and are grouped per window, every notifier sends from its own thread
+class NotificationDispatcher:
+    def __init__(
+            self, notifiers, outbox_path, window=2, queue_size=1000,
+            retry_min_delay=1, retry_max_delay=300, circuit_threshold=5,
+    ):
+        self.window = window
+        self.events = queue.Queue(queue_size)
+        self.outbox = Outbox(outbox_path)
+        self.workers = [
+            NotifierWorker(notifier, self.outbox, util.Backoff(retry_min_delay, retry_max_delay), circuit_threshold)
+            for notifier in notifiers
+        ]
+        self.dropped = 0
+        self.thread = None
+
+    def submit(self, message, stream=None, status=None):
+        try:
+            self.events.put_nowait((time.time(), message, stream, status))
+        except queue.Full:
+            self.dropped += 1
+            logging.warning('Notification queue is full, dropping "%s"', message)
+
+    def start(self):
+        pending = self.outbox.load([worker.name for worker in self.workers])
+        if pending:
+            logging.info('Resending %d notifications from the outbox', len(pending))
+        for worker in self.workers:
+            worker.put([record for record in pending if worker.name in record['to']])
+            worker.start()
+        self.thread = threading.Thread(target=self._run, name='notify')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        # pending events are delivered right away instead of waiting for the window to close
+        self.events.put(None)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        if self.thread:
+            self.thread.join(timeout)
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            if worker.thread:
+                worker.thread.join(max(deadline - time.monotonic(), 0) if deadline is not None else None)
+        self.outbox.close()
+
+    def _dispatch(self, batch):
+        records = []
+        for created, message, stream, status in batch:
+            to = [worker.name for worker in self.workers if worker.notifier.accepts(message, stream, status)]
+            if to:
+                records.append({'t': created, 'm': message, 's': stream, 'st': status, 'to': to})
+        self.outbox.append(records)
+        for worker in self.workers:
+            worker.put([record for record in records if worker.name in record['to']])
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            event = self.events.get()
+            if event is None:
+                break
+            batch = [event]
+            deadline = time.monotonic() + self.window
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    event = self.events.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if event is None:
+                    stopping = True
+                    break
+                batch.append(event)
+            if len(batch) > 1:
+                logging.debug('Coalescing %d notifications', len(batch))
+            self._dispatch(batch)
+
+    def stats(self):
+        return {
+            'queued': self.events.qsize(),
+            'dropped': self.dropped,
+            'notifiers': {worker.name: worker.stats() for worker in self.workers},
+        }
@@ -1,6 +1,16 @@
 class Notifier:
+    # notifiers with digest receive one combined message per burst of events instead of every event
+    digest = True
+
     def __init__(self, config):
         self.config = config
 
+    def accepts(self, message, stream=None, status=None):
+        return message is not None
+
+    # returns whether the message was delivered, failed ones are retried from the outbox
     def send(self, message, stream=None, status=None):
+        return True
+
+    def close(self):
         pass
@@ -1,31 +1,40 @@
+import http.client
 import logging
-import urllib.error
 import urllib.parse
-import urllib.request
 
 import util
 from notifier import *
 
 
 class HttpGet(Notifier):
+    # the receiving endpoint expects one request per stream status change
+    digest = False
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.http = util.PersistentHTTPConnection()
+
+    def accepts(self, message, stream=None, status=None):
+        return stream is not None and status is not None
+
     def send(self, message, stream=None, status=None):
         if stream is None or status is None:
-            return
+            return True
         params = {
             'stream': stream,
             'status': 1 if status else 0,
             'message': message
         }
-        request = urllib.request.Request('{}?{}'.format(
-            self.config.get_http_get_url(),
-            urllib.parse.urlencode(params))
-        )
-        opener = urllib.request.build_opener(util.TolerantHTTPErrorProcessor)
+        url = '{}?{}'.format(self.config.get_http_get_url(), urllib.parse.urlencode(params))
         try:
-            response = opener.open(request, timeout=4).read().decode('utf-8').replace('\n', '')
-        except urllib.error as e:
+            response = self.http.request('GET', url)[1].decode('utf-8').replace('\n', '')
+        except (OSError, http.client.HTTPException, ValueError) as e:
             response = str(e)
         if response == self.config.get_http_get_success_response():
             logging.info('Sent HTTP GET notification successfully')
-        else:
-            logging.error('Failed to send HTTP GET notification: {}'.format(response))
+            return True
+        logging.error('Failed to send HTTP GET notification: {}'.format(response))
+        return False
+
+    def close(self):
+        self.http.close()
@@ -1,28 +1,33 @@
+import http.client
 import json
 import logging
-import urllib.error
-import urllib.request
 
 import util
 from notifier import *
 
 
 class Slack(Notifier):
+    def __init__(self, config):
+        super().__init__(config)
+        self.http = util.PersistentHTTPConnection()
+
     def send(self, message, stream=None, status=None):
         if message is None:
-            return
+            return True
         params = {'channel': self.config.get_slack_channel(), 'text': message}
-        request = urllib.request.Request(
-            url=self.config.get_slack_webhook_url(),
-            data=json.dumps(params).encode('utf-8'),
-            headers={'content-type': 'application/json'}
-        )
-        opener = urllib.request.build_opener(util.TolerantHTTPErrorProcessor)
         try:
-            response = opener.open(request, timeout=4).read().decode('utf-8')
-        except urllib.error as e:
+            response = self.http.request(
+                'POST', self.config.get_slack_webhook_url(),
+                body=json.dumps(params).encode('utf-8'),
+                headers={'content-type': 'application/json'},
+            )[1].decode('utf-8')
+        except (OSError, http.client.HTTPException, ValueError) as e:
             response = str(e)
         if response == 'ok':
             logging.info('Sent Slack message successfully')
-        else:
-            logging.error('Failed to send Slack message: {}'.format(response))
+            return True
+        logging.error('Failed to send Slack message: {}'.format(response))
+        return False
+
+    def close(self):
+        self.http.close()
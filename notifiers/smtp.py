@@ -6,38 +6,71 @@ from notifier import *
 
 
 class SMTP(Notifier):
+    def __init__(self, config):
+        super().__init__(config)
+        self.smtp = None
+        self.key = None
+        self.timeout = 10
+
+    def _settings(self):
+        return (
+            self.config.get_smtp_server(), self.config.get_smtp_port(), self.config.get_smtp_security(),
+            self.config.get_smtp_login(), self.config.get_smtp_password(),
+        )
+
+    def _connect(self):
+        server, port, security, login, password = self._settings()
+        if security == 'ssl':
+            smtp = smtplib.SMTP_SSL(server, port, timeout=self.timeout)
+        else:
+            smtp = smtplib.SMTP(server, port, timeout=self.timeout)
+        try:
+            if security == 'starttls':
+                smtp.starttls()
+            smtp.login(login, password)
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+            raise
+        return smtp
+
     def send(self, message, stream=None, status=None):
         if message is None:
-            return
-        server = self.config.get_smtp_server()
-        port = self.config.get_smtp_port()
+            return True
         login = self.config.get_smtp_login()
-        password = self.config.get_smtp_password()
         subject = self.config.get_smtp_subject()
         recipient = self.config.get_smtp_recipient()
-        security = self.config.get_smtp_security()
-        if security != 'ssl' and security != 'starttls':
-            security = None
 
         message = MIMEText(message)
         message['Subject'] = subject
         message['From'] = login
         message['To'] = recipient
 
-        try:
-            if security == 'starttls':
-                with smtplib.SMTP(server, port) as smtp:
-                    smtp.starttls()
-                    smtp.login(login, password)
-                    smtp.send_message(message)
-            elif security == 'ssl':
-                with smtplib.SMTP_SSL(server, port) as smtp:
-                    smtp.login(login, password)
-                    smtp.send_message(message)
-            else:
-                with smtplib.SMTP(server, port) as smtp:
-                    smtp.login(login, password)
-                    smtp.send_message(message)
-            logging.info('Sent Email successfully')
-        except smtplib.SMTPException as e:
-            logging.error('Failed to send Email: {}'.format(str(e)))
+        if self.key != self._settings():
+            self.close()
+            self.key = self._settings()
+        while True:
+            # the session is kept open between messages, a fresh one is opened when the server dropped it
+            reused = self.smtp is not None
+            try:
+                if not reused:
+                    self.smtp = self._connect()
+                self.smtp.send_message(message)
+                logging.info('Sent Email successfully')
+                return True
+            except smtplib.SMTPServerDisconnected as e:
+                self.close()
+                if not reused:
+                    logging.error('Failed to send Email: {}'.format(str(e)))
+                    return False
+            except (smtplib.SMTPException, OSError) as e:
+                self.close()
+                logging.error('Failed to send Email: {}'.format(str(e)))
+                return False
+
+    def close(self):
+        if self.smtp:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self.smtp.close()
+            self.smtp = None
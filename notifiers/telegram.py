@@ -1,35 +1,40 @@
+import http.client
 import json
 import logging
-import urllib.error
-import urllib.request
 
 import util
 from notifier import *
 
 
 class Telegram(Notifier):
+    def __init__(self, config):
+        super().__init__(config)
+        self.http = util.PersistentHTTPConnection()
+
     def send(self, message, stream=None, status=None):
         if message is None:
-            return
+            return True
         url = 'https://api.telegram.org/bot{}/sendMessage'.format(self.config.get_telegram_api_key())
         params = {'chat_id': self.config.get_telegram_chat_id(), 'text': message}
-        request = urllib.request.Request(
-            url=url,
-            data=json.dumps(params).encode('utf-8'),
-            headers={'content-type': 'application/json'},
-        )
-        opener = urllib.request.build_opener(util.TolerantHTTPErrorProcessor)
         try:
-            response = json.loads(opener.open(request, timeout=4).read().decode('utf-8'))
-        except urllib.error as e:
+            response = json.loads(self.http.request(
+                'POST', url,
+                body=json.dumps(params).encode('utf-8'),
+                headers={'content-type': 'application/json'},
+            )[1].decode('utf-8'))
+        except (OSError, http.client.HTTPException, ValueError) as e:
             logging.error('Failed to send Telegram message: {}'.format(str(e)))
-            return
-        if response['ok']:
+            return False
+        if response.get('ok'):
             logging.info('Sent Telegram message successfully')
             if (
                     not self.config.get_telegram_chat_id().lstrip('-').isnumeric()
                     and self.config.get_telegram_convert_chat_id()
             ):
                 self.config.set_telegram_chat_id(response['result']['chat']['id'])
-        else:
-            logging.error('Failed to send Telegram message: {}'.format(response['description']))
+            return True
+        logging.error('Failed to send Telegram message: {}'.format(response.get('description')))
+        return False
+
+    def close(self):
+        self.http.close()
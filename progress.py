@@ -0,0 +1,143 @@
+import collections
+import logging
+import os
+import selectors
+import threading
+import time
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def _parse_number(value, suffix=''):
+    value = value.strip()
+    if suffix and value.endswith(suffix):
+        value = value[:-len(suffix)]
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def process_usage(pid):
+    try:
+        with open('/proc/{:d}/stat'.format(pid)) as f:
+            # the command name may contain spaces, fields are counted after its closing bracket
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/{:d}/statm'.format(pid)) as f:
+            rss_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    return cpu_seconds, rss_pages * PAGE_SIZE
+
+
+class Progress:
+    def __init__(self, size=60):
+        self.samples = collections.deque(maxlen=size)
+        self.block = {}
+        self.updated = None
+        self.advanced = None
+
+    def feed(self, line):
+        key, _, value = line.partition('=')
+        key = key.strip()
+        if key != 'progress':
+            self.block[key] = value.strip()
+            return
+        block, self.block = self.block, {}
+        now = time.monotonic()
+        out_time_us = _parse_number(block.get('out_time_us', block.get('out_time_ms', 'N/A')))
+        sample = (
+            now,
+            _parse_number(block.get('fps', 'N/A')),
+            _parse_number(block.get('bitrate', 'N/A'), 'kbits/s'),
+            _parse_number(block.get('total_size', 'N/A')),
+            out_time_us,
+            _parse_number(block.get('dup_frames', 'N/A')),
+            _parse_number(block.get('drop_frames', 'N/A')),
+            _parse_number(block.get('speed', 'N/A'), 'x'),
+        )
+        previous = self.samples[-1] if self.samples else None
+        if out_time_us is not None and (previous is None or previous[4] is None or out_time_us > previous[4]):
+            self.advanced = now
+        self.samples.append(sample)
+        self.updated = now
+
+    def latest(self):
+        if not self.samples:
+            return None
+        now, fps, bitrate, total_size, out_time_us, dup_frames, drop_frames, speed = self.samples[-1]
+        return {
+            'fps': fps,
+            'bitrate_kbps': bitrate,
+            'total_size': total_size,
+            'out_time': out_time_us / 1000000 if out_time_us is not None else None,
+            'dup_frames': dup_frames,
+            'drop_frames': drop_frames,
+            'speed': speed,
+            'age': time.monotonic() - self.advanced if self.advanced is not None else None,
+        }
+
+
+class ProgressReader:
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.wake_read_fd, self.wake_write_fd = os.pipe()
+        os.set_blocking(self.wake_read_fd, False)
+        self.selector.register(self.wake_read_fd, selectors.EVENT_READ)
+        self.pending = []
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def register(self, pipe, progress):
+        os.set_blocking(pipe.fileno(), False)
+        with self.lock:
+            self.pending.append((pipe, progress))
+        os.write(self.wake_write_fd, b'\0')
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='progress')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        os.write(self.wake_write_fd, b'\0')
+
+    def _read(self, key):
+        pipe, progress, buffer = key.data
+        try:
+            data = os.read(pipe.fileno(), 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.selector.unregister(pipe)
+            pipe.close()
+            return
+        lines = (buffer + data).split(b'\n')
+        for line in lines[:-1]:
+            progress.feed(line.decode('utf-8', 'replace'))
+        self.selector.modify(pipe, selectors.EVENT_READ, (pipe, progress, lines[-1]))
+
+    def _run(self):
+        while self.running:
+            for key, _ in self.selector.select():
+                if key.fd == self.wake_read_fd:
+                    try:
+                        os.read(self.wake_read_fd, 4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    self._read(key)
+                except Exception as e:
+                    logging.error('Failed to read FFmpeg progress: %s', e)
+            with self.lock:
+                pending, self.pending = self.pending, []
+            for pipe, progress in pending:
+                self.selector.register(pipe, selectors.EVENT_READ, (pipe, progress, b''))
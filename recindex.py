@@ -0,0 +1,380 @@
+import bisect
+import collections
+import datetime
+import heapq
+import itertools
+import logging
+import os
+import re
+import threading
+import time
+
+import inotify
+
+RECORDING_RE = re.compile(r'^([A-Za-z\d_-]+)_(\d+)\.mp4$')
+LATEST_SUFFIX = '_latest'
+
+
+def effective_end(start, next_start, closed, mtime):
+    # a closed segment ends when it was last written, an outage before the next segment stays a gap
+    if not closed or mtime is None:
+        return next_start
+    if next_start is None or start < mtime < next_start:
+        return mtime
+    return next_start
+
+
+class Segment:
+    __slots__ = ('stream', 'start', 'filename', 'size', 'closed', 'mtime')
+
+    def __init__(self, stream, start, filename, size=0, closed=True, mtime=None):
+        self.stream = stream
+        self.start = start
+        self.filename = filename
+        self.size = size
+        self.closed = closed
+        self.mtime = mtime
+
+    def __lt__(self, other):
+        return (self.start, self.filename) < (other.start, other.filename)
+
+
+class RecordingIndex:
+    def __init__(self, rec_dir, date_fmt, rescan_interval=60):
+        self.rec_dir = os.path.realpath(rec_dir)
+        self.date_fmt = date_fmt
+        self.rescan_interval = rescan_interval
+        self.lock = threading.RLock()
+        self.streams = {}
+        self.segments = {}
+        self.stream_sizes = {}
+        self.total_size = 0
+        self.watcher = None
+        self.next_rescan = None
+
+    def _parse(self, filename):
+        match = RECORDING_RE.match(filename)
+        if not match:
+            return None
+        try:
+            start = datetime.datetime.strptime(match.group(2), self.date_fmt).timestamp()
+        except ValueError:
+            return None
+        return match.group(1), start
+
+    def _stat(self, filename):
+        try:
+            return os.stat(os.path.join(self.rec_dir, filename))
+        except FileNotFoundError:
+            return None
+
+    def start(self):
+        try:
+            self.watcher = inotify.Inotify()
+            self.watcher.add_watch(
+                self.rec_dir,
+                inotify.IN_CREATE | inotify.IN_CLOSE_WRITE | inotify.IN_DELETE
+                | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO,
+            )
+        except (OSError, AttributeError) as e:
+            logging.warning('inotify is unavailable (%s), rescanning %s every %d seconds', e, self.rec_dir,
+                            self.rescan_interval)
+            if self.watcher:
+                self.watcher.close()
+            self.watcher = None
+        self.scan()
+
+    def stop(self):
+        if self.watcher:
+            self.watcher.close()
+            self.watcher = None
+
+    def scan(self):
+        started = time.monotonic()
+        streams = {}
+        segments = {}
+        stream_sizes = {}
+        total_size = 0
+        latest_streams = []
+        with os.scandir(self.rec_dir) as it:
+            for entry in it:
+                if entry.name.endswith(LATEST_SUFFIX):
+                    latest_streams.append(entry.name[:-len(LATEST_SUFFIX)])
+                    continue
+                parsed = self._parse(entry.name)
+                if not parsed:
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                size = stat.st_size
+                segment = Segment(parsed[0], parsed[1], entry.name, size, mtime=stat.st_mtime)
+                streams.setdefault(segment.stream, []).append(segment)
+                segments[entry.name] = segment
+                stream_sizes[segment.stream] = stream_sizes.get(segment.stream, 0) + size
+                total_size += size
+        with self.lock:
+            self.streams = {name: collections.deque(sorted(items)) for name, items in streams.items()}
+            self.segments = segments
+            self.stream_sizes = stream_sizes
+            self.total_size = total_size
+        self.next_rescan = time.monotonic() + self.rescan_interval
+        logging.info(
+            'Indexed %d recordings of %d streams in %.3f s',
+            len(segments), len(streams), time.monotonic() - started,
+        )
+        self.remove_stale_latest_files(latest_streams)
+
+    def refresh(self):
+        if not self.watcher:
+            if time.monotonic() >= self.next_rescan:
+                self.scan()
+            return
+        removed_streams = set()
+        for _, mask, _, name in self.watcher.read_events():
+            if mask & inotify.IN_Q_OVERFLOW:
+                logging.warning('inotify queue overflow, rescanning %s', self.rec_dir)
+                self.scan()
+                continue
+            if mask & inotify.IN_ISDIR:
+                continue
+            if mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                segment = self.remove(name)
+                if segment:
+                    removed_streams.add(segment.stream)
+            elif mask & inotify.IN_CREATE:
+                self.add(name, closed=False)
+            elif mask & (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO):
+                self.add(name)
+        if removed_streams:
+            self.remove_stale_latest_files(removed_streams)
+
+    def add(self, filename, closed=True):
+        parsed = self._parse(filename)
+        if not parsed:
+            return None
+        stat = self._stat(filename)
+        if stat is None:
+            return None
+        size = stat.st_size
+        with self.lock:
+            segment = self.segments.get(filename)
+            if segment:
+                self.stream_sizes[segment.stream] += size - segment.size
+                self.total_size += size - segment.size
+                segment.size = size
+                segment.closed = closed
+                segment.mtime = stat.st_mtime
+                return segment
+            segment = Segment(parsed[0], parsed[1], filename, size, closed, stat.st_mtime)
+            segments = self.streams.setdefault(segment.stream, collections.deque())
+            if not segments or not segment < segments[-1]:
+                segments.append(segment)
+            else:
+                bisect.insort(segments, segment)
+            self.segments[filename] = segment
+            self.stream_sizes[segment.stream] = self.stream_sizes.get(segment.stream, 0) + size
+            self.total_size += size
+            return segment
+
+    def remove(self, filename):
+        with self.lock:
+            segment = self.segments.pop(filename, None)
+            if not segment:
+                return None
+            segments = self.streams[segment.stream]
+            if segments[0] is segment:
+                segments.popleft()
+            else:
+                segments.remove(segment)
+            if not segments:
+                del self.streams[segment.stream]
+                del self.stream_sizes[segment.stream]
+            else:
+                self.stream_sizes[segment.stream] -= segment.size
+            self.total_size -= segment.size
+            return segment
+
+    def oldest(self):
+        with self.lock:
+            oldest = None
+            for segments in self.streams.values():
+                if oldest is None or segments[0] < oldest:
+                    oldest = segments[0]
+            return oldest
+
+    def expired(self, cutoff):
+        result = []
+        with self.lock:
+            for segments in self.streams.values():
+                for segment in segments:
+                    if segment.start >= cutoff:
+                        break
+                    result.append(segment)
+        return result
+
+    def _stream_iterators(self):
+        # the segments of every stream, oldest first
+        return [(name, iter(segments)) for name, segments in self.streams.items()]
+
+    def select_oldest(self, size, weights=None):
+        # a stream weight of 2 makes its recordings age half as fast, so they are evicted later
+        now = time.time()
+
+        def key(segment_):
+            weight = weights.get(segment_.stream, 1) if weights else 1
+            return now - (now - segment_.start) / weight
+
+        result = []
+        selected_size = 0
+        with self.lock:
+            heap = []
+            for name, it in self._stream_iterators():
+                segment = next(it, None)
+                if segment:
+                    heap.append((key(segment), name, segment, it))
+            heapq.heapify(heap)
+            while heap and selected_size < size:
+                _, name, segment, it = heapq.heappop(heap)
+                # the file being written frees no space until ffmpeg closes it
+                if segment.closed:
+                    result.append(segment)
+                    selected_size += segment.size
+                segment = next(it, None)
+                if segment:
+                    heapq.heappush(heap, (key(segment), name, segment, it))
+        return result
+
+    def over_quota(self, quotas):
+        result = []
+        with self.lock:
+            for name, quota in quotas.items():
+                excess = self.stream_sizes.get(name, 0) - quota
+                if not quota or excess <= 0:
+                    continue
+                segments = self.streams[name]
+                # always keep the newest segment
+                for i in range(len(segments) - 1):
+                    if excess <= 0:
+                        break
+                    result.append(segments[i])
+                    excess -= segments[i].size
+        return result
+
+    def parse_cursor(self, filename):
+        parsed = self._parse(filename)
+        if not parsed:
+            return None
+        return Segment(parsed[0], parsed[1], filename)
+
+    def query(self, stream=None, start=None, end=None, after=None, limit=100):
+        def with_end(segments_, lo):
+            previous = None
+            for segment_ in itertools.islice(segments_, lo, None):
+                if previous is not None:
+                    yield previous, effective_end(previous.start, segment_.start, previous.closed, previous.mtime)
+                if end is not None and segment_.start >= end:
+                    return
+                previous = segment_
+            if previous is not None:
+                yield previous, effective_end(previous.start, None, previous.closed, previous.mtime)
+
+        items = []
+        has_more = False
+        with self.lock:
+            names = [stream] if stream is not None else sorted(self.streams)
+            iterators = []
+            for name in names:
+                segments = self.streams.get(name)
+                if not segments:
+                    continue
+                lo = 0
+                if start is not None:
+                    # include the segment that covers the start of the range
+                    lo = max(bisect.bisect_left(segments, Segment(name, start, '')) - 1, 0)
+                if after is not None:
+                    lo = max(lo, bisect.bisect_right(segments, after))
+                iterators.append(with_end(segments, lo))
+            for segment, segment_end in heapq.merge(*iterators, key=lambda item: item[0]):
+                if start is not None and segment_end is not None and segment_end <= start:
+                    continue
+                if len(items) >= limit:
+                    has_more = True
+                    break
+                items.append((segment, segment_end, segment.size, segment.closed))
+        result = []
+        for segment, segment_end, size, closed in items:
+            result.append({
+                'stream': segment.stream,
+                'filename': segment.filename,
+                'start': int(segment.start),
+                'end': int(segment_end) if segment_end is not None else None,
+                'duration': int(segment_end - segment.start) if segment_end is not None else None,
+                'size': size,
+                'closed': closed,
+            })
+        return result, items[-1][0].filename if has_more else None
+
+    def summary(self):
+        result = []
+        with self.lock:
+            for name in sorted(self.streams):
+                segments = self.streams[name]
+                result.append({
+                    'stream': name,
+                    'count': len(segments),
+                    'size': self.stream_sizes[name],
+                    'first': int(segments[0].start),
+                    'last': int(segments[-1].start),
+                })
+        return result
+
+    def newest(self, stream):
+        with self.lock:
+            segments = self.streams.get(stream)
+            return segments[-1] if segments else None
+
+    def contains(self, filename):
+        with self.lock:
+            return filename in self.segments
+
+    def get(self, filename):
+        with self.lock:
+            return self.segments.get(filename)
+
+    def get_stream_names(self):
+        with self.lock:
+            return list(self.streams)
+
+    def get_segments(self, stream):
+        with self.lock:
+            return list(self.streams.get(stream, ()))
+
+    def get_size(self, stream=None):
+        if stream is not None:
+            return self.stream_sizes.get(stream, 0)
+        return self.total_size
+
+    def delete(self, segment):
+        try:
+            os.remove(os.path.join(self.rec_dir, segment.filename))
+        except FileNotFoundError:
+            pass
+        self.remove(segment.filename)
+
+    def remove_stale_latest_files(self, streams):
+        for stream in streams:
+            latest_file = os.path.join(self.rec_dir, '{}{}'.format(stream, LATEST_SUFFIX))
+            try:
+                with open(latest_file) as f:
+                    rec_filename = f.readline().strip()
+            except FileNotFoundError:
+                continue
+            if self.contains(rec_filename):
+                continue
+            logging.info('Removing stale %s', os.path.basename(latest_file))
+            try:
+                os.remove(latest_file)
+            except FileNotFoundError:
+                pass
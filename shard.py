@@ -0,0 +1,254 @@
+import logging
+import multiprocessing
+import os
+import signal
+import time
+import zlib
+
+import config
+import progress
+import supervisor
+import util
+
+
+def shard_of(name, count):
+    return zlib.crc32(name.encode('utf-8')) % count
+
+
+class RemoteProgress:
+    def __init__(self, latest):
+        self._latest = latest
+
+    def latest(self):
+        return self._latest
+
+
+# stands in for an FFmpeg instance owned by a worker process, built from its status reports
+class RemoteStream:
+    def __init__(self, name, report):
+        self.name = name
+        self.started, self.exit_status, latest, self._pids = report
+        self.progress = RemoteProgress(latest)
+
+    def status(self):
+        return self.started, self.exit_status
+
+    def pids(self):
+        return self._pids
+
+    def stop(self):
+        # the owning worker stops the stream once it sees the stream table change
+        return None
+
+
+class Worker:
+    def __init__(self, index, count, conn, streams_version):
+        self.index = index
+        self.count = count
+        self.conn = conn
+        # version of the coordinator's stream table this worker has loaded
+        self.streams_version = streams_version
+        self.running = False
+        self.threads = {}
+        self.waker = util.Waker()
+        self.report_interval = 1
+
+    def _notify(self, message, stream=None, status=None):
+        self.conn.send(('notify', message, stream, status))
+
+    def _report(self):
+        report = {}
+        for name, thread in self.threads.items():
+            started, status = thread.status()
+            latest = thread.progress.latest() if thread.progress else None
+            report[name] = (started, status, latest, thread.pids())
+        # processes being stopped are no longer in the report, but their stream's files are still written
+        self.conn.send(('status', report, self.supervisor.process_names(), self.streams_version))
+
+    def _handle(self):
+        while self.conn.poll():
+            try:
+                message = self.conn.recv()
+            except EOFError:
+                logging.error('Coordinator went away, stopping')
+                self.running = False
+                return
+            if message[0] == 'reload':
+                self.config.reload()
+                self.config.reload_streams()
+                self.streams_version = message[1]
+            elif message[0] == 'stop':
+                self.running = False
+
+    def run(self):
+        # ffmpeg children join this group so the coordinator can clean them up if the worker dies
+        os.setpgrp()
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGCHLD, lambda signum, frame: self.waker.wake())
+        self.config = config.Config(read_only=True)
+        progress_reader = progress.ProgressReader()
+        progress_reader.start()
+        self.supervisor = supervisor.Supervisor(
+            self.config, self.threads, self._notify,
+            progress_reader=progress_reader,
+            stream_filter=lambda name: shard_of(name, self.count) == self.index,
+        )
+        self.waker.register(self.conn)
+        self.running = True
+        next_report = time.monotonic()
+        while self.running:
+            now = time.monotonic()
+            self.supervisor.check(now)
+            if now >= next_report:
+                self._report()
+                next_report = now + self.report_interval
+            deadline = next_report
+            supervisor_deadline = self.supervisor.next_deadline()
+            if supervisor_deadline is not None:
+                deadline = min(deadline, supervisor_deadline)
+            if self.waker.wait(deadline - time.monotonic()):
+                self._handle()
+        self.supervisor.stop()
+        progress_reader.stop()
+        return 0
+
+    def stop(self):
+        self.running = False
+        self.waker.wake()
+
+
+def worker_main(index, count, conn, streams_version):
+    util.configure_logging('[worker {:d}] '.format(index))
+    try:
+        exit(Worker(index, count, conn, streams_version).run())
+    except Exception as e:
+        logging.critical(e or e.__class__.__name__)
+        raise
+
+
+class ShardManager:
+    def __init__(self, config, count, threads, notify, waker):
+        self.config = config
+        self.count = count
+        self.threads = threads
+        self.notify = notify
+        self.waker = waker
+        self.context = multiprocessing.get_context('spawn')
+        self.processes = [None] * count
+        self.conns = [None] * count
+        self.restart_at = [None] * count
+        self.streams = [{} for _ in range(count)]
+        self.process_names = [frozenset() for _ in range(count)]
+        self.applied_versions = [None] * count
+        self.streams_version = None
+        self.restart_delay = 1
+        self.process_tracker = supervisor.ProcessTracker()
+
+    def _start_worker(self, index):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=worker_main, args=(index, self.count, child_conn, self.config.streams_version),
+            name='worker-{:d}'.format(index),
+        )
+        process.start()
+        child_conn.close()
+        logging.info('Started worker %d (pid %d)', index, process.pid)
+        self.processes[index] = process
+        self.conns[index] = parent_conn
+        self.restart_at[index] = None
+        self.waker.register(parent_conn)
+
+    def _cleanup_worker(self, index):
+        process = self.processes[index]
+        self.waker.unregister(self.conns[index])
+        self.conns[index].close()
+        self.conns[index] = None
+        self.processes[index] = None
+        # orphaned ffmpeg processes of the dead worker
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            pass
+        process.join(0)
+        for name in self.streams[index]:
+            self.threads.pop(name, None)
+        self.streams[index] = {}
+        # the FFmpeg processes of a dead worker were killed along with it
+        self.process_names[index] = frozenset()
+        self.applied_versions[index] = None
+        self._publish_processes()
+
+    def _publish_processes(self):
+        versions = [self.applied_versions[index] for index, process in enumerate(self.processes) if process]
+        if None in versions:
+            version = None
+        else:
+            version = min(versions, default=self.config.streams_version)
+        self.process_tracker.publish(version, frozenset().union(*self.process_names))
+
+    def _update_streams(self, index, report):
+        for name in self.streams[index]:
+            if name not in report:
+                self.threads.pop(name, None)
+        self.streams[index] = report
+        for name, item in report.items():
+            self.threads[name] = RemoteStream(name, item)
+
+    def start(self):
+        self.streams_version = self.config.streams_version
+        for index in range(self.count):
+            self._start_worker(index)
+
+    def handle(self, conns):
+        for conn in conns:
+            index = self.conns.index(conn)
+            try:
+                while conn.poll():
+                    message = conn.recv()
+                    if message[0] == 'notify':
+                        self.notify(*message[1:])
+                    elif message[0] == 'status':
+                        self._update_streams(index, message[1])
+                        self.process_names[index] = message[2]
+                        self.applied_versions[index] = message[3]
+                        self._publish_processes()
+            except (EOFError, OSError):
+                # the worker exited, check() restarts it
+                pass
+
+    def check(self, now):
+        if self.streams_version != self.config.streams_version:
+            self.streams_version = self.config.streams_version
+            self.broadcast(('reload', self.streams_version))
+        for index, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                logging.error('Worker %d exited with status %s, restarting', index, process.exitcode)
+                self.notify('Worker {:d} exited'.format(index))
+                self._cleanup_worker(index)
+                self.restart_at[index] = now + self.restart_delay
+            if process is None and self.restart_at[index] is not None and self.restart_at[index] <= now:
+                self._start_worker(index)
+
+    def next_deadline(self):
+        deadlines = [deadline for deadline in self.restart_at if deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    def broadcast(self, message):
+        for conn in self.conns:
+            if conn is not None:
+                try:
+                    conn.send(message)
+                except (BrokenPipeError, OSError):
+                    pass
+
+    def stop(self):
+        self.broadcast(('stop',))
+        timeout = self.config.get_ffmpeg_stop_timeout() + 5
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                logging.warning('Worker %d did not stop, killing', index)
+            self._cleanup_worker(index)
@@ -0,0 +1,115 @@
+import collections
+import logging
+import os
+import subprocess
+import threading
+import time
+
+import ffmpeg
+
+
+class SnapshotCache:
+    def __init__(self, config, recordings, live_store=None):
+        self.config = config
+        self.recordings = recordings
+        self.live_store = live_store
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stream_locks = collections.defaultdict(threading.Lock)
+        self.timeout = 10
+
+    def _latest_live_segment(self, name):
+        playlist = os.path.join(self.config.get_live_dir(), '{}.m3u8'.format(name))
+        init = None
+        lines = []
+        try:
+            with open(playlist) as f:
+                for line in f:
+                    line = line.strip()
+                    if line.startswith('#EXT-X-MAP:URI="'):
+                        init = line[len('#EXT-X-MAP:URI="'):].split('"', 1)[0]
+                    elif line and not line.startswith('#'):
+                        lines.append(line)
+        except FileNotFoundError:
+            return None
+        if not lines:
+            return None
+        segment = os.path.join(self.config.get_live_dir(), os.path.basename(lines[-1]))
+        if init:
+            # fMP4 segments can only be decoded together with the initialization segment
+            return 'concat:{}|{}'.format(os.path.join(self.config.get_live_dir(), os.path.basename(init)), segment)
+        return segment
+
+    def _latest_recordings(self, name):
+        # the segment being written goes first, the newest closed one can be a whole segment_duration old
+        segments = self.recordings.get_segments(name)
+        paths = []
+        if segments and not segments[-1].closed:
+            paths.append(os.path.join(self.recordings.rec_dir, segments[-1].filename))
+        closed = next((segment for segment in reversed(segments) if segment.closed), None)
+        if closed:
+            paths.append(os.path.join(self.recordings.rec_dir, closed.filename))
+        return paths
+
+    def _capture(self, name):
+        sources = []
+        live_data = self.live_store.latest_segment(name) if self.live_store else None
+        if live_data:
+            # the uploaded segment only exists in memory and is fed through stdin
+            sources.append(('pipe:0', None, live_data))
+        else:
+            live_segment = self._latest_live_segment(name)
+            if live_segment:
+                sources.append((live_segment, None, None))
+        for recording in self._latest_recordings(name):
+            sources.append((recording, 10, None))
+        for path, from_end, data in sources:
+            cmd = ffmpeg.snapshot_cmd(self.config.get_ffmpeg_bin(), path, from_end)
+            try:
+                result = subprocess.run(
+                    cmd, input=data, stdin=subprocess.DEVNULL if data is None else None, stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL, timeout=self.timeout,
+                )
+            except subprocess.TimeoutExpired:
+                logging.warning('Timed out taking a snapshot of %s from %s', name, path)
+                continue
+            if result.returncode == 0 and result.stdout:
+                return result.stdout
+        return None
+
+    def _get_cached(self, name, now):
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry and now - entry[0] < self.config.get_snapshot_ttl():
+                self.entries.move_to_end(name)
+                return entry
+        return None
+
+    def _put(self, name, created, data):
+        max_size = self.config.get_snapshot_cache_mb() * 1000000
+        with self.lock:
+            old = self.entries.pop(name, None)
+            if old:
+                self.size -= len(old[1])
+            self.entries[name] = (created, data)
+            self.size += len(data)
+            while self.size > max_size and self.entries:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def get(self, name):
+        entry = self._get_cached(name, time.monotonic())
+        if entry:
+            return entry
+        # concurrent viewers of the same stream wait for a single capture
+        with self.stream_locks[name]:
+            now = time.monotonic()
+            entry = self._get_cached(name, now)
+            if entry:
+                return entry
+            data = self._capture(name)
+            if not data:
+                return None
+            self._put(name, now, data)
+            return now, data
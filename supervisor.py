@@ -0,0 +1,382 @@
+import logging
+import os
+import threading
+import time
+
+import ffmpeg
+import util
+
+
+class StreamState:
+    def __init__(self, backoff):
+        self.started_at = None
+        self.restart_at = None
+        self.backoff = backoff
+        self.running_ok = False
+        self.failed_since = None
+        self.failure_notified = False
+        self.output_marker = None
+        self.output_changed_at = None
+
+
+# the main loop publishes which streams still have a process, other threads wait for a stream to be gone
+class ProcessTracker:
+    def __init__(self):
+        self.version = None
+        self.names = frozenset()
+        self.condition = threading.Condition()
+
+    def publish(self, version, names):
+        with self.condition:
+            self.version = version
+            self.names = frozenset(names)
+            self.condition.notify_all()
+
+    def wait_stopped(self, name, version, timeout=None):
+        # version is the stream table version that no longer has the stream
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: self.version is not None and self.version >= version and name not in self.names, timeout,
+            )
+
+
+class Supervisor:
+    def __init__(
+            self, config, threads, notify, progress_reader=None, recordings=None, stream_filter=None, live_store=None,
+    ):
+        self.config = config
+        self.threads = threads
+        self.notify = notify
+        self.progress_reader = progress_reader
+        self.recordings = recordings
+        self.stream_filter = stream_filter
+        self.live_store = live_store
+        self.stall_check_interval = 1
+        self.next_stall_check = time.monotonic()
+        self.checked_at = 0
+        self.states = {}
+        self.retiring = []
+        self.stopping = []
+        # processes that still write the live output of a stream, its replacement starts once they have exited
+        self.live_writers = {}
+        self.handover_poll_interval = 0.2
+        self.streams_version = None
+        self.spawn_limiter = util.TokenBucket(config.get_ffmpeg_spawn_rate(), config.get_ffmpeg_spawn_burst())
+        self.spawn_blocked = False
+        self.process_tracker = ProcessTracker()
+
+    def _create_thread(self, stream):
+        live = None
+        rec = None
+        snap = None
+        if stream['live']:
+            live = self.config.get_live_dir()
+        if stream['rec']:
+            rec = self.config.get_rec_dir()
+        if 'snap' in stream and stream['snap'] is not None:
+            snap = stream['snap']
+        if stream['segment_offset'] == 'auto':
+            segment_offset = util.stagger_offset(stream['name'], stream['segment_duration'])
+        else:
+            segment_offset = stream['segment_offset'] % max(stream['segment_duration'], 1)
+        live_url = None
+        if live and self.config.get_live_store() == 'memory':
+            live_url = self.config.get_live_store_url()
+        cls = ffmpeg.Pipeline if stream['pipeline'] else ffmpeg.FFmpeg
+        return cls(
+            stream['name'], stream['source'],
+            ffmpeg_bin=self.config.get_ffmpeg_bin(),
+            live=live, rec=rec, snap=snap,
+            segment_duration=stream['segment_duration'],
+            segment_offset=segment_offset,
+            rec_format=stream['rec_format'],
+            stop_timeout=self.config.get_ffmpeg_stop_timeout(),
+            date_fmt=self.config.get_date_fmt(),
+            debug_output=self.config.get_ffmpeg_debug_output(),
+            progress_reader=self.progress_reader,
+            hls_time=stream['hls_time'],
+            hls_list_size=stream['hls_list_size'],
+            hls_segment_type=stream['hls_segment_type'],
+            live_url=live_url,
+        )
+
+    def _new_state(self):
+        return StreamState(util.Backoff(
+            self.config.get_ffmpeg_restart_min_delay(), self.config.get_ffmpeg_restart_max_delay(),
+        ))
+
+    def sync(self, now=None):
+        if self.streams_version == self.config.streams_version:
+            return
+        if now is None:
+            now = time.monotonic()
+        self.streams_version = self.config.streams_version
+        self.spawn_limiter.rate = self.config.get_ffmpeg_spawn_rate()
+        self.spawn_limiter.burst = self.config.get_ffmpeg_spawn_burst()
+        active_stream_names = []
+        for stream in self.config.get_streams():
+            if stream is None or (self.stream_filter and not self.stream_filter(stream['name'])):
+                continue
+            name = stream['name']
+            active_stream_names.append(name)
+            thread = self._create_thread(stream)
+            if name not in self.threads:
+                self.threads[name] = thread
+                self.states[name] = self._new_state()
+                continue
+            old_thread = self.threads[name]
+            if thread.signature() == old_thread.signature():
+                if isinstance(old_thread, ffmpeg.Pipeline):
+                    # snapshots are a separate consumer in pipeline mode and can be toggled on the fly
+                    snap = old_thread.set_snap(stream['snap'])
+                    if snap:
+                        self._terminate(snap, now)
+                continue
+            started, status = old_thread.status()
+            if started and status is None and old_thread.live and not isinstance(old_thread, ffmpeg.Pipeline):
+                # both processes would write the same playlist and segments, the new one waits for the old to exit
+                logging.info('FFmpeg command of stream %s changed, restarting the running process', name)
+                self._terminate(old_thread, now)
+                self.live_writers[name] = old_thread
+            elif started and status is None:
+                # make before break: the old process keeps recording until the new one produces output
+                logging.info('FFmpeg command of stream %s changed, replacing the running process', name)
+                if old_thread.live:
+                    # only the recording overlaps, the old live consumer is stopped before the new pipeline starts
+                    live = old_thread.detach_live()
+                    self._terminate(live, now)
+                    self.live_writers[name] = live
+                self.retiring.append((old_thread, thread, now + self.config.get_ffmpeg_start_timeout()))
+            else:
+                logging.info('FFmpeg command of stream %s changed', name)
+                self._terminate(old_thread, now)
+            self.threads[name] = thread
+            self.states[name] = self._new_state()
+
+        for name in [name for name in self.threads if name not in active_stream_names]:
+            self._terminate(self.threads[name], now)
+            if self.threads[name].live:
+                self.live_writers[name] = self.threads[name]
+            del self.threads[name]
+            del self.states[name]
+
+    def check_retiring(self, now):
+        retiring = []
+        for old_thread, thread, deadline in self.retiring:
+            started, status = thread.status()
+            progress = thread.progress
+            if not started:
+                # the replacement may wait for the old live output to stop, its start timeout has not begun
+                retiring.append((old_thread, thread, now + self.config.get_ffmpeg_start_timeout()))
+            elif (progress is not None and progress.advanced is not None) or status is not None or now >= deadline:
+                self._terminate(old_thread, now)
+            else:
+                retiring.append((old_thread, thread, deadline))
+        self.retiring = retiring
+
+    def _terminate(self, thread, now):
+        # processes are signalled and reaped later, so the loop never waits for them to exit
+        thread.terminate()
+        self.stopping.append((thread, now + self.config.get_ffmpeg_stop_timeout()))
+
+    def process_names(self):
+        names = set(self.threads)
+        names.update(thread.name for thread, _ in self.stopping)
+        names.update(old_thread.name for old_thread, _, _ in self.retiring)
+        names.update(self.live_writers)
+        return names
+
+    def _is_stopping(self, thread):
+        return any(stopping is thread for stopping, _ in self.stopping)
+
+    def check_stopping(self, now):
+        stopping = []
+        for thread, deadline in self.stopping:
+            if not thread.pids() or now >= deadline:
+                # returns immediately for exited processes, kills the others
+                thread.wait(now)
+                for name in [name for name, writer in self.live_writers.items() if writer is thread]:
+                    del self.live_writers[name]
+            else:
+                stopping.append((thread, deadline))
+        self.stopping = stopping
+
+    def _start(self, name, now):
+        self.threads[name].start()
+        self.states[name].started_at = now
+        self.states[name].restart_at = None
+        self.states[name].output_marker = self._output_marker(self.threads[name])
+        self.states[name].output_changed_at = now
+
+    def _live_tracked(self, thread):
+        # uploaded playlists are only visible to the process that owns the live store
+        return thread.live and (not thread.live_url or self.live_store is not None)
+
+    def _rec_tracked(self, thread):
+        # shard workers have no recording index, FFmpeg's own progress report shows whether output advances
+        return thread.rec and (self.recordings is not None or thread.progress is not None)
+
+    def _output_tracked(self, thread):
+        return self._live_tracked(thread) or self._rec_tracked(thread)
+
+    def _output_advanced(self, thread, state):
+        if not self.config.get_stream_stall_timeout() or not self._output_tracked(thread):
+            return True
+        return state.output_changed_at > state.started_at
+
+    def _output_marker(self, thread):
+        rec_segment = None
+        rec_size = None
+        rec_advanced = None
+        playlist_mtime = None
+        if thread.rec and self.recordings:
+            segment = self.recordings.newest(thread.name)
+            if segment:
+                rec_segment = segment.filename
+                try:
+                    rec_size = os.stat(os.path.join(thread.rec, rec_segment)).st_size
+                except FileNotFoundError:
+                    pass
+        elif thread.rec and thread.progress is not None:
+            rec_advanced = thread.progress.advanced
+        if thread.live_url and self.live_store is not None:
+            playlist_mtime = self.live_store.playlist_marker(thread.name)
+        elif thread.live and not thread.live_url:
+            try:
+                playlist_mtime = os.stat(os.path.join(thread.live, '{}.m3u8'.format(thread.name))).st_mtime_ns
+            except FileNotFoundError:
+                pass
+        return rec_segment, rec_size, rec_advanced, playlist_mtime
+
+    def check_stalls(self, now):
+        stall_timeout = self.config.get_stream_stall_timeout()
+        if not stall_timeout:
+            return
+        for name, thread in self.threads.items():
+            state = self.states[name]
+            started, status = thread.status()
+            if not started or status is not None or not self._output_tracked(thread) or self._is_stopping(thread):
+                continue
+            marker = self._output_marker(thread)
+            if marker != state.output_marker:
+                state.output_marker = marker
+                state.output_changed_at = now
+            elif now - state.output_changed_at >= stall_timeout:
+                logging.warning('Output of stream %s stalled for %d seconds, restarting', name, stall_timeout)
+                self._terminate(thread, now)
+
+    def check(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        self.checked_at = now
+        self.sync(now)
+        if self.stopping:
+            self.check_stopping(now)
+        if self.retiring:
+            self.check_retiring(now)
+        if now >= self.next_stall_check:
+            self.check_stalls(now)
+            self.next_stall_check = now + self.stall_check_interval
+        start_timeout = self.config.get_ffmpeg_start_timeout()
+        down_timeout = self.config.get_stream_down_timeout()
+        due = []
+        for name, thread in self.threads.items():
+            # a stalled process is restarted only after it has been reaped
+            if self.stopping and self._is_stopping(thread) or name in self.live_writers:
+                continue
+            state = self.states[name]
+            started, status = thread.status()
+            if not started:
+                if state.restart_at is None:
+                    state.restart_at = now
+                if state.restart_at <= now:
+                    due.append(name)
+            # failed
+            elif status is not None:
+                if state.restart_at is None:
+                    state.running_ok = False
+                    if state.failed_since is None:
+                        logging.warning('FFmpeg for stream %s exited with status %d, restarting', name, status)
+                        state.failed_since = now
+                    delay = state.backoff.next_delay()
+                    logging.debug('Restarting FFmpeg for %s in %.1f s', name, delay)
+                    state.restart_at = now + delay
+                if state.restart_at <= now:
+                    due.append(name)
+            # running, and producing output unless stall detection is disabled
+            elif now - state.started_at >= start_timeout and self._output_advanced(thread, state):
+                state.backoff.reset()
+                if state.failed_since is not None:
+                    logging.info('FFmpeg for stream %s restored', name)
+                    if state.failure_notified:
+                        self.notify('Stream {} restored'.format(name), name, True)
+                    state.failed_since = None
+                    state.failure_notified = False
+                    state.running_ok = True
+                elif not state.running_ok:
+                    logging.info('FFmpeg for stream %s started successfully', name)
+                    self.notify(None, name, True)
+                    state.running_ok = True
+
+            if (
+                    state.failed_since is not None
+                    and not state.failure_notified
+                    and now - state.failed_since >= down_timeout
+            ):
+                self.notify('Stream {} failed'.format(name), name, False)
+                state.failure_notified = True
+
+        # the longest waiting streams go first when spawns are rate limited
+        due.sort(key=lambda name_: self.states[name_].restart_at)
+        self.spawn_blocked = False
+        for name in due:
+            if not self.spawn_limiter.consume(now):
+                self.spawn_blocked = True
+                break
+            if not self.threads[name].status()[0]:
+                logging.info('Starting FFmpeg for %s', name)
+            self._start(name, now)
+        self.process_tracker.publish(self.streams_version, self.process_names())
+
+    def handle(self, ready):
+        # only the ShardManager registers connections with the main loop's waker
+        pass
+
+    def next_deadline(self):
+        start_timeout = self.config.get_ffmpeg_start_timeout()
+        down_timeout = self.config.get_stream_down_timeout()
+        deadline = None
+        if self.spawn_blocked:
+            deadline = self.spawn_limiter.next_available()
+        if self.retiring or self.live_writers:
+            # neither progress of the replacement processes nor the exit of old ones wakes the loop up
+            candidate = time.monotonic() + self.handover_poll_interval
+            if deadline is None or candidate < deadline:
+                deadline = candidate
+        for _, candidate in self.stopping:
+            if deadline is None or candidate < deadline:
+                deadline = candidate
+        if self.config.get_stream_stall_timeout() and (deadline is None or self.next_stall_check < deadline):
+            deadline = self.next_stall_check
+        for state in self.states.values():
+            candidates = []
+            if state.restart_at is not None:
+                candidates.append(state.restart_at)
+            elif state.started_at is not None and not state.running_ok:
+                candidates.append(state.started_at + start_timeout)
+            if state.failed_since is not None and not state.failure_notified:
+                candidates.append(state.failed_since + down_timeout)
+            for candidate in candidates:
+                # already due at the last check: it waits for output (seen by the stall check) or a spawn token
+                if candidate <= self.checked_at:
+                    continue
+                if deadline is None or candidate < deadline:
+                    deadline = candidate
+        return deadline
+
+    def stop(self):
+        threads = [thread for thread, _ in self.stopping] + [old_thread for old_thread, _, _ in self.retiring]
+        threads += list(self.threads.values())
+        self.stopping = []
+        self.retiring = []
+        ffmpeg.stop_all(threads, self.config.get_ffmpeg_stop_timeout())
@@ -0,0 +1,252 @@
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+import cluster
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# stands in for FFmpeg: logs the source it was started for and runs until it is stopped or its node dies
+FAKE_FFMPEG = textwrap.dedent('''\
+    #!{python}
+    import os, signal, sys, time
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with open(os.environ['FAKE_FFMPEG_LOG'], 'a') as f:
+        f.write(sys.argv[sys.argv.index('-i') + 1] + '\\n')
+    parent = os.getppid()
+    while os.getppid() == parent:
+        time.sleep(0.1)
+''')
+
+HEARTBEAT_INTERVAL = 0.2
+NODE_TIMEOUT = 1.5
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        result = predicate()
+        if result or time.monotonic() >= deadline:
+            return result
+        time.sleep(0.05)
+
+
+class Node:
+    def __init__(self, directory, node_id, registry, ffmpeg_bin, weight=1, streams=''):
+        self.node_id = node_id
+        self.port = free_port()
+        self.url = 'http://127.0.0.1:{:d}'.format(self.port)
+        self.config_dir = os.path.join(directory, node_id)
+        self.ffmpeg_log = os.path.join(self.config_dir, 'ffmpeg.log')
+        for name in ('live', 'rec'):
+            os.makedirs(os.path.join(self.config_dir, name))
+        with open(os.path.join(self.config_dir, 'videoserver.ini'), 'w') as f:
+            f.write(textwrap.dedent('''\
+                [general]
+                ffmpeg_bin = {ffmpeg_bin}
+                live_dir = {dir}/live
+                rec_dir = {dir}/rec
+                [api]
+                http_port = {port:d}
+                [cluster]
+                enabled = true
+                registry = {registry}
+                node_id = {node_id}
+                heartbeat_interval = {heartbeat_interval}
+                node_timeout = {node_timeout}
+                weight = {weight:g}
+            ''').format(
+                ffmpeg_bin=ffmpeg_bin, dir=self.config_dir, port=self.port, registry=registry, node_id=node_id,
+                heartbeat_interval=HEARTBEAT_INTERVAL, node_timeout=NODE_TIMEOUT, weight=weight,
+            ))
+        with open(os.path.join(self.config_dir, 'streams.ini'), 'w') as f:
+            f.write(streams)
+        self.log = open(os.path.join(self.config_dir, 'videoserver.log'), 'w')
+        env = dict(os.environ, VIDEOSERVER_CONFIG_DIR=self.config_dir, FAKE_FFMPEG_LOG=self.ffmpeg_log)
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'main.py')], cwd=ROOT, env=env, stdout=self.log, stderr=self.log,
+        )
+
+    def request(self, method, path, body=None):
+        # answers the status and the decoded JSON body, also of error responses
+        request = urllib.request.Request(
+            self.url + path, method=method, data=json.dumps(body).encode('utf-8') if body is not None else None,
+            headers={'Content-Type': 'application/json'} if body is not None else {},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status, json.loads(response.read() or 'null')
+        except urllib.error.HTTPError as e:
+            with e:
+                return e.code, json.loads(e.read() or 'null')
+        except OSError:
+            return None, None
+
+    def streams(self):
+        status, result = self.request('GET', '/')
+        return {stream['name'] for stream in result if stream} if status == 200 else set()
+
+    def served(self, request_line):
+        with open(self.log.name) as f:
+            return request_line in f.read()
+
+    def started_sources(self):
+        try:
+            with open(self.ffmpeg_log) as f:
+                return f.read().split()
+        except FileNotFoundError:
+            return []
+
+    def stop(self, sig=signal.SIGTERM):
+        if self.process.poll() is None:
+            self.process.send_signal(sig)
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.log.close()
+
+
+class ClusterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        ffmpeg_bin = os.path.join(self.directory.name, 'ffmpeg')
+        with open(ffmpeg_bin, 'w') as f:
+            f.write(FAKE_FFMPEG.format(python=sys.executable))
+        os.chmod(ffmpeg_bin, 0o755)
+        registry = os.path.join(self.directory.name, 'registry.json')
+        self.nodes = [
+            Node(self.directory.name, 'node{:d}'.format(i), registry, ffmpeg_bin) for i in range(3)
+        ]
+        self.addCleanup(self._stop_nodes)
+        for node in self.nodes:
+            self.assertTrue(
+                wait_for(lambda: len(self._cluster_nodes(node)) == 3),
+                'node {} did not join the cluster'.format(node.node_id),
+            )
+
+    def _stop_nodes(self):
+        for node in self.nodes:
+            node.stop()
+        self.directory.cleanup()
+
+    def _cluster_nodes(self, node):
+        status, result = node.request('GET', '/:cluster')
+        return {item['id']: item for item in result['nodes']} if status == 200 else {}
+
+    def _owner(self, name, node_ids):
+        return pick_node(self.nodes, cluster.pick_owner(name, {node_id: {'weight': 1} for node_id in node_ids}))
+
+    def _foreign_names(self, node, count):
+        # names owned by other nodes than the one that receives the requests
+        node_ids = [node_.node_id for node_ in self.nodes]
+        names = ('cam{:d}'.format(i) for i in range(100))
+        return [name for name in names if self._owner(name, node_ids) is not node][:count]
+
+    def test_requests_are_forwarded_to_the_owner(self):
+        entry = self.nodes[0]
+        names = self._foreign_names(entry, 2)
+        node_ids = [node.node_id for node in self.nodes]
+        for name in names:
+            status, result = entry.request('PUT', '/' + name, {'source': 'rtsp://camera/' + name, 'rec': False})
+            self.assertEqual((status, result), (200, {'success': True}))
+
+        for name in names:
+            owner = self._owner(name, node_ids)
+            # the owner answered the request itself instead of finding the stream in the registry later
+            self.assertTrue(owner.served('"PUT /{} HTTP/1.1" 200'.format(name)))
+            self.assertTrue(wait_for(lambda: 'rtsp://camera/' + name in owner.started_sources()))
+            self.assertIn(name, owner.streams())
+            for node in self.nodes:
+                if node is not owner:
+                    self.assertNotIn(name, node.streams())
+                    self.assertNotIn('rtsp://camera/' + name, node.started_sources())
+            self.assertIn(name, self._cluster_nodes(entry)[owner.node_id]['streams'])
+
+        status, result = entry.request('DELETE', '/' + names[0])
+        self.assertEqual(status, 200)
+        self.assertTrue(result['success'])
+        owner = self._owner(names[0], node_ids)
+        self.assertTrue(wait_for(lambda: names[0] not in owner.streams()))
+        self.assertIn(names[1], self._owner(names[1], node_ids).streams())
+
+    def test_streams_move_when_a_node_stops_heartbeating(self):
+        entry = self.nodes[0]
+        name = self._foreign_names(entry, 1)[0]
+        node_ids = [node.node_id for node in self.nodes]
+        owner = self._owner(name, node_ids)
+        status, _ = entry.request('PUT', '/' + name, {'source': 'rtsp://camera/' + name, 'rec': False})
+        self.assertEqual(status, 200)
+        self.assertTrue(wait_for(lambda: 'rtsp://camera/' + name in owner.started_sources()))
+
+        # a killed node does not leave the cluster, the others wait for its heartbeat to time out
+        owner.stop(signal.SIGKILL)
+        survivors = [node for node in self.nodes if node is not owner]
+        successor = self._owner(name, [node.node_id for node in survivors])
+        self.assertTrue(wait_for(lambda: 'rtsp://camera/' + name in successor.started_sources(), NODE_TIMEOUT + 10))
+        self.assertIn(name, successor.streams())
+        for node in survivors:
+            self.assertTrue(wait_for(lambda: set(self._cluster_nodes(node)) == {node_.node_id for node_ in survivors}))
+            self.assertIn(name, self._cluster_nodes(node)[successor.node_id]['streams'])
+
+
+class NoOwnerTest(unittest.TestCase):
+    def test_streams_without_an_owner_are_refused(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # a node with weight 0 takes no streams, and it is the only one
+        node = Node(directory.name, 'node0', os.path.join(directory.name, 'registry.json'), '/bin/false', weight=0)
+        self.addCleanup(node.stop)
+        self.assertTrue(wait_for(lambda: node.request('GET', '/:cluster')[0] == 200))
+        for method, body in (('PUT', {'source': 'rtsp://camera/cam0'}), ('DELETE', None)):
+            status, result = node.request(method, '/cam0', body)
+            self.assertEqual(status, 503)
+            self.assertFalse(result['success'])
+            self.assertIn('cam0', result['error'])
+
+
+class ApplyTest(unittest.TestCase):
+    def test_same_stream_table_is_unchanged(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        ffmpeg_bin = os.path.join(directory.name, 'ffmpeg')
+        with open(ffmpeg_bin, 'w') as f:
+            f.write(FAKE_FFMPEG.format(python=sys.executable))
+        os.chmod(ffmpeg_bin, 0o755)
+        # imported into the registry as parsed from streams.ini, applied again with the request defaults
+        node = Node(directory.name, 'node0', os.path.join(directory.name, 'registry.json'), ffmpeg_bin, streams=(
+            '[stream:cam0]\nsource = rtsp://camera/cam0\nlive = true\nrec = false\n'
+        ))
+        self.addCleanup(node.stop)
+        self.assertTrue(wait_for(lambda: 'rtsp://camera/cam0' in node.started_sources()))
+        streams = [{'name': 'cam0', 'source': 'rtsp://camera/cam0', 'rec': False}]
+        for _ in range(2):
+            status, result = node.request('POST', '/:apply', streams)
+            self.assertEqual(status, 200)
+            self.assertEqual([result[key] for key in ('added', 'changed', 'removed', 'unchanged')], [[], [], [], 1])
+        time.sleep(1)
+        self.assertEqual(node.started_sources(), ['rtsp://camera/cam0'])
+
+
+def pick_node(nodes, node_id):
+    return next(node for node in nodes if node.node_id == node_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
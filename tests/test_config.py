@@ -0,0 +1,56 @@
+import os
+import tempfile
+import textwrap
+import unittest
+from unittest import mock
+
+import config
+
+
+class ReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.config_file = os.path.join(self.directory.name, 'videoserver.ini')
+        with open(self.config_file, 'w') as f:
+            f.write(textwrap.dedent('''\
+                [general]
+                ffmpeg_bin = /bin/true
+                live_dir = {path}/live
+                rec_dir = {path}/rec
+                [api]
+                http_addr = 127.0.0.1
+                http_port = 8080
+                [live]
+                upload_port = 8081
+            ''').format(path=self.directory.name))
+        with mock.patch.dict(os.environ, VIDEOSERVER_CONFIG_DIR=self.directory.name):
+            self.config = config.Config()
+
+    def test_complete_file_is_not_rewritten(self):
+        inode = os.stat(self.config_file).st_ino
+        self.config.reload()
+        self.assertEqual(os.stat(self.config_file).st_ino, inode)
+
+    def test_removed_option_is_restored(self):
+        with open(self.config_file) as f:
+            lines = f.readlines()
+        with open(self.config_file, 'w') as f:
+            f.writelines(line for line in lines if not line.startswith('ffmpeg_stop_timeout'))
+        self.config.reload()
+        # the default is back, in the parser readers use and in the file
+        self.assertEqual(self.config.parser.get('general', 'ffmpeg_stop_timeout'), '10')
+        with open(self.config_file) as f:
+            self.assertIn('ffmpeg_stop_timeout = 10', f.read())
+
+
+    def test_spawn_limit_falls_back_when_not_positive(self):
+        self.config.parser.set('general', 'ffmpeg_spawn_rate', '0')
+        self.config.parser.set('general', 'ffmpeg_spawn_burst', '-1')
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(self.config.get_ffmpeg_spawn_rate(), 10)
+            self.assertEqual(self.config.get_ffmpeg_spawn_burst(), 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,312 @@
+import http.server
+import json
+import os
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+import urllib.parse
+
+import notifications
+import notifiers
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+# stand-in for the Slack webhook and the HTTP GET endpoint, records every request with the client port of its
+# connection; with drop set it closes every connection after one response without announcing it
+class FakeHttpServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        self.requests = []
+        self.status = 200
+        self.drop = False
+        self.closed = 0
+        super().__init__(('127.0.0.1', 0), FakeHttpHandler)
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{:d}{}'.format(self.server_address[1], path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeHttpHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self, body):
+        self.server.requests.append((self.client_address[1], self.command, self.path, body))
+        response = b'ok' if self.server.status == 200 else b'error'
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', len(response))
+        self.end_headers()
+        self.wfile.write(response)
+        if self.server.drop:
+            self.close_connection = True
+
+    def do_GET(self):
+        self._respond(None)
+
+    def do_POST(self):
+        self._respond(self.rfile.read(int(self.headers['Content-Length'])))
+
+    def finish(self):
+        super().finish()
+        self.server.closed += 1
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+# minimal SMTP server: counts sessions and accepted messages, with drop set it hangs up after each message the way
+# servers end idle sessions
+class FakeSmtpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        self.sessions = 0
+        self.messages = []
+        self.drop = False
+        self.closed = 0
+        super().__init__(('127.0.0.1', 0), FakeSmtpHandler)
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeSmtpHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.sessions += 1
+        self.wfile.write(b'220 localhost\r\n')
+        data = None
+        for line in self.rfile:
+            if data is not None:
+                if line != b'.\r\n':
+                    data.append(line)
+                    continue
+                self.server.messages.append(b''.join(data))
+                data = None
+                self.wfile.write(b'250 queued\r\n')
+                if self.server.drop:
+                    return
+                continue
+            command = line[:4].upper()
+            if command == b'EHLO':
+                self.wfile.write(b'250-localhost\r\n250 AUTH PLAIN LOGIN\r\n')
+            elif command == b'AUTH':
+                self.wfile.write(b'235 accepted\r\n')
+            elif command == b'DATA':
+                data = []
+                self.wfile.write(b'354 go ahead\r\n')
+            elif command == b'QUIT':
+                self.wfile.write(b'221 bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 ok\r\n')
+
+    def finish(self):
+        super().finish()
+        self.server.closed += 1
+
+
+class FakeConfig:
+    def __init__(self, http_server=None, smtp_server=None):
+        self.http_server = http_server
+        self.smtp_server = smtp_server
+
+    def get_slack_webhook_url(self):
+        return self.http_server.url('/slack')
+
+    def get_slack_channel(self):
+        return '#video'
+
+    def get_http_get_url(self):
+        return self.http_server.url('/status')
+
+    def get_http_get_success_response(self):
+        return 'ok'
+
+    def get_smtp_server(self):
+        return '127.0.0.1'
+
+    def get_smtp_port(self):
+        return self.smtp_server.server_address[1]
+
+    def get_smtp_security(self):
+        return 'none'
+
+    def get_smtp_login(self):
+        return 'videoserver@example.com'
+
+    def get_smtp_password(self):
+        return 'secret'
+
+    def get_smtp_subject(self):
+        return 'videoserver'
+
+    def get_smtp_recipient(self):
+        return 'admin@example.com'
+
+
+class DigestTest(unittest.TestCase):
+    def test_single_message_is_kept(self):
+        self.assertEqual(notifications.digest([('Stream a failed', 'a', False)]), [('Stream a failed', 'a', False)])
+
+    def test_status_changes_are_summarized(self):
+        events = [('Started', None, None)] + [('Stream s{:d} failed'.format(i), 's{:d}'.format(i), False)
+                                              for i in range(3)]
+        events.append(('Stream s1 restored', 's1', True))
+        self.assertEqual(notifications.digest(events), [(
+            'Started\n3 streams failed: s0, s1, s2\nStream s1 restored', None, None,
+        )])
+
+    def test_long_lists_are_cut(self):
+        names = ['s{:d}'.format(i) for i in range(25)]
+        self.assertTrue(notifications.summarize(names, 'failed').endswith('s19 and 5 more'))
+
+
+class DispatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.http_server = FakeHttpServer()
+        self.directory = tempfile.TemporaryDirectory()
+        self.outbox_path = os.path.join(self.directory.name, 'outbox.jsonl')
+        self.config = FakeConfig(self.http_server)
+        self.dispatcher = None
+
+    def tearDown(self):
+        if self.dispatcher:
+            self.dispatcher.stop(5)
+        self.http_server.stop()
+        self.directory.cleanup()
+
+    def _start(self, notifiers_, **kwargs):
+        self.dispatcher = notifications.NotificationDispatcher(notifiers_, self.outbox_path, **kwargs)
+        self.dispatcher.start()
+        return self.dispatcher
+
+    def _requests(self, path):
+        return [request for request in self.http_server.requests if urllib.parse.urlsplit(request[2]).path == path]
+
+    def test_burst_is_coalesced(self):
+        dispatcher = self._start([notifiers.Slack(self.config), notifiers.HttpGet(self.config)], window=0.3)
+        dispatcher.submit('Started')
+        for i in range(30):
+            dispatcher.submit('Stream cam{:d} failed'.format(i), 'cam{:d}'.format(i), False)
+        dispatcher.stop(5)
+
+        # the digest notifier sends one message for the whole burst
+        slack = self._requests('/slack')
+        self.assertEqual(len(slack), 1)
+        self.assertEqual(json.loads(slack[0][3])['text'].splitlines()[0], 'Started')
+        self.assertTrue(json.loads(slack[0][3])['text'].splitlines()[1].startswith('30 streams failed: cam0, '))
+        # the per-event notifier still gets every status change, over one kept-alive connection
+        status = self._requests('/status')
+        self.assertEqual(len(status), 30)
+        self.assertEqual(len({port for port, _, _, _ in status}), 1)
+        self.assertEqual(
+            urllib.parse.parse_qs(urllib.parse.urlsplit(status[0][2]).query),
+            {'stream': ['cam0'], 'status': ['0'], 'message': ['Stream cam0 failed']},
+        )
+        self.assertEqual(dispatcher.stats()['notifiers']['Slack']['sent'], 31)
+
+    def test_separate_bursts_are_sent_separately(self):
+        dispatcher = self._start([notifiers.Slack(self.config)], window=0.1)
+        dispatcher.submit('Stream a failed', 'a', False)
+        self.assertTrue(wait_for(lambda: len(self._requests('/slack')) == 1))
+        dispatcher.submit('Stream a restored', 'a', True)
+        self.assertTrue(wait_for(lambda: len(self._requests('/slack')) == 2))
+        self.assertEqual(
+            [json.loads(request[3])['text'] for request in self._requests('/slack')],
+            ['Stream a failed', 'Stream a restored'],
+        )
+
+    def test_failed_delivery_is_retried(self):
+        self.http_server.status = 500
+        dispatcher = self._start([notifiers.Slack(self.config)], window=0, retry_min_delay=0.1, retry_max_delay=0.1)
+        dispatcher.submit('Stream a failed', 'a', False)
+        self.assertTrue(wait_for(lambda: dispatcher.stats()['notifiers']['Slack']['retries'] >= 1))
+        self.http_server.status = 200
+        self.assertTrue(wait_for(lambda: dispatcher.stats()['notifiers']['Slack']['sent'] == 1))
+        dispatcher.stop(5)
+        self.dispatcher = None
+
+        # delivered events are acknowledged and not sent again on the next start
+        outbox = notifications.Outbox(self.outbox_path)
+        self.assertEqual(outbox.load(['Slack']), [])
+        outbox.close()
+
+    def test_undelivered_events_survive_a_restart(self):
+        self.http_server.status = 500
+        dispatcher = self._start([notifiers.Slack(self.config)], window=0, retry_min_delay=10, retry_max_delay=10)
+        dispatcher.submit('Stream a failed', 'a', False)
+        self.assertTrue(wait_for(lambda: dispatcher.stats()['notifiers']['Slack']['retries'] == 1))
+        dispatcher.stop(5)
+
+        self.http_server.status = 200
+        self.http_server.requests = []
+        self._start([notifiers.Slack(self.config)], window=0)
+        self.assertTrue(wait_for(lambda: len(self._requests('/slack')) == 1))
+        self.assertEqual(json.loads(self._requests('/slack')[0][3])['text'], 'Stream a failed')
+
+    def test_http_reconnects_after_the_server_closed_the_connection(self):
+        self.http_server.drop = True
+        slack = notifiers.Slack(self.config)
+        self.assertTrue(slack.send('first'))
+        self.assertTrue(wait_for(lambda: self.http_server.closed == 1))
+        # the kept connection is gone, the message goes out over a new one instead of failing
+        self.assertTrue(slack.send('second'))
+        slack.close()
+        requests = self._requests('/slack')
+        self.assertEqual([json.loads(request[3])['text'] for request in requests], ['first', 'second'])
+        self.assertNotEqual(requests[0][0], requests[1][0])
+
+
+class SmtpTest(unittest.TestCase):
+    def setUp(self):
+        self.smtp_server = FakeSmtpServer()
+        self.smtp = notifiers.SMTP(FakeConfig(smtp_server=self.smtp_server))
+
+    def tearDown(self):
+        self.smtp.close()
+        self.smtp_server.stop()
+
+    def test_session_is_reused(self):
+        for i in range(3):
+            self.assertTrue(self.smtp.send('message {:d}'.format(i)))
+        self.assertEqual(self.smtp_server.sessions, 1)
+        self.assertEqual(len(self.smtp_server.messages), 3)
+
+    def test_reconnects_after_the_server_closed_the_session(self):
+        self.smtp_server.drop = True
+        self.assertTrue(self.smtp.send('first'))
+        self.assertTrue(wait_for(lambda: self.smtp_server.closed == 1))
+        self.assertTrue(self.smtp.send('second'))
+        self.assertEqual(self.smtp_server.sessions, 2)
+        self.assertEqual(len(self.smtp_server.messages), 2)
+        self.assertIn(b'second', self.smtp_server.messages[1])
+
+    def test_unreachable_server_fails(self):
+        self.smtp_server.stop()
+        self.assertFalse(self.smtp.send('lost'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# stands in for FFmpeg: logs its source and reports progress on -progress pipe:1, sources ending in /stuck stop
+# advancing after the first report the way a camera that keeps the connection but sends nothing does
+FAKE_FFMPEG = textwrap.dedent('''\
+    #!{python}
+    import os, signal, sys, time
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    source = sys.argv[sys.argv.index('-i') + 1]
+    with open(os.environ['FAKE_FFMPEG_LOG'], 'a') as f:
+        f.write(source + '\\n')
+    parent = os.getppid()
+    out_time = 0
+    while os.getppid() == parent:
+        if out_time == 0 or not source.endswith('/stuck'):
+            out_time += 200000
+            sys.stdout.write('out_time_us={{:d}}\\nprogress=continue\\n'.format(out_time))
+            sys.stdout.flush()
+        time.sleep(0.2)
+''')
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        result = predicate()
+        if result or time.monotonic() >= deadline:
+            return result
+        time.sleep(0.05)
+
+
+class ShardedStallTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        path = self.directory.name
+        ffmpeg_bin = os.path.join(path, 'ffmpeg')
+        with open(ffmpeg_bin, 'w') as f:
+            f.write(FAKE_FFMPEG.format(python=sys.executable))
+        os.chmod(ffmpeg_bin, 0o755)
+        for name in ('live', 'rec'):
+            os.makedirs(os.path.join(path, name))
+        with open(os.path.join(path, 'videoserver.ini'), 'w') as f:
+            f.write(textwrap.dedent('''\
+                [general]
+                ffmpeg_bin = {ffmpeg_bin}
+                live_dir = {path}/live
+                rec_dir = {path}/rec
+                workers = 2
+                stream_stall_timeout = 2
+                [api]
+                http_port = 0
+            ''').format(ffmpeg_bin=ffmpeg_bin, path=path))
+        with open(os.path.join(path, 'streams.ini'), 'w') as f:
+            for name in ('stuck', 'steady'):
+                f.write(textwrap.dedent('''\
+                    [stream:{name}]
+                    source = rtsp://camera/{name}
+                    live = false
+                    rec = true
+                    snap = false
+                    segment_duration = 60
+                ''').format(name=name))
+        self.ffmpeg_log = os.path.join(path, 'ffmpeg.log')
+        self.log = open(os.path.join(path, 'videoserver.log'), 'w')
+        self.addCleanup(self.log.close)
+        env = dict(os.environ, VIDEOSERVER_CONFIG_DIR=path, FAKE_FFMPEG_LOG=self.ffmpeg_log)
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'main.py')], cwd=ROOT, env=env, stdout=self.log, stderr=self.log,
+        )
+        self.addCleanup(self._stop)
+
+    def _stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def _starts(self, source):
+        try:
+            with open(self.ffmpeg_log) as f:
+                return f.read().split().count(source)
+        except FileNotFoundError:
+            return 0
+
+    def test_rec_only_stream_is_restarted_when_its_output_stalls(self):
+        # workers have no recording index, the stall is seen in FFmpeg's progress report
+        self.assertTrue(wait_for(lambda: self._starts('rtsp://camera/stuck') >= 2, 15))
+        self.assertEqual(self._starts('rtsp://camera/steady'), 1)
+        with open(self.log.name) as f:
+            self.assertIn('Output of stream stuck stalled', f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
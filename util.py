@@ -1,5 +1,38 @@
+import http.client
+import logging
+import os
+import random
+import selectors
 import string
+import time
+import urllib.parse
 import urllib.request
+import zlib
+
+
+def configure_logging(prefix=''):
+    logging.root.setLevel(logging.NOTSET)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s [%(levelname)s] {}%(message)s'.format(prefix), '%Y-%m-%d %H:%M:%S',
+    ))
+    logging.root.addHandler(handler)
+
+
+def stagger_offset(name, period):
+    # stable for a name and spread evenly across the period, unlike shard_of it hashes a prefixed name so that
+    # streams of one worker do not share offsets
+    return zlib.crc32('offset:{}'.format(name).encode('utf-8')) % max(int(period), 1)
+
+
+def write_file_atomic(path, content):
+    # readers see either the old or the new file, never a partially written one
+    tmp_path = '{}.{:d}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
 
 
 def escape_name(s):
@@ -47,3 +80,135 @@ class TolerantHTTPErrorProcessor(urllib.request.HTTPErrorProcessor):
         return res
 
     https_response = http_response
+
+
+# one keep-alive connection reused across requests, reopened when the host changes or the server closes it
+class PersistentHTTPConnection:
+    def __init__(self, timeout=4):
+        self.timeout = timeout
+        self.key = None
+        self.connection = None
+
+    def request(self, method, url, body=None, headers=None):
+        parts = urllib.parse.urlsplit(url)
+        if (parts.scheme, parts.netloc) != self.key:
+            self.close()
+            self.key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        while True:
+            reused = self.connection is not None
+            if not reused:
+                cls = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+                self.connection = cls(parts.netloc, timeout=self.timeout)
+            try:
+                self.connection.request(method, path, body=body, headers=headers or {})
+                response = self.connection.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                self.close()
+                # the server dropped an idle connection, the request never reached it
+                if reused:
+                    continue
+                raise
+            except Exception:
+                self.close()
+                raise
+            if response.will_close:
+                self.close()
+            return response.status, data
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+
+class Waker:
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        os.set_blocking(self.write_fd, False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.read_fd, selectors.EVENT_READ)
+
+    def wake(self):
+        try:
+            os.write(self.write_fd, b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def register(self, fileobj):
+        self.selector.register(fileobj, selectors.EVENT_READ)
+
+    def unregister(self, fileobj):
+        self.selector.unregister(fileobj)
+
+    def wait(self, timeout=None):
+        if timeout is not None and timeout < 0:
+            timeout = 0
+        ready = []
+        for key, _ in self.selector.select(timeout):
+            if key.fd != self.read_fd:
+                ready.append(key.fileobj)
+        while True:
+            try:
+                if not os.read(self.read_fd, 4096):
+                    break
+            except BlockingIOError:
+                break
+        return ready
+
+    def close(self):
+        self.selector.close()
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+class Backoff:
+    def __init__(self, initial=0.5, maximum=30.0, factor=2.0, jitter=0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next_delay(self):
+        delay = min(self.initial * self.factor ** self.attempts, self.maximum)
+        self.attempts += 1
+        # spread retries of units that failed together
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        self.attempts = 0
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def consume(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def next_available(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate